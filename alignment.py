@@ -0,0 +1,79 @@
+'''
+Align the fund series to a trading calendar, e.g. the days of the Shanghai Composite Index.
+'''
+
+import numpy as np
+
+
+class CalendarAligner():
+    """
+    Join dates to the days of a trading calendar.
+
+    The calendar is turned into a table of day --> row once, so joining n dates
+    takes O(n) time whatever the lags and holidays of each fund are.
+
+
+    Parameters
+    ----------
+    calendar_dates : array of int64
+        The days of the calendar, days since 1970-01-01, in any order.
+        Negative values are ignored.
+    """
+
+    def __init__(self, calendar_dates):
+        calendar_dates = np.asarray(calendar_dates, dtype = np.int64)
+        rows = np.flatnonzero(calendar_dates >= 0)
+
+        if len(rows) == 0:
+            self.first_day = 0
+            self.table = np.full(0, -1, dtype = np.int64)
+            return
+
+        self.first_day = calendar_dates[rows].min()
+        self.table = np.full(calendar_dates[rows].max() - self.first_day + 1, -1, dtype = np.int64)
+        self.table[calendar_dates[rows] - self.first_day] = rows
+
+
+    def positions(self, dates):
+        """
+        Returns the calendar row of each date, -1 if the date is not in the calendar.
+
+        Parameters
+        ----------
+        dates : int64 array of any shape, days since 1970-01-01, negative values are padding.
+        """
+
+        days = np.asarray(dates, dtype = np.int64) - self.first_day
+        is_in_range = (days >= 0) & (days < len(self.table))
+
+        positions = np.full(days.shape, -1, dtype = np.int64)
+        positions[is_in_range] = self.table[days[is_in_range]]
+
+        return positions
+
+
+    def align(self, fund_dates, fund_lengths):
+        """
+        Align the stacked fund rows to the calendar.
+
+        Parameters
+        ----------
+        fund_dates : 2-D int64 array (funds x days), -1 after the last row.
+
+        fund_lengths : number of rows of each fund.
+
+        Returns: (positions, is_aligned, dropped_days)
+            positions    - calendar row of each fund row, -1 if it is not aligned.
+            is_aligned   - 2-D bool array, True if the fund row has a calendar day.
+            dropped_days - number of rows of each fund that are not in the calendar.
+        """
+
+        positions = self.positions(fund_dates)
+
+        is_row = np.arange(fund_dates.shape[1])[np.newaxis, :] < np.asarray(fund_lengths)[:, np.newaxis]
+        is_aligned = is_row & (positions >= 0)
+        positions[~is_aligned] = -1
+
+        dropped_days = is_row.sum(axis = 1) - is_aligned.sum(axis = 1)
+
+        return positions, is_aligned, dropped_days
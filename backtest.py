@@ -0,0 +1,296 @@
+'''
+Walk-forward backtest of the label strategies.
+
+At every rebalance day the features that the labels use are computed again
+from the history up to that day, the labels of labelengine pick the funds, and
+the funds are held until the next rebalance day, their equal weighted return is
+put against the Shanghai Composite Index.
+
+Nothing loops over the rebalance days: the history of every fund is packed to
+its own rows once, the features of all the rebalance days are gathered with
+fancy indexing into arrays of days x funds, and the ranks of every day are
+taken by one partial selection.
+'''
+
+import numpy as np
+import pandas as pd
+
+import datatypes as dy
+import labelengine
+import navpanel
+import featureengineer as fe
+
+
+class WalkForward():
+    """
+    The fund history and the index that the strategies are backtested on.
+
+    The features of a rebalance day are the ones that featureengineer.GenerateLatestData
+    gives when the history ends on that day: the increases are taken on the rows of
+    each fund and days_of_processed counts its latest dy.TOTAL_DAYS rows that the index has.
+
+
+    Parameters
+    ----------
+    panel : navpanel.NavPanel
+        The history of the funds, with the field total.
+
+    sci_df : DataFrame
+        The index indexed by date, with the column close, like sh_index.csv.
+        Its days are the calendar of the rebalance days.
+    """
+
+    def __init__(self, panel, sci_df):
+        self.symbols = np.asarray(panel.symbols)
+
+        sci_df = sci_df.sort_index()
+        self.dates = pd.to_datetime(sci_df.index).values.astype('datetime64[D]')
+        self.sci_close = sci_df['close'].values.astype(float)
+
+        present = np.asarray(panel.present)
+        total = np.asarray(panel.data['total'], dtype = float)
+
+        # Pack the rows of each fund to the front of its column, the oldest row first,
+        # so the n-th row back from a day is an index instead of a search.
+        counts = np.cumsum(present, axis = 0)
+        rows, columns = np.nonzero(present)
+        ranks = counts[rows, columns] - 1
+
+        num_of_rows = int(present.sum(axis = 0).max()) if len(self.symbols) > 0 else 0
+        self.totals = np.full((max(num_of_rows, 1), len(self.symbols)), np.nan)
+        self.totals[ranks, columns] = total[rows, columns]
+
+        # 1 where the row of the fund is on a day of the index, counted like the days of process_fund_history_data.
+        is_on_calendar = np.zeros(self.totals.shape, dtype = bool)
+        is_on_calendar[ranks, columns] = np.isin(panel.dates[rows], self.dates)
+        self.calendar_counts = np.vstack([np.zeros((1, len(self.symbols)), dtype = int), np.cumsum(is_on_calendar, axis = 0)])
+
+        # The number of rows of each fund up to each calendar day.
+        panel_rows = np.searchsorted(panel.dates, self.dates, side = 'right') - 1
+        self.row_counts = np.where(panel_rows[:, np.newaxis] >= 0, counts[np.maximum(panel_rows, 0)], 0)
+
+
+    def rebalance_days(self, step = dy.ONE_MONTH, holding = None, warmup = dy.SIX_MONTHS):
+        """
+        Returns the calendar rows of the rebalance days, every step days after warmup,
+        the last one still has holding days after it.
+        """
+
+        holding = step if holding is None else holding
+
+        return np.arange(warmup, len(self.dates) - holding, step)
+
+
+    def features(self, days, horizons = None):
+        """
+        Returns dict of column --> 2-D array (days x funds) of the features on the calendar rows days,
+        days_of_processed and the increase of every horizon, NaN where the fund has no such row yet
+        and days_of_processed is 0 before the first row of the fund.
+        """
+
+        if horizons is None:
+            horizons = dy.INCREASE_HORIZONS
+
+        latest = self.row_counts[days] - 1
+        columns = np.arange(len(self.symbols))[np.newaxis, :]
+
+        latest_totals = self._gather(latest, columns)
+
+        features = dict()
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            for days_of_horizon in horizons:
+                past_totals = self._gather(latest - (days_of_horizon - 1), columns)
+                features[fe.increase_column_name(days_of_horizon)] = np.round((latest_totals - past_totals) / past_totals, 4)
+
+        first = np.maximum(latest + 1 - dy.TOTAL_DAYS, 0)
+        days_of_processed = self.calendar_counts[latest + 1, columns] - self.calendar_counts[first, columns]
+        features['days_of_processed'] = np.where(latest >= 0, np.maximum(days_of_processed, 1), 0)
+
+        return features
+
+
+    def forward_returns(self, days, holding):
+        """
+        Returns (fund_returns, sci_returns) from each calendar row of days to holding days later,
+        fund_returns is 2-D (days x funds), NaN where the fund has no row on the first day.
+        A fund without a row on the last day is valued at its latest row before it.
+        """
+
+        columns = np.arange(len(self.symbols))[np.newaxis, :]
+
+        start_totals = self._gather(self.row_counts[days] - 1, columns)
+        end_totals   = self._gather(self.row_counts[days + holding] - 1, columns)
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            fund_returns = end_totals / start_totals - 1
+        sci_returns = self.sci_close[days + holding] / self.sci_close[days] - 1
+
+        return fund_returns, sci_returns
+
+
+    def run(self, rules, universe = None, step = dy.ONE_MONTH, holding = None, warmup = dy.SIX_MONTHS):
+        """
+        Backtest the label rules.
+
+        Parameters
+        ----------
+        rules, universe : see labelengine.label_masks.
+            Each label is a strategy, the funds of the universe are one more, named universe.
+
+        step : int, default is dy.ONE_MONTH
+            The calendar days between two rebalance days.
+
+        holding : int, default is step
+            The calendar days that the funds are held.
+
+        warmup : int, default is dy.SIX_MONTHS
+            The calendar days before the first rebalance day.
+
+        Returns
+        -------
+        DataFrame, one row per rebalance day and strategy:
+            date, label, num_of_funds, fund_return, sci_return, excess_return.
+            fund_return is the equal weighted return of the funds, NaN if no fund is labeled.
+        """
+
+        holding = step if holding is None else holding
+        days = self.rebalance_days(step, holding, warmup)
+
+        features = self.features(days)
+        fund_returns, sci_returns = self.forward_returns(days, holding)
+
+        return evaluate_rules(self.dates[days], features, fund_returns, sci_returns, rules, universe)
+
+
+    def _gather(self, rows, columns):
+        # The totals of the packed rows, NaN for the rows before the first one.
+        return np.where(rows >= 0, self.totals[np.maximum(rows, 0), columns], np.nan)
+
+
+def evaluate_rules(dates, features, fund_returns, sci_returns, rules, universe = None):
+    '''
+    Hold the funds of each label on every rebalance day, see WalkForward.run.
+
+    Inputs:
+        dates - the rebalance days.
+        features - dict of column --> 2-D array (days x funds), see WalkForward.features.
+        fund_returns, sci_returns - see WalkForward.forward_returns.
+        rules, universe - see labelengine.label_masks.
+
+    Returns: DataFrame, see WalkForward.run.
+    '''
+    rules = list(rules) + [{'name' : 'universe', 'conditions' : []}]
+    masks = labelengine.label_masks(features, rules, universe)
+
+    results = list()
+    for rule in rules:
+        is_held = np.broadcast_to(masks[rule['name']], fund_returns.shape) & ~np.isnan(fund_returns)
+        num_of_funds = is_held.sum(axis = 1)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            returns = np.where(is_held, fund_returns, 0.0).sum(axis = 1) / num_of_funds
+
+        results.append(pd.DataFrame({'date'          : dates,
+                                     'label'         : rule['name'],
+                                     'num_of_funds'  : num_of_funds,
+                                     'fund_return'   : returns,
+                                     'sci_return'    : sci_returns,
+                                     'excess_return' : returns - sci_returns},
+                                    columns = ['date', 'label', 'num_of_funds', 'fund_return', 'sci_return', 'excess_return']))
+
+    return pd.concat(results, ignore_index = True)
+
+
+def summarize(results, holding = dy.ONE_MONTH):
+    '''
+    Summarize the backtest of each strategy.
+
+    Inputs:
+        results - DataFrame that WalkForward.run returns.
+        holding - the calendar days that the funds are held, to annualize the returns.
+
+    Returns: DataFrame indexed by label
+        rebalances - number of rebalance days.
+        invested - number of rebalance days that some funds are labeled, on the others the money is not invested.
+        mean_return, mean_sci_return, mean_excess_return - mean of the invested periods.
+        hit_rate - the part of the invested periods that beat the index.
+        cumulative_return, cumulative_sci_return - compounded over all the periods.
+        annual_excess_return - the annualized cumulative return minus the annualized cumulative index return.
+    '''
+    summary = dict()
+    for label, label_df in results.groupby('label', sort = False):
+        invested = label_df['fund_return'].notnull()
+        periods = len(label_df) * holding / float(dy.DAYS_OF_YEAR)
+
+        cumulative_return = (1 + label_df['fund_return'].fillna(0.0)).prod() - 1
+        cumulative_sci_return = (1 + label_df['sci_return']).prod() - 1
+
+        summary[label] = {
+                            'rebalances' : len(label_df),
+                            'invested' : int(invested.sum()),
+                            'mean_return' : label_df['fund_return'][invested].mean(),
+                            'mean_sci_return' : label_df['sci_return'][invested].mean(),
+                            'mean_excess_return' : label_df['excess_return'][invested].mean(),
+                            'hit_rate' : (label_df['excess_return'][invested] > 0).mean(),
+                            'cumulative_return' : cumulative_return,
+                            'cumulative_sci_return' : cumulative_sci_return,
+                            'annual_excess_return' : (1 + cumulative_return) ** (1 / periods) - (1 + cumulative_sci_return) ** (1 / periods)
+                         }
+
+    return pd.DataFrame.from_dict(summary, orient = 'index')[['rebalances', 'invested', 'mean_return', 'mean_sci_return',
+                                                              'mean_excess_return', 'hit_rate', 'cumulative_return',
+                                                              'cumulative_sci_return', 'annual_excess_return']]
+
+
+def load_walk_forward(fund_type = 'mix', panel_path = None):
+    '''
+    Returns the WalkForward of the funds of fund_type, see RunBacktest.
+    '''
+    fund_symbols = fe._type_fund_symbols(fund_type)
+
+    if panel_path is not None:
+        panel = navpanel.NavPanelStore(panel_path).load(symbols = fund_symbols, fields = ['total'], mmap = False)
+    else:
+        panel = navpanel.NavPanel.from_csv_dir(r'.\data\processingdata\fund\historyinfo', fields = ['total'])
+        if fund_symbols is not None:
+            panel_symbols = set(panel.symbols)
+            panel = panel.select([symbol for symbol in fund_symbols if symbol in panel_symbols])
+    print('Backtesting %s funds...' %(len(panel)))
+
+    sci_df = pd.read_csv(r'.\data\processingdata\fund\sh_index.csv', index_col = 'date')
+
+    return WalkForward(panel, sci_df)
+
+
+def RunBacktest(fund_type = 'mix', panel_path = None, label_rules = None, step = dy.ONE_MONTH, holding = None,
+                warmup = dy.SIX_MONTHS, output_file_long_path = None):
+    '''
+    Backtest the labels of GenerateLabelFundsToFiles on the funds of fund_type and print the summary.
+
+    Inputs:
+        fund_type - the funds of this type in featureengineer.FUND_TYPES_FILE, all the funds if there is no such file.
+        panel_path - the directory of a navpanel.NavPanelStore to read the fund history from,
+                     None reads the per fund csv files.
+        label_rules - (universe, rules) of labelengine, default is labelengine.default_label_rules().
+        step, holding, warmup - see WalkForward.run.
+        output_file_long_path - save the result of every rebalance day to this file, if it is not None.
+
+    Returns: (results, summary), see WalkForward.run and summarize.
+    '''
+    walk_forward = load_walk_forward(fund_type, panel_path)
+
+    label_universe, rules = labelengine.default_label_rules() if label_rules is None else label_rules
+    holding = step if holding is None else holding
+
+    results = walk_forward.run(rules, label_universe, step = step, holding = holding, warmup = warmup)
+    summary = summarize(results, holding)
+    print(summary.to_string())
+
+    if output_file_long_path is not None:
+        results.to_csv(output_file_long_path, encoding = 'utf-8', index = False)
+        print('Saved the backtest of %s rebalance days to %s' %(len(results), output_file_long_path))
+
+    return results, summary
+
+
+if __name__ == "__main__":
+    RunBacktest(output_file_long_path = r'.\data\processingdata\mix_fund_backtest.csv')
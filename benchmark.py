@@ -0,0 +1,484 @@
+'''
+Benchmarks of the fetch and feature stages.
+
+Run:
+    python benchmark.py
+    python benchmark.py suite --output benchmark.json
+    python benchmark.py risk
+    python benchmark.py imports
+    python benchmark.py memory
+    python benchmark.py snapshots
+'''
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import zlib
+import contextlib
+import tracemalloc
+
+import pandas as pd
+
+import utility
+import fetcher
+import fundbasic
+import navpanel
+import synthetic
+import snapshotstore
+import featureengineer as fe
+import datatypes as dy
+
+
+def _make_fund_info(fund_symbol):
+    '''
+    A frame with the same columns as nav.get_fund_info() returns.
+    '''
+    return pd.DataFrame({
+                            'jjqc'      : ['Fund %s full name' %(fund_symbol)],
+                            'jjjc'      : ['Fund %s' %(fund_symbol)],
+                            'clrq'      : ['2012-05-%02d 00:00:00' %(int(fund_symbol) % 28 + 1)],
+                            'ssrq'      : ['2012-06-01 00:00:00'],
+                            'xcr'       : ['--'],
+                            'ssdd'      : ['--'],
+                            'Type1Name' : ['open'],
+                            'Type2Name' : ['mix'],
+                            'Type3Name' : ['mix'],
+                            'jjgm'      : ['%.4f' %(int(fund_symbol) % 97 / 3.0)],
+                            'jjfe'      : ['%.6f' %(int(fund_symbol) % 89 / 7.0)],
+                            'jjltfe'    : ['%.6f' %(int(fund_symbol) % 83 / 11.0)],
+                            'jjferq'    : ['2016-09-30 00:00:00'],
+                            'quarter'   : ['2'],
+                            'glr'       : ['company'],
+                            'tgr'       : ['trustee'],
+                        },
+                        index = pd.Index([fund_symbol], name = 'symbol'))
+
+
+def benchmark_fund_basic(sizes = (1000, 2500, 5000, 10000)):
+    '''
+    Time fundbasic.build_fund_basic_df for several numbers of symbols.
+    The time per symbol should stay flat if the building scales linearly.
+
+    Returns: list of dict with size, seconds and microseconds_per_symbol.
+    '''
+    results = []
+    for size in sizes:
+        frames = [_make_fund_info('%06d' %(i)) for i in range(size)]
+
+        start = time.perf_counter()
+        fundbasic.build_fund_basic_df(frames)
+        seconds = time.perf_counter() - start
+
+        results.append({'size' : size,
+                        'seconds' : round(seconds, 4),
+                        'microseconds_per_symbol' : round(seconds / size * 1e6, 2)})
+        print('build_fund_basic_df: %6d symbols %8.4fs %8.2fus/symbol' %(size, seconds, seconds / size * 1e6))
+
+    return results
+
+
+def benchmark_history_features(sizes = (500, 1000, 2000, 4000), num_of_days = 1500):
+    '''
+    Time featureengineer.compute_history_features on the whole universe at once,
+    including the alignment of every fund to the SCI days.
+
+    Returns: list of dict with size, seconds and microseconds_per_fund.
+    '''
+    results = []
+    for size in sizes:
+        universe = synthetic.SyntheticUniverse(size, num_of_days)
+        panel, sci_df = universe.panel(), universe.sci_history()
+
+        start = time.perf_counter()
+        fund_dates, fund_data, fund_lengths = panel.latest_rows(dy.TOTAL_DAYS, ['change'])
+        fe.compute_history_features(panel.symbols, fund_dates, fund_data['change'], fund_lengths, sci_df, is_analysis_label = True)
+        seconds = time.perf_counter() - start
+
+        results.append({'size' : size,
+                        'seconds' : round(seconds, 4),
+                        'microseconds_per_fund' : round(seconds / size * 1e6, 2)})
+        print('compute_history_features: %6d funds %8.4fs %8.2fus/fund' %(size, seconds, seconds / size * 1e6))
+
+    return results
+
+
+def benchmark_history_memory(sizes = (500, 2000), num_of_days = 1500):
+    '''
+    Compare the memory of the whole history of a universe in three layouts: the per fund frames
+    of pd.read_csv(index_col = 'date') that the csv files are read to today, a float64
+    navpanel.NavPanel and a navpanel.CompactNavHistory, read from the same csv files.
+
+    Returns: list of dict with size, the MB of each layout and the ratio of the frames to the compact history.
+    '''
+    results = []
+    for size in sizes:
+        universe = synthetic.SyntheticUniverse(size, num_of_days)
+
+        temp_path = tempfile.mkdtemp()
+        try:
+            for fund_symbol in universe.symbols:
+                his_df = universe.nav_history(fund_symbol)
+                if his_df is not None:
+                    his_df.to_csv(os.path.join(temp_path, fund_symbol + '.csv'))
+
+            frames = dict((file_name.split('.')[0], pd.read_csv(os.path.join(temp_path, file_name), index_col = 'date'))
+                          for file_name in os.listdir(temp_path))
+            frames_mb = navpanel.frames_memory_usage(frames) / 1024.0 / 1024.0
+            panel_mb = navpanel.NavPanel.from_frames(frames).memory_usage()['total'] / 1024.0 / 1024.0
+            del frames
+
+            start = time.perf_counter()
+            compact = navpanel.CompactNavHistory.from_csv_dir(temp_path)
+            seconds = time.perf_counter() - start
+            compact_mb = compact.memory_usage()['total'] / 1024.0 / 1024.0
+        finally:
+            shutil.rmtree(temp_path, ignore_errors = True)
+
+        results.append({'size' : size,
+                        'frames_mb' : round(frames_mb, 2),
+                        'panel_mb' : round(panel_mb, 2),
+                        'compact_mb' : round(compact_mb, 2),
+                        'frames_to_compact' : round(frames_mb / compact_mb, 1),
+                        'compact_read_seconds' : round(seconds, 4)})
+        print('history memory: %6d funds, frames %8.2f MB, float64 panel %8.2f MB, compact %8.2f MB (%.1fx smaller than the frames)'
+              %(size, frames_mb, panel_mb, compact_mb, frames_mb / compact_mb))
+
+    return results
+
+
+def benchmark_snapshot_store(num_of_funds = 500, num_of_days = 750, num_of_snapshots = 30):
+    '''
+    Store a month of synthetic daily data directories in a snapshotstore.SnapshotStore.
+
+    Every day is written like main.py fetch does: the basic information of the funds, the history
+    of every fund extended from the directory of the day before, the navpanel, the manifests of the
+    fetches and the benchmark indices, all by fetcher.Fecther against synthetic.FakeNav. The store
+    skips the navpanel and the manifests, see snapshotstore.EXCLUDED_PATTERNS, it is compared with
+    keeping the whole directories and with keeping the stored files compressed file by file, and the
+    last day is read back from the store.
+
+    Returns: dict with the bytes of the directories, of the skipped files, of the compressed files and
+             of the store, the ratios and the seconds to add a day.
+    '''
+    universe = synthetic.SyntheticUniverse(num_of_funds, num_of_days + num_of_snapshots)
+    fake_nav = synthetic.FakeNav(universe)
+    fc = fetcher.Fecther(nav_api = fake_nav, ts_api = fake_nav)
+    start_day = universe.calendar[0].strftime('%Y-%m-%d')
+
+    temp_path = tempfile.mkdtemp()
+    try:
+        store = snapshotstore.SnapshotStore(os.path.join(temp_path, 'snapshots'))
+        raw_bytes = 0
+        excluded_bytes = 0
+        compressed_bytes = 0
+        seconds = 0.0
+        previous_path = None
+
+        for i in range(num_of_snapshots):
+            end_day = universe.calendar[num_of_days + i].strftime('%Y-%m-%d')
+            day = end_day.replace('-', '')
+            fund_path = os.path.join(temp_path, 'originaldata', day, 'fund') + os.sep
+            history_path = utility.check_path(fund_path + 'historyinfo') + os.sep
+            day_path = os.path.dirname(os.path.dirname(fund_path))
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                fc.fetch_fund_basic_data(['all'], fund_path + 'fund_basic.csv', resume = False)
+                fc.fetch_fund_history_data(['all'], history_path, start_day = start_day, end_day = end_day, resume = False,
+                                           incremental = previous_path is not None,
+                                           base_path = None if previous_path is None else previous_path + 'historyinfo' + os.sep,
+                                           panel_path = fund_path + 'navpanel' + os.sep)
+                fc.fetch_benchmark_indices(fund_path, start_day = start_day, end_day = end_day,
+                                           incremental = previous_path is not None, base_path = previous_path)
+
+            for root, _, file_names in os.walk(day_path):
+                for file_name in file_names:
+                    with open(os.path.join(root, file_name), 'rb') as f:
+                        data = f.read()
+                    raw_bytes += len(data)
+                    if store.is_excluded(os.path.relpath(os.path.join(root, file_name), day_path).replace(os.sep, '/')):
+                        excluded_bytes += len(data)
+                    else:
+                        compressed_bytes += len(zlib.compress(data, 6))
+
+            start = time.perf_counter()
+            stats = store.add_snapshot(day, day_path)
+            seconds += time.perf_counter() - start
+
+            # The next day only needs the directory of the day before, the stored ones are removed like snapshot --prune does.
+            if previous_path is not None:
+                shutil.rmtree(os.path.dirname(os.path.dirname(previous_path)))
+            previous_path = fund_path
+
+        usage = store.storage_usage()
+        bad_paths = store.verify(day, day_path)
+    finally:
+        shutil.rmtree(temp_path, ignore_errors = True)
+
+    report = {'funds' : num_of_funds,
+              'snapshots' : num_of_snapshots,
+              'files_per_day' : stats['files'],
+              'directories_mb' : round(raw_bytes / 1024.0 / 1024.0, 2),
+              'excluded_mb' : round(excluded_bytes / 1024.0 / 1024.0, 2),
+              'compressed_files_mb' : round(compressed_bytes / 1024.0 / 1024.0, 2),
+              'store_mb' : round(usage['total_bytes'] / 1024.0 / 1024.0, 2),
+              'manifests_mb' : round(usage['manifest_bytes'] / 1024.0 / 1024.0, 2),
+              'directories_to_store' : round(raw_bytes / float(usage['total_bytes']), 1),
+              'compressed_files_to_store' : round(compressed_bytes / float(usage['total_bytes']), 1),
+              'seconds_per_snapshot' : round(seconds / num_of_snapshots, 3),
+              'last_day_verified' : len(bad_paths) == 0}
+
+    print('snapshots: %d days of %d funds, directories %.2f MB of which %.2f MB skipped, stored files compressed %.2f MB, store %.2f MB (manifests %.2f MB)'
+          %(num_of_snapshots, num_of_funds, report['directories_mb'], report['excluded_mb'], report['compressed_files_mb'],
+            report['store_mb'], report['manifests_mb']))
+    print('snapshots: %.1fx smaller than the directories, %.1fx smaller than the stored files compressed, %.3fs per day, last day verified %s'
+          %(report['directories_to_store'], report['compressed_files_to_store'], report['seconds_per_snapshot'],
+            report['last_day_verified']))
+
+    return report
+
+
+def benchmark_parallel_features(num_of_funds = 2000, num_of_days = 1500, workers_list = (1, 2, 4, 8, 16, 32)):
+    '''
+    Time process_fund_history_data and AddIncreaseAttributes on the per fund csv files
+    with several numbers of worker processes.
+
+    Returns: list of dict with workers, seconds and speedup against one worker.
+    '''
+    universe = synthetic.SyntheticUniverse(num_of_funds, num_of_days)
+
+    results = []
+    current_path = os.getcwd()
+    temp_path = tempfile.mkdtemp()
+    try:
+        os.chdir(temp_path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            synthetic.write_processing_data(universe)
+
+        for workers in workers_list:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                fe.process_fund_history_data(True, 'fund_hist.csv', workers = workers)
+                fe.AddIncreaseAttributes('fund_hist.csv', workers = workers)
+            seconds = time.perf_counter() - start
+
+            speedup = results[0]['seconds'] / seconds if len(results) > 0 else 1.0
+            results.append({'workers' : workers,
+                            'seconds' : round(seconds, 4),
+                            'speedup' : round(speedup, 2)})
+            print('features of %d funds: %3d workers %8.4fs speedup %5.2f' %(num_of_funds, workers, seconds, speedup))
+    finally:
+        os.chdir(current_path)
+        shutil.rmtree(temp_path)
+
+    return results
+
+
+def benchmark_risk_features(sizes = (1000, 2000, 4000), num_of_days = 600):
+    '''
+    Time featureengineer.compute_risk_features against compute_increases on the whole universe.
+    The cost per added feature is the time per fund divided by the number of columns.
+
+    Returns: list of dict with size, stage, seconds, columns and microseconds_per_fund_per_column.
+    '''
+    results = []
+    for size in sizes:
+        universe = synthetic.SyntheticUniverse(size, num_of_days)
+        panel, sci_df = universe.panel(), universe.sci_history()
+        num_of_rows = max(max(dy.RISK_HORIZONS), max(dy.INCREASE_HORIZONS))
+        fund_dates, fund_data, fund_lengths = panel.latest_rows(num_of_rows, ['change', 'total'])
+
+        stages = [
+            ('compute_increases', lambda: fe.compute_increases(panel.symbols, fund_data['total'], fund_lengths,
+                                                               dy.INCREASE_HORIZONS)),
+            ('compute_risk_features', lambda: fe.compute_risk_features(panel.symbols, fund_dates, fund_data['change'],
+                                                                       fund_data['total'], fund_lengths, sci_df,
+                                                                       dy.RISK_HORIZONS)),
+        ]
+
+        for stage, function in stages:
+            start = time.perf_counter()
+            feature_df = function()
+            seconds = time.perf_counter() - start
+
+            columns = len(feature_df.columns)
+            cost = seconds / size / columns * 1e6
+            results.append({'size' : size,
+                            'stage' : stage,
+                            'seconds' : round(seconds, 4),
+                            'columns' : columns,
+                            'microseconds_per_fund_per_column' : round(cost, 3)})
+            print('%-22s %6d funds %3d columns %8.4fs %8.3fus/fund/column' %(stage, size, columns, seconds, cost))
+
+    return results
+
+
+def benchmark_import_times(modules, repeat = 3):
+    '''
+    Time the import of each module in a new interpreter, the way a cron job pays it when it starts.
+
+    Inputs:
+        modules - the module names, e.g. ['main', 'featureengineer', 'sklearn'].
+        repeat - the best of repeat runs is kept, the first run also reads the files from disk.
+
+    Returns: dict of module --> seconds, None if the import failed.
+    '''
+    code = 'import time; start = time.perf_counter(); import %s; print(time.perf_counter() - start)'
+    package_path = os.path.dirname(os.path.abspath(__file__))
+
+    import_times = dict()
+    for module in modules:
+        seconds = list()
+        for _ in range(repeat):
+            result = subprocess.run([sys.executable, '-c', code %(module)], cwd = package_path,
+                                    stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+            if result.returncode == 0:
+                seconds.append(float(result.stdout.split()[-1]))
+        import_times[module] = min(seconds) if len(seconds) > 0 else None
+
+        if import_times[module] is None:
+            print('import %-20s failed' %(module))
+        else:
+            print('import %-20s %.3f s' %(module, import_times[module]))
+
+    return import_times
+
+
+def _measure(function, *args, **kwargs):
+    '''
+    Run function once with its prints hidden.
+
+    Returns: dict with seconds, peak_memory_mb and error, error is None if nothing was raised.
+    '''
+    error = None
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            function(*args, **kwargs)
+    except Exception as e:
+        error = '%s: %s' %(type(e).__name__, e)
+    seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds' : round(seconds, 4),
+            'peak_memory_mb' : round(peak_memory / 1024.0 / 1024.0, 2),
+            'error' : error}
+
+
+def run_suite(sizes = (300, 1000, 3000), num_of_days = 750, latency = 0.002, failure_rate = 0.01,
+              max_workers = 8, output_file = None):
+    '''
+    Time every stage from fetching to labelling on synthetic universes of several sizes.
+
+    The fetch stages run against synthetic.FakeNav, so they write the same files as a real
+    fetch does and the feature stages read them from the usual paths. Everything runs in a
+    temporary directory. The peak memory is the one seen by tracemalloc, it includes numpy
+    and pandas buffers but not the memory of worker processes. Tracing slows the stages down,
+    so compare the seconds between sizes and commits, not with untraced runs.
+
+    Inputs:
+        sizes - the numbers of funds, GenerateLabelFundsToFiles needs more than 100 funds.
+        num_of_days - the number of trading days of every universe.
+        latency - seconds of every call to the fake nav.
+        failure_rate - the probability that a call to the fake nav fails.
+        max_workers - the threads of fetch_fund_history_data.
+        output_file - the json file to save the report to, None does not save.
+
+    Returns: dict, the report.
+        results        - one dict per size and stage with seconds, peak_memory_mb and error.
+        fake_nav_calls - the number of calls to each endpoint per size, retries included.
+    '''
+    report = {'num_of_days' : num_of_days,
+              'latency' : latency,
+              'failure_rate' : failure_rate,
+              'max_workers' : max_workers,
+              'results' : [],
+              'fake_nav_calls' : {}}
+
+    fund_path = r'.\data\processingdata\fund'
+    basic_file = fund_path + r'\mix_fund_basic.csv'
+    hist_file = r'.\data\processingdata\mix_fund_hist_analysis_label.csv'
+    merged_file = r'.\data\processingdata\mix_fund_merged.csv'
+
+    current_path = os.getcwd()
+    for size in sizes:
+        universe = synthetic.SyntheticUniverse(size, num_of_days)
+        fake_nav = synthetic.FakeNav(universe, latency = latency, failure_rate = failure_rate)
+        fc = fetcher.Fecther(nav_api = fake_nav, ts_api = fake_nav)
+        start_day = universe.calendar[0].strftime('%Y-%m-%d')
+        end_day   = universe.calendar[-1].strftime('%Y-%m-%d')
+
+        temp_path = tempfile.mkdtemp()
+        try:
+            os.chdir(temp_path)
+            file_short_path = utility.check_path(fund_path + r'\historyinfo') + dy.sep
+
+            # The features need the SCI too, it is fetched without latency and failures and not timed.
+            with contextlib.redirect_stdout(io.StringIO()):
+                fetcher.Fecther(ts_api = synthetic.FakeNav(universe)).fetch_shanghai_index(
+                    fund_path + r'\sh_index.csv', start_day = start_day, end_day = end_day)
+
+            stages = [
+                ('fetch_fund_basic_data', fc.fetch_fund_basic_data, (['all'], basic_file), {}),
+                ('fetch_fund_history_data', fc.fetch_fund_history_data, (['all'], file_short_path),
+                    {'start_day' : start_day, 'end_day' : end_day, 'max_workers' : max_workers}),
+                ('process_fund_history_data', fe.process_fund_history_data, (True, hist_file), {}),
+                ('AddIncreaseAttributes', fe.AddIncreaseAttributes, (hist_file,), {}),
+                ('MergeFundData', fe.MergeFundData, (hist_file, basic_file, merged_file), {}),
+                ('GenerateLabelFundsToFiles', fe.GenerateLabelFundsToFiles, (merged_file,), {}),
+            ]
+
+            for stage, function, args, kwargs in stages:
+                result = {'funds' : size, 'stage' : stage}
+                result.update(_measure(function, *args, **kwargs))
+                report['results'].append(result)
+                print('%-26s %6d funds %8.3fs %9.2fMB%s' %(stage, size, result['seconds'], result['peak_memory_mb'],
+                                                           '' if result['error'] is None else '  ' + result['error']))
+        finally:
+            os.chdir(current_path)
+            shutil.rmtree(temp_path)
+
+        report['fake_nav_calls'][str(size)] = dict(fake_nav.calls)
+
+    if output_file is not None:
+        with open(output_file, 'w') as f:
+            json.dump(report, f, indent = 2)
+        print('Saved benchmark report to %s' %(output_file))
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the fetch and feature stages.')
+    parser.add_argument('benchmark', nargs = '?', default = 'all', choices = ['all', 'suite', 'risk', 'imports', 'memory', 'snapshots'])
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [300, 1000, 3000])
+    parser.add_argument('--days', type = int, default = 750)
+    parser.add_argument('--latency', type = float, default = 0.002)
+    parser.add_argument('--failure-rate', type = float, default = 0.01)
+    parser.add_argument('--output', default = None)
+    args = parser.parse_args()
+
+    if args.benchmark == 'risk':
+        benchmark_risk_features()
+    elif args.benchmark == 'memory':
+        benchmark_history_memory()
+    elif args.benchmark == 'snapshots':
+        benchmark_snapshot_store()
+    elif args.benchmark == 'imports':
+        benchmark_import_times(['main', 'pandas', 'tushare', 'sklearn', 'matplotlib.pyplot', 'fetcher', 'featureengineer'])
+    elif args.benchmark == 'suite':
+        report = run_suite(args.sizes, args.days, args.latency, args.failure_rate, output_file = args.output)
+        if args.output is None:
+            json.dump(report, sys.stdout, indent = 2)
+    else:
+        benchmark_fund_basic()
+        benchmark_history_features()
+        benchmark_risk_features()
+        benchmark_parallel_features()
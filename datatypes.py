@@ -15,6 +15,8 @@ FIVE_MONTHS = 105
 
 SIX_MONTHS = 126
 
+NINE_MONTHS = 189
+
 TWELVE_MONTHS = 252
 
 EIGHTEEN_MONTHS = 378
@@ -24,3 +26,40 @@ TWENTY_FOUR_MONTHS = 504
 # There are 250 working days in a year.
 # Here I deal with two years data, and use 504 days respect 2 years.
 TOTAL_DAYS = TWENTY_FOUR_MONTHS
+
+# The horizons of the increase attributes.
+INCREASE_HORIZONS = [ONE_MONTH, TWO_MONTHS, THREE_MONTHS, FOUR_MONTHS, FIVE_MONTHS, SIX_MONTHS]
+
+# The column name of the increase in each horizon,
+# the other horizons are named increase_of_<days>_days.
+INCREASE_COLUMNS = {
+                        ONE_MONTH          : 'increase_of_one_month',
+                        TWO_MONTHS         : 'increase_of_two_months',
+                        THREE_MONTHS       : 'increase_of_three_months',
+                        FOUR_MONTHS        : 'increase_of_four_months',
+                        FIVE_MONTHS        : 'increase_of_five_months',
+                        SIX_MONTHS         : 'increase_of_six_months',
+                        NINE_MONTHS        : 'increase_of_nine_months',
+                        TWELVE_MONTHS      : 'increase_of_twelve_months',
+                        EIGHTEEN_MONTHS    : 'increase_of_eighteen_months',
+                        TWENTY_FOUR_MONTHS : 'increase_of_twenty_four_months'
+                   }
+
+# The horizons of the risk attributes.
+RISK_HORIZONS = [ONE_MONTH, THREE_MONTHS, SIX_MONTHS, TWELVE_MONTHS]
+
+# The trading days in a year, the risk attributes are annualized with it.
+DAYS_OF_YEAR = TWELVE_MONTHS
+
+# The benchmark indices, name --> the code of tushare get_hist_data.
+# The relative features are named after the name, e.g. rate_of_higher_than_hs300,
+# sci is the Shanghai Composite Index that every fund is compared to.
+BENCHMARKS = {
+                'sci'     : 'sh',
+                'szci'    : 'sz',
+                'hs300'   : 'hs300',
+                'chinext' : 'cyb'
+             }
+
+# The file of each benchmark is named after its code, so the SCI stays in sh_index.csv.
+BENCHMARK_FILE = '%s_index.csv'
@@ -1,25 +1,51 @@
 ﻿import numpy as np
 import pandas as pd
-import sklearn
-import matplotlib.pyplot as plt
 import os
+from concurrent.futures import ProcessPoolExecutor
 import datatypes as dy
+import navpanel
+import alignment
+import pipeline
+import symboluniverse
+import ranking
+import labelengine
+import utility
+import metrics
 
 
 
-def process_fund_history_data(is_analysis_label, output_file_long_path, is_accuracy = True):
+def process_fund_history_data(is_analysis_label, output_file_long_path, is_accuracy = True, panel_path = None, workers = 1,
+                              fund_symbols = None, max_memory_mb = None, benchmarks = None):
     '''
     Construct some features from the fund daily data.
-    Saves a DataFrame to a local file and returns this DataFrame.
+    Saves a DataFrame to a local file, if output_file_long_path is not None, and returns this DataFrame.
 
     Inputs:
         is_analysis_label - True: use fund full history data to analysis and label the funds.
                             False: use per_fund_df[dy.[MONTH]:dy.TOTAL_DAYS] to build the model.
 
-        is_accuracy - True: means that the days we use to analysis in SCI and per fund must be the same.
+        is_accuracy - True: means that the days we use to analysis in SCI and per fund must be the same,
+                            each fund day is joined to the SCI day of the same date and the fund days
+                            that SCI does not have are dropped.
                     - False: means that the days do not need to be the same, but the number of days need to be equal.
                     Default is True
 
+        panel_path - the directory of a navpanel.NavPanelStore to read the fund history from,
+                     None reads the per fund csv files.
+
+        workers - the number of processes, the funds are split into shards that are
+                  read and computed in a process pool. The result is the same as workers = 1.
+
+        fund_symbols - only process these funds, e.g. the funds of one type.
+                       None processes all the funds in the history.
+
+        max_memory_mb - the memory budget of each process, the funds are read and computed in batches
+                        that fit in it and each batch is appended to the output file when it is done.
+                        None processes the funds of a process in one batch. The result is the same.
+
+        benchmarks - the names of dy.BENCHMARKS to compare the funds with besides SCI, e.g. ['hs300'].
+                     None is every benchmark whose file is in the processing data, see available_benchmarks.
+
 
     Returns: DataFrame
         symbol  - fund symbol
@@ -27,258 +53,583 @@ def process_fund_history_data(is_analysis_label, output_file_long_path, is_accur
         rate_of_rise_days - The percentage that this fund rise.
         rate_of_higher_than_sci - The percentage that this fund rise higher than Shanghai Composite Index.
         rate_of_rise_and_higher_than_sci - The percentage that this fund rise and higher than SCI.
+        rate_of_higher_than_<benchmark> - The percentage that this fund rise higher than each of benchmarks.
     '''
     # Process the fund daily data.
     file_short_path = r'.\data\processingdata\fund\historyinfo'
-    file_long_names = os.listdir(file_short_path)
-    print('Processing %s funds...' %(len(file_long_names)))
+    fund_histories = _FundHistoryLoader(file_short_path, panel_path, fields = ['change'])
+    if fund_symbols is None:
+        fund_symbols = fund_histories.symbols()
+    else:
+        fund_symbols_set = set(fund_symbols)
+        fund_symbols = [symbol for symbol in fund_histories.symbols() if symbol in fund_symbols_set]
+    print('Processing %s funds...' %(len(fund_symbols)))
 
     # Read Shanghai Composite Index data.
     sci_df_original = pd.read_csv(r'.\data\processingdata\fund\sh_index.csv', index_col = 'date')
 
-    skipped_funds = []
-    fund_df = pd.DataFrame()
-    fund_change_ave = []
-    fund_symbols_list = []
-    days_of_processed_list = []
-    rate_of_rise_days_list = []
-    rate_of_higher_than_sci_list = []
-    rate_of_rise_and_higher_than_sci_list = []
+    # The other benchmarks are compared in the same pass as SCI.
+    if benchmarks is None:
+        benchmarks = available_benchmarks()
+    benchmark_dfs = dict((name, pd.read_csv(benchmark_file(name), index_col = 'date')) for name in benchmarks)
+    print('Comparing the funds with SCI and %s other benchmarks %s' %(len(benchmark_dfs), list(benchmark_dfs.keys())))
+
+    bytes_per_day = WINDOW_BYTES_PER_DAY['history'] + BENCHMARK_BYTES_PER_DAY * len(benchmark_dfs)
+    batch_size = _memory_batch_size(max_memory_mb, fund_histories.bytes_per_fund(dy.TOTAL_DAYS, bytes_per_day),
+                                     fund_histories.mapped_bytes())
+
+    results = list()
+    for result in _iter_fund_shards(_process_history_shard, fund_symbols, workers, batch_size,
+                                    file_short_path, panel_path, sci_df_original, is_analysis_label, is_accuracy, benchmark_dfs):
+        if output_file_long_path is not None:
+            _append_to_csv(result[0], output_file_long_path, is_first = len(results) == 0)
+        results.append(result)
+
+    fund_df = pd.concat([result[0] for result in results])
+    dropped_days  = pd.concat([result[2] for result in results])
+
+    print('Dropped %d days that SCI does not have from %d funds' %(dropped_days.sum(), (dropped_days > 0).sum()))
+
+    # The skipped symbols are in the metrics of the run, only their number is printed.
+    skipped_funds = dict()
+    for result in results:
+        for fund_symbol, reason in result[1].items():
+            skipped_funds.setdefault(reason, list()).append(fund_symbol)
+    for reason, reason_symbols in skipped_funds.items():
+        metrics.METRICS.skip(reason, reason_symbols)
+        print('Skip %d funds: %s' %(len(reason_symbols), reason))
+
+    # if is_analysis_label:
+    #     output_file_long_path, = r'.\data\processingdata\mix_fund_hist_analysis_label.csv'
+    # else:
+    #     output_file_long_path, = r'.\data\processingdata\mix_fund_hist.csv'
+
+    if output_file_long_path is not None:
+        metrics.METRICS.add_written(output_file_long_path, len(fund_df), kind = 'features')
+        print('Saved %s funds to %s' %(len(fund_df), output_file_long_path,))
+
+    return fund_df
+
 
-    # file_name is 000001.csv
-    for file_name in file_long_names[:]:
-        fund_symbol = file_name.split('.')[0]
-        print('Processing fund %s ...' %(fund_symbol))
+def _process_history_shard(fund_symbols, file_short_path, panel_path, sci_df, is_analysis_label, is_accuracy, benchmark_dfs = None):
+    '''
+    Read the history of some funds and compute their features, it runs in the worker processes.
+    '''
+    fund_histories = _FundHistoryLoader(file_short_path, panel_path, symbols = fund_symbols, fields = ['change'])
+
+    # Only the latest dy.TOTAL_DAYS rows of each fund are used.
+    fund_symbols, fund_dates, fund_data, fund_lengths = fund_histories.latest_rows(dy.TOTAL_DAYS, ['change'])
+
+    return compute_history_features(fund_symbols, fund_dates, fund_data['change'], fund_lengths,
+                                    sci_df, is_analysis_label, is_accuracy, benchmark_dfs)
+
+
+def compute_history_features(fund_symbols, fund_dates, fund_change, fund_lengths, sci_df, is_analysis_label, is_accuracy = True,
+                             benchmark_dfs = None):
+    '''
+    Compute the rise ratios of all funds at once.
 
-        file_full_name = file_short_path + dy.sep + file_name
-        per_fund_df = pd.read_csv(file_full_name, index_col = 'date')
+    Every fund's change is put against the SCI p_change in one 2-D array of
+    funds x days, the latest day first, and the ratios are counted with NumPy
+    reductions instead of a loop per fund. The other benchmarks are stacked on
+    SCI in one 3-D array of benchmarks x funds x days, which is gathered and
+    compared once for all of them.
 
-        # Define how many days we will use to build our model.
+    Inputs:
+        fund_symbols - list of fund symbols.
+        fund_dates   - 2-D int64 array (funds x days), days since 1970-01-01, -1 after the last row.
+        fund_change  - 2-D float array (funds x days) of the fund change.
+        fund_lengths - number of rows of each fund, at most the number of days.
+        sci_df - the SCI DataFrame indexed by date, the latest day first.
+        is_analysis_label, is_accuracy - see process_fund_history_data.
+        benchmark_dfs - dict of benchmark name --> DataFrame like sci_df, default is none.
+                        They are joined to the days of SCI by date, a day that a benchmark
+                        does not have never counts as higher than it.
+
+    Returns: (fund_df, skipped_funds, dropped_days)
+        fund_df - the same DataFrame as process_fund_history_data returns.
+        skipped_funds - dict of the skipped fund symbols --> the reason, 'no_history_days'
+                        or 'too_few_training_days'.
+        dropped_days - Series of the number of fund days that SCI does not have, indexed by symbol.
+    '''
+    num_of_funds, end_day = fund_change.shape
+    days = np.arange(end_day)
+
+    sci_dates  = pd.to_datetime(sci_df.index).values.astype('datetime64[D]').astype(np.int64)
+    sci_change = sci_df['p_change'].values.astype(float)
+
+    # benchmarks x SCI days, SCI first.
+    benchmark_dfs = benchmark_dfs or {}
+    benchmark_change = np.vstack([sci_change] + [_benchmark_change(benchmark_df, sci_dates) for benchmark_df in benchmark_dfs.values()])
+
+    is_row = days[np.newaxis, :] < fund_lengths[:, np.newaxis]
+
+    # The index in SCI and fund is the date.
+    # is_accuracy is True means that the days in these two must be the same.
+    # is_accuracy is False means that the days do not need to be the same,
+    # but the number of days need to be equal.
+    if is_accuracy:
+        # Join each fund day to the SCI day of the same date, so the funds that lag behind SCI
+        # or miss some days keep all their other days. The fund days that SCI does not have are dropped.
+        sci_positions, is_aligned, dropped_days = alignment.CalendarAligner(sci_dates).align(fund_dates, fund_lengths)
+        aligned_change = np.where(is_aligned, benchmark_change[:, np.maximum(sci_positions, 0)], np.nan)
+
+        # The n-th aligned day of each fund, the latest day is 0.
+        aligned_days = np.cumsum(is_aligned, axis = 1) - 1
+        fund_lengths = is_aligned.sum(axis = 1)
+    else:
+        aligned_change = np.full((len(benchmark_change), end_day), np.nan)
+        num_of_sci_days = min(len(sci_change), end_day)
+        aligned_change[:, :num_of_sci_days] = benchmark_change[:, :num_of_sci_days]
+        aligned_change = aligned_change[:, np.newaxis, :]
+
+        is_aligned = is_row
+        aligned_days = np.broadcast_to(days, fund_change.shape)
+        dropped_days = np.zeros(num_of_funds, dtype = int)
+
+    # Skip the fund when there is no day left, but keep end_day as 1 to let the process
+    # going in the analysis case.
+    is_skipped = fund_lengths == 0
+    end_days = np.maximum(fund_lengths, 1)
+
+    if is_analysis_label:
         start_day = 0
-        end_day = dy.TOTAL_DAYS
-
-        # Some fund is newly set up and len(per_fund_df) is less than end_day.
-        if len(per_fund_df) < end_day:
-            print('***INFO: len(per_fund_df) = %s < %s' %(len(per_fund_df), end_day))
-            end_day = len(per_fund_df)
-            print('***INFO: end_day change to %s' %(end_day))
-
-        sci_df      = sci_df_original[:end_day]
-        per_fund_df = per_fund_df[:end_day]
-        # print('end_day = %s' %(end_day))
-        # print('len(sci_df.index) = %s' %(len(sci_df.index)))
-        # print('len(per_fund_df.index) = %s' %(len(per_fund_df.index)))
-
-        # The index in sci_d and per_fund_df is the date.
-        # is_accuracy is True means that the days in these two df must be the same.
-        # is_accuracy is False means that the days do not need to be the same, 
-        # but the number of days need to be equal.
-        if is_accuracy:
-            if (sci_df.index != per_fund_df.index).any():
-                print('***INFO: sci_df.index != per_fund_df.index')
-
-                # Most cases are that the per_fund_df data is one day latter than sci_df data,
-                # So move SCI one day back.
-                # For the case that the fund data is more latter than SCI data(more than one day), I don't deal with it right now,
-                # because the number of these cases is less than 10.
-                if sci_df.index[0] != per_fund_df.index[0] and len(sci_df.index) > 1 and sci_df.index[1] == per_fund_df.index[0]:
-                    sci_df = sci_df_original[1 : end_day + 1]
-
-                num = -1
-                for element in (sci_df.index != per_fund_df.index):
-                    num = num +1
-                    if (str(element) == 'True'):
-                        end_day = num
-
-                        sci_df       = sci_df[:end_day]
-                        per_fund_df  = per_fund_df[:end_day]
-                        print('***INFO: end_day change to %s' %(end_day))
-                        break
-
-            if end_day == 0:
-                print('!!!!!! Skip this fund because end_day == 0!!!!!!')
-
-                # Skip this fund, but I end_day to 1 here to let the process
-                # going. Then filter out these funds when save information to file.
-                end_day = 1
-                skipped_funds.append(fund_symbol)
-
-        if is_analysis_label:
-            pass
-        else:
-            # Collect data that is used for training model.
-            start_day = dy.TWO_MONTHS
-            if len(per_fund_df) <= start_day:
-                if fund_symbol not in skipped_funds:
-                    skipped_funds.append(fund_symbol)
-                continue
-            else:
-                per_fund_df = per_fund_df[start_day:]
-                sci_df = sci_df[start_day:]
-
-
-        rate_of_rise_days       = round(len(per_fund_df[per_fund_df.change > 0])/(end_day - start_day), 4)
-        rate_of_higher_than_sci = round(len(per_fund_df[per_fund_df.change > sci_df.p_change])/(end_day - start_day), 4)
-
-        temp_per_fund = per_fund_df[per_fund_df.change > 0]
-        temp_sci_df   = sci_df[per_fund_df.change > 0]
-        temp_per_fund = temp_per_fund[temp_per_fund.change > temp_sci_df.p_change]
-        rate_of_rise_and_higher_than_sci = round(len(temp_per_fund)/(end_day - start_day), 4)
-
-        fund_symbols_list.append(fund_symbol)
-        days_of_processed_list.append((end_day - start_day))
-        rate_of_rise_days_list.append(rate_of_rise_days)
-        rate_of_higher_than_sci_list.append(rate_of_higher_than_sci)
-        rate_of_rise_and_higher_than_sci_list.append(rate_of_rise_and_higher_than_sci)
-
-
-    fund_dict = {
-                    'symbol' : fund_symbols_list,
-                    'days_of_processed' : days_of_processed_list,
-                    'rate_of_rise_days' : rate_of_rise_days_list,
-                    'rate_of_higher_than_sci' : rate_of_higher_than_sci_list,
-                    'rate_of_rise_and_higher_than_sci' : rate_of_rise_and_higher_than_sci_list
-                }
-    fund_df = pd.DataFrame(fund_dict,
-                            columns = ['symbol',
-                                        'days_of_processed',
-                                        'rate_of_rise_days',
-                                        'rate_of_higher_than_sci',
-                                        'rate_of_rise_and_higher_than_sci']
-                            )
+        is_kept = np.ones(num_of_funds, dtype = bool)
+    else:
+        # Collect data that is used for training model.
+        start_day = dy.TWO_MONTHS
+        is_kept = fund_lengths > start_day
+        is_skipped = is_skipped | ~is_kept
+
+    is_used = is_aligned & (aligned_days >= start_day)
+    is_rise = is_used & (fund_change > 0)
+    is_higher = is_used & (fund_change > aligned_change)
+
+    # The skipped funds in the training case have no day to divide, they are dropped below.
+    days_of_processed = end_days - start_day
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        rate_of_rise_days = is_rise.sum(axis = 1) / days_of_processed
+        rates_of_higher = is_higher.sum(axis = 2) / days_of_processed
+        rate_of_higher_than_sci = rates_of_higher[0]
+        rate_of_rise_and_higher_than_sci = (is_rise & is_higher[0]).sum(axis = 1) / days_of_processed
+
+    fund_symbols = np.asarray(fund_symbols)
+    fund_df = pd.DataFrame({
+                    'symbol' : fund_symbols[is_kept],
+                    'days_of_processed' : days_of_processed[is_kept],
+                    'rate_of_rise_days' : [round(rate, 4) for rate in rate_of_rise_days[is_kept].tolist()],
+                    'rate_of_higher_than_sci' : [round(rate, 4) for rate in rate_of_higher_than_sci[is_kept].tolist()],
+                    'rate_of_rise_and_higher_than_sci' : [round(rate, 4) for rate in rate_of_rise_and_higher_than_sci[is_kept].tolist()]
+                },
+                columns = ['symbol',
+                           'days_of_processed',
+                           'rate_of_rise_days',
+                           'rate_of_higher_than_sci',
+                           'rate_of_rise_and_higher_than_sci']
+                )
 
     fund_df = fund_df.set_index('symbol')
 
-    print('Skip %d funds are:\n %s' %(len(skipped_funds), skipped_funds))
+    # The other benchmarks after the columns of SCI.
+    for name, rate_of_higher in zip(benchmark_dfs.keys(), rates_of_higher[1:]):
+        fund_df[benchmark_column_name(name)] = [round(rate, 4) for rate in rate_of_higher[is_kept].tolist()]
 
-    # if is_analysis_label:
-    #     output_file_long_path, = r'.\data\processingdata\mix_fund_hist_analysis_label.csv'
-    # else:
-    #     output_file_long_path, = r'.\data\processingdata\mix_fund_hist.csv'
+    dropped_days = pd.Series(dropped_days, index = pd.Index(fund_symbols, name = 'symbol'), name = 'dropped_days')
 
-    print('Saving %s funds to %s' %(len(fund_df), output_file_long_path,))
-    fund_df.to_csv(output_file_long_path, encoding = 'utf-8')
+    reasons = np.where(fund_lengths == 0, 'no_history_days', 'too_few_training_days')
+    skipped_funds = dict(zip(fund_symbols[is_skipped].tolist(), reasons[is_skipped].tolist()))
+
+    return fund_df, skipped_funds, dropped_days
+
+
+def benchmark_column_name(name):
+    '''
+    Returns the column of the rate of the days that a fund rises higher than the benchmark name,
+    e.g. rate_of_higher_than_hs300.
+    '''
+    return 'rate_of_higher_than_%s' %(name)
+
+
+def benchmark_file(name):
+    '''
+    Returns the processing data file of the benchmark name of dy.BENCHMARKS.
+    '''
+    return r'.\data\processingdata\fund\%s' %(dy.BENCHMARK_FILE %(dy.BENCHMARKS[name]))
+
+
+def available_benchmarks():
+    '''
+    Returns the names of dy.BENCHMARKS other than SCI whose file is in the processing data.
+    '''
+    return [name for name in dy.BENCHMARKS if name != 'sci' and os.path.exists(benchmark_file(name))]
 
-    return fund_df
+
+def _benchmark_change(benchmark_df, dates):
+    '''
+    Returns the p_change of benchmark_df on each of dates (days since 1970-01-01), NaN on the days it does not have.
+    '''
+    benchmark_dates = pd.to_datetime(benchmark_df.index).values.astype('datetime64[D]').astype(np.int64)
+    positions = alignment.CalendarAligner(benchmark_dates).positions(dates)
+
+    return np.where(positions >= 0, benchmark_df['p_change'].values.astype(float)[np.maximum(positions, 0)], np.nan)
 
 
-def AddIncreaseAttributes(file_long_path):
+def AddIncreaseAttributes(file_long_path, panel_path = None, horizons = None, workers = 1, max_memory_mb = None):
     '''
     Add the increase of several months in the input file.
 
     Inputs:
         file_long_path - file that contains the information of fund and will be added
                          in Increasement of fund.
+        panel_path - the directory of a navpanel.NavPanelStore to read the fund history from,
+                     None reads the per fund csv files.
+        horizons - list of the number of days, default is dy.INCREASE_HORIZONS (one to six months).
+        workers, max_memory_mb - see process_fund_history_data.
     '''
-    print('Calculating the amount of increase...')
-    days_list = [dy.ONE_MONTH, dy.TWO_MONTHS, dy.THREE_MONTHS, dy.FOUR_MONTHS, dy.FIVE_MONTHS, dy.SIX_MONTHS]
-    
     # file_long_path = r'.\data\processingdata\mix_fund_hist.csv'
     fund_df = pd.read_csv(file_long_path, encoding = 'utf-8', dtype = {'symbol' : str})
     fund_df = fund_df.set_index('symbol')
 
+    fund_df = add_increase_attributes(fund_df, panel_path = panel_path, horizons = horizons, workers = workers,
+                                      max_memory_mb = max_memory_mb, output_file_long_path = file_long_path)
+    print('Save to file %s' %(file_long_path))
+
+    return fund_df
+
+
+def add_increase_attributes(fund_df, panel_path = None, horizons = None, workers = 1, max_memory_mb = None,
+                            output_file_long_path = None):
+    '''
+    Returns a copy of fund_df with the increase columns of the funds in its index,
+    see AddIncreaseAttributes. The result is also saved to output_file_long_path batch by batch, if it is not None.
+    '''
+    print('Calculating the amount of increase...')
+    if horizons is None:
+        horizons = dy.INCREASE_HORIZONS
+
     file_short_path = r'.\data\processingdata\fund\historyinfo'
-    for fund_symbol in fund_df.index.values[:]:
-        print('Calculating fund %s increasement...' %(fund_symbol))
+    fund_histories = _FundHistoryLoader(file_short_path, panel_path, fields = ['total'])
+    batch_size = _memory_batch_size(max_memory_mb, fund_histories.bytes_per_fund(max(horizons), WINDOW_BYTES_PER_DAY['increase']),
+                                     fund_histories.mapped_bytes())
+
+    return _add_shard_columns(fund_df, _iter_fund_shards(_process_increase_shard, list(fund_df.index.values), workers, batch_size,
+                                                         file_short_path, panel_path, horizons),
+                              output_file_long_path)
+
+
+def _process_increase_shard(fund_symbols, file_short_path, panel_path, horizons):
+    '''
+    Read the history of some funds and compute their increases, it runs in the worker processes.
+    '''
+    fund_histories = _FundHistoryLoader(file_short_path, panel_path, symbols = fund_symbols, fields = ['total'])
+    fund_symbols, _, fund_data, fund_lengths = fund_histories.latest_rows(max(horizons), ['total'])
+
+    return compute_increases(fund_symbols, fund_data['total'], fund_lengths, horizons)
+
+
+def increase_column_name(days):
+    '''
+    Returns the column name of the increase in the past days, e.g. increase_of_one_month.
+    '''
+    return dy.INCREASE_COLUMNS.get(days, 'increase_of_%d_days' %(days))
+
+
+def compute_increases(fund_symbols, fund_totals, fund_lengths, horizons):
+    '''
+    Compute the increase of every fund in every horizon in one vectorized operation.
 
-        fund_long_path = file_short_path + dy.sep  + str(fund_symbol) + '.csv'
-        per_fund_df = pd.read_csv(fund_long_path)
+    The increase in the past h days is (total of the latest day - total of the h-th day) / total of the h-th day,
+    it is NaN if the fund has less than h days.
 
-        increase_of_one_month    = None
-        increase_of_two_months   = None
-        increase_of_three_months = None
-        increase_of_four_months  = None
-        increase_of_five_months  = None
-        increase_of_six_months   = None
+    Inputs:
+        fund_symbols - list of fund symbols.
+        fund_totals  - 2-D float array (funds x days) of the fund total, the latest day first.
+        fund_lengths - number of rows of each fund.
+        horizons     - list of the number of days.
+
+    Returns: DataFrame indexed by symbol, one column per horizon, see increase_column_name.
+    '''
+    horizons = np.asarray(horizons, dtype = int)
 
-        if len(per_fund_df.index) >= days_list[5]:
-            increase_of_six_months = round((per_fund_df.iloc[0].total - per_fund_df.iloc[days_list[5]-1].total) / per_fund_df.iloc[days_list[5]-1].total, 4)
+    latest_totals = fund_totals[:, :1]
+    past_totals   = fund_totals[:, horizons - 1]
 
-        if len(per_fund_df.index) >= days_list[4]:
-            increase_of_five_months = round((per_fund_df.iloc[0].total - per_fund_df.iloc[days_list[4]-1].total) / per_fund_df.iloc[days_list[4]-1].total, 4)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        increases = np.round((latest_totals - past_totals) / past_totals, 4)
 
-        if len(per_fund_df.index) >= days_list[3]:
-            increase_of_four_months = round((per_fund_df.iloc[0].total - per_fund_df.iloc[days_list[3]-1].total) / per_fund_df.iloc[days_list[3]-1].total, 4)
+    increases[np.asarray(fund_lengths)[:, np.newaxis] < horizons[np.newaxis, :]] = np.nan
 
-        if len(per_fund_df.index) >= days_list[2]:
-            increase_of_three_months = round((per_fund_df.iloc[0].total - per_fund_df.iloc[days_list[2]-1].total) / per_fund_df.iloc[days_list[2]-1].total, 4)
+    return pd.DataFrame(increases,
+                        index = pd.Index(fund_symbols, name = 'symbol'),
+                        columns = [increase_column_name(days) for days in horizons])
 
-        if len(per_fund_df.index) >= days_list[1]:
-            increase_of_two_months = round((per_fund_df.iloc[0].total - per_fund_df.iloc[days_list[1]-1].total) / per_fund_df.iloc[days_list[1]-1].total, 4)
 
-        if len(per_fund_df.index) >= days_list[0]:
-            increase_of_one_month = round((per_fund_df.iloc[0].total - per_fund_df.iloc[days_list[0]-1].total) / per_fund_df.iloc[days_list[0]-1].total, 4)
+def AddRiskAttributes(file_long_path, panel_path = None, horizons = None, offset = 0, workers = 1):
+    '''
+    Add the risk and return attributes of several months in the input file,
+    run it on the history file before MergeFundData to merge them with the basic data.
+
+    Inputs:
+        file_long_path - file that contains the information of fund and will be added
+                         in the risk attributes of fund.
+        panel_path - the directory of a navpanel.NavPanelStore to read the fund history from,
+                     None reads the per fund csv files.
+        horizons - list of the number of days, default is dy.RISK_HORIZONS.
+        offset - the number of the latest days that are not used, e.g. dy.TWO_MONTHS for the training data.
+        workers - the number of processes, see process_fund_history_data.
+    '''
+    fund_df = pd.read_csv(file_long_path, encoding = 'utf-8', dtype = {'symbol' : str})
+    fund_df = fund_df.set_index('symbol')
 
-        fund_df.loc[fund_symbol, 'increase_of_one_month']    = increase_of_one_month
-        fund_df.loc[fund_symbol, 'increase_of_two_months']   = increase_of_two_months
-        fund_df.loc[fund_symbol, 'increase_of_three_months'] = increase_of_three_months
-        fund_df.loc[fund_symbol, 'increase_of_four_months']  = increase_of_four_months
-        fund_df.loc[fund_symbol, 'increase_of_five_months']  = increase_of_five_months
-        fund_df.loc[fund_symbol, 'increase_of_six_months']   = increase_of_six_months
+    fund_df = add_risk_attributes(fund_df, panel_path = panel_path, horizons = horizons, offset = offset, workers = workers)
 
-    fund_df.to_csv(file_long_path, index_col = 'symbol', encoding = 'utf-8')
+    fund_df.to_csv(file_long_path, encoding = 'utf-8')
     print('Save to file %s' %(file_long_path))
 
+    return fund_df
 
-def GenerateLabelFundsToFiles(file_long_path):
+
+def add_risk_attributes(fund_df, panel_path = None, horizons = None, offset = 0, workers = 1, max_memory_mb = None):
+    '''
+    Returns a copy of fund_df with the risk columns of the funds in its index,
+    see AddRiskAttributes and compute_risk_features. max_memory_mb, see process_fund_history_data.
+    '''
+    print('Calculating the risk attributes...')
+    if horizons is None:
+        horizons = dy.RISK_HORIZONS
+
+    file_short_path = r'.\data\processingdata\fund\historyinfo'
+    sci_df = pd.read_csv(r'.\data\processingdata\fund\sh_index.csv', index_col = 'date')
+    fund_histories = _FundHistoryLoader(file_short_path, panel_path, fields = ['change', 'total'])
+    batch_size = _memory_batch_size(max_memory_mb, fund_histories.bytes_per_fund(offset + max(horizons), WINDOW_BYTES_PER_DAY['risk']),
+                                     fund_histories.mapped_bytes())
+
+    return _add_shard_columns(fund_df, _iter_fund_shards(_process_risk_shard, list(fund_df.index.values), workers, batch_size,
+                                                         file_short_path, panel_path, sci_df, horizons, offset))
+
+
+def _process_risk_shard(fund_symbols, file_short_path, panel_path, sci_df, horizons, offset):
+    '''
+    Read the history of some funds and compute their risk attributes, it runs in the worker processes.
+    '''
+    fund_histories = _FundHistoryLoader(file_short_path, panel_path, symbols = fund_symbols, fields = ['change', 'total'])
+    fund_symbols, fund_dates, fund_data, fund_lengths = fund_histories.latest_rows(offset + max(horizons), ['change', 'total'])
+
+    return compute_risk_features(fund_symbols, fund_dates, fund_data['change'], fund_data['total'], fund_lengths,
+                                 sci_df, horizons, offset)
+
+
+# The risk attributes that compute_risk_features adds for every horizon.
+RISK_FEATURES = ['volatility', 'max_drawdown', 'sharpe_ratio', 'sortino_ratio', 'beta', 'alpha', 'up_capture', 'down_capture']
+
+
+def risk_column_name(feature, days):
+    '''
+    Returns the column name of a risk attribute in the past days, e.g. volatility_of_one_month.
+    '''
+    return feature + increase_column_name(days)[len('increase'):]
+
+
+def compute_risk_features(fund_symbols, fund_dates, fund_change, fund_total, fund_lengths, sci_df, horizons,
+                          offset = 0, risk_free_rate = 0.0):
+    '''
+    Compute the risk and return attributes of every fund in every horizon at once.
+
+    The window of horizon h is the latest h days of the fund after skipping offset days.
+    The sums of every window are read from cumulative sums along the days, so all the
+    funds and all the horizons take a few passes over the funds x days arrays, only the
+    drawdown needs one running maximum per horizon. The fund days are joined to the SCI
+    days of the same date for beta, alpha and the capture ratios.
+
+        volatility    - annualized standard deviation of the daily return.
+        max_drawdown  - the largest fall of total from its previous highest value, e.g. 0.2 is 20%.
+        sharpe_ratio  - annualized mean excess return / standard deviation.
+        sortino_ratio - annualized mean excess return / downside deviation.
+        beta          - covariance with the SCI return / variance of the SCI return.
+        alpha         - annualized mean return - beta * mean SCI return.
+        up_capture    - mean return / mean SCI return on the days that SCI rises.
+        down_capture  - mean return / mean SCI return on the days that SCI falls.
+
+    Inputs:
+        fund_symbols - list of fund symbols.
+        fund_dates   - 2-D int64 array (funds x days), days since 1970-01-01, -1 after the last row.
+        fund_change  - 2-D float array (funds x days) of the fund change in percent, the latest day first.
+        fund_total   - 2-D float array (funds x days) of the fund total.
+        fund_lengths - number of rows of each fund.
+        sci_df - the SCI DataFrame indexed by date.
+        horizons - list of the number of days.
+        offset - the number of the latest days that are skipped.
+        risk_free_rate - the annual risk free rate, e.g. 0.03.
+
+    Returns: DataFrame indexed by symbol, one column per feature and horizon, see risk_column_name.
+             The attributes are NaN if the fund has less than h days.
+    '''
+    horizons = np.asarray(horizons, dtype = int)
+    num_of_days = offset + horizons.max()
+
+    fund_change = fund_change[:, offset:num_of_days]
+    fund_total  = fund_total[:, offset:num_of_days]
+    fund_dates  = fund_dates[:, offset:num_of_days]
+    fund_lengths = np.maximum(np.asarray(fund_lengths) - offset, 0)
+
+    sci_dates  = pd.to_datetime(sci_df.index).values.astype('datetime64[D]').astype(np.int64)
+    sci_change = sci_df['p_change'].values.astype(float)
+    sci_positions = alignment.CalendarAligner(sci_dates).positions(fund_dates)
+
+    is_row = np.arange(fund_change.shape[1])[np.newaxis, :] < fund_lengths[:, np.newaxis]
+    fund_return = fund_change / 100.0
+    sci_return = np.where(sci_positions >= 0, sci_change[np.maximum(sci_positions, 0)] / 100.0, np.nan)
+    excess_return = fund_return - risk_free_rate / dy.DAYS_OF_YEAR
+
+    is_valid = is_row & ~np.isnan(fund_return)
+    is_joined = is_valid & ~np.isnan(sci_return)
+    is_up = is_joined & (sci_return > 0)
+    is_down = is_joined & (sci_return < 0)
+
+    def window_sums(values, mask):
+        # Column h - 1 of the cumulative sum is the sum of the latest h days.
+        return np.cumsum(np.where(mask, values, 0.0), axis = 1)[:, horizons - 1]
+
+    n = window_sums(1.0, is_valid)
+    sum_r = window_sums(fund_return, is_valid)
+    sum_r2 = window_sums(fund_return * fund_return, is_valid)
+    sum_excess = window_sums(excess_return, is_valid)
+    sum_downside2 = window_sums(np.minimum(excess_return, 0.0) ** 2, is_valid)
+
+    n_joined = window_sums(1.0, is_joined)
+    sum_r_joined = window_sums(fund_return, is_joined)
+    sum_m_joined = window_sums(sci_return, is_joined)
+    sum_rm = window_sums(fund_return * sci_return, is_joined)
+    sum_m2 = window_sums(sci_return * sci_return, is_joined)
+
+    # The maximum drawdown of each horizon, the window is put in date order for the running maximum.
+    max_drawdown = np.full((len(fund_lengths), len(horizons)), np.nan)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        for i, days in enumerate(horizons):
+            totals = np.where(is_row[:, :days], fund_total[:, :days], np.nan)[:, ::-1]
+            running_max = np.fmax.accumulate(totals, axis = 1)
+            drawdowns = np.where(np.isnan(totals), -np.inf, 1 - totals / running_max)
+            max_drawdown[:, i] = drawdowns.max(axis = 1)
+
+        mean_r = sum_r / n
+        std_r = np.sqrt(np.maximum(sum_r2 - n * mean_r * mean_r, 0.0) / (n - 1))
+        downside_std = np.sqrt(sum_downside2 / n)
+
+        cov_rm = (sum_rm - sum_r_joined * sum_m_joined / n_joined) / (n_joined - 1)
+        var_m = (sum_m2 - sum_m_joined * sum_m_joined / n_joined) / (n_joined - 1)
+        beta = cov_rm / var_m
+
+        features = {
+                    'volatility'    : std_r * np.sqrt(dy.DAYS_OF_YEAR),
+                    'max_drawdown'  : max_drawdown,
+                    'sharpe_ratio'  : sum_excess / n / std_r * np.sqrt(dy.DAYS_OF_YEAR),
+                    'sortino_ratio' : sum_excess / n / downside_std * np.sqrt(dy.DAYS_OF_YEAR),
+                    'beta'          : beta,
+                    'alpha'         : (sum_r_joined - beta * sum_m_joined) / n_joined * dy.DAYS_OF_YEAR,
+                    'up_capture'    : window_sums(fund_return, is_up) / window_sums(sci_return, is_up),
+                    'down_capture'  : window_sums(fund_return, is_down) / window_sums(sci_return, is_down)
+                   }
+
+    is_short = fund_lengths[:, np.newaxis] < horizons[np.newaxis, :]
+
+    columns = dict()
+    for feature in RISK_FEATURES:
+        values = np.round(features[feature], 4)
+        values[is_short | ~np.isfinite(values)] = np.nan
+        for i, days in enumerate(horizons):
+            columns[risk_column_name(feature, days)] = values[:, i]
+
+    return pd.DataFrame(columns, index = pd.Index(fund_symbols, name = 'symbol'),
+                        columns = [risk_column_name(feature, days) for feature in RISK_FEATURES for days in horizons])
+
+
+def GenerateLabelFundsToFiles(file_long_path, fund_type = 'mix'):
     '''
     Choose which funds we can give a label and then save them to file.
 
     Inputs:
         file_long_path - file that contains the funds data.
+        fund_type - the fund type in the names of the label files.
     '''
     # file_long_path = r'.\data\processingdata\mix_fund_hist_analysis_label.csv'
     fund_df = pd.read_csv(file_long_path, encoding = 'utf-8', dtype = {'symbol' : str}).set_index('symbol')
     print('Read %s' %(file_long_path))
+
+    label_funds = select_label_funds(fund_df)
+
+    for label_name, fund_df_tmp in label_funds.items():
+        labeled_fund_file = LABEL_FILES[label_name] %(fund_type)
+        fund_df_tmp.to_csv(labeled_fund_file, encoding = 'utf-8')
+        print('Saved %s with labels' %(labeled_fund_file))
+
+
+# The file that GenerateLabelFundsToFiles saves the funds of each label to, %s is the fund type.
+LABEL_FILES = {
+                'label_past_one_and_two_month' : r'.\data\processingdata\%s_fund_label_past_one_and_two_month.csv',
+                'label_past_one_month_only'    : r'.\data\processingdata\%s_fund_label_past_one_month_only.csv'
+              }
+
+
+def select_label_funds(fund_df, num_of_candidates = 100, min_days_of_processed = 100,
+                       max_increase_of_one_month = 0.3, max_increase_of_three_months = 0.5):
+    '''
+    Choose which funds we can give a label.
+
+    Inputs:
+        fund_df - DataFrame of the funds with the increase attributes.
+        num_of_candidates - the funds that rank in the top num_of_candidates are labeled.
+        min_days_of_processed, max_increase_of_one_month, max_increase_of_three_months - the funds
+                              out of these limits are dropped as outlier.
+
+    Returns: dict of label name --> DataFrame of the labeled funds.
+    '''
     print('Total funds %s' %(len(fund_df)))
 
     # del fund_df['label_past_one_and_two_month']
 
     # Drop the outlier data.
-    fund_df = fund_df[fund_df.days_of_processed > 100]
-    fund_df = fund_df[fund_df.increase_of_one_month < 0.3]
-    fund_df = fund_df[fund_df.increase_of_three_months < 0.5]
+    is_kept = ((fund_df.days_of_processed > min_days_of_processed) &
+               (fund_df.increase_of_one_month < max_increase_of_one_month) &
+               (fund_df.increase_of_three_months < max_increase_of_three_months)).values
 
-    print('Process %s funds' %(len(fund_df)))
+    print('Process %s funds' %(is_kept.sum()))
 
-    # Choose the candidates that will be labeled.
-    num_of_candidates = 100
+    label_funds = dict()
 
-    fund_df_tmp = fund_df.sort_values(by = 'increase_of_two_months', ascending = False)
-    cutting_value_of_two_months = fund_df_tmp.iloc[num_of_candidates]['increase_of_two_months']
+    # Choose the candidates that will be labeled.
+    # The cutting values of both months are found in one partial selection, not two full sorts.
+    rank = ranking.Ranking(fund_df, ['increase_of_one_month', 'increase_of_two_months'], mask = is_kept)
+    cutting_values = rank.cutoffs(num_of_candidates)
+    cutting_value_of_one_month  = cutting_values['increase_of_one_month']
+    cutting_value_of_two_months = cutting_values['increase_of_two_months']
     print('The increasement of the %sth fund in past two months is %s' %(num_of_candidates, cutting_value_of_two_months))
-
-    fund_df_tmp = fund_df.sort_values(by = 'increase_of_one_month', ascending = False)
-    cutting_value_of_one_month = fund_df_tmp.iloc[num_of_candidates]['increase_of_one_month']
     print('The increasement of the %sth fund in past one month is %s' %(num_of_candidates, cutting_value_of_one_month))
 
     # Filter criteria.
-    fund_df_tmp = fund_df_tmp[fund_df_tmp.increase_of_one_month > cutting_value_of_one_month]
-    print('Top %s funds in past one month is %s' %(num_of_candidates, len(fund_df_tmp)))
-    fund_df_tmp = fund_df_tmp[fund_df_tmp.increase_of_two_months > cutting_value_of_two_months]
-    print('Top %s funds in past one AND two month is %s' %(num_of_candidates, len(fund_df_tmp)))
-    fund_df_tmp = fund_df_tmp[fund_df_tmp.increase_of_two_months > fund_df_tmp.increase_of_one_month * 1.0]
-    print('Top %s funds in past one AND two month and increase_of_two_months > increase_of_one_month*0.8 is %s' %(num_of_candidates, len(fund_df_tmp)))
-
+    top_funds = rank.top(num_of_candidates)
+    is_labeled = top_funds['increase_of_one_month']
+    print('Top %s funds in past one month is %s' %(num_of_candidates, is_labeled.sum()))
+    is_labeled = is_labeled & top_funds['increase_of_two_months']
+    print('Top %s funds in past one AND two month is %s' %(num_of_candidates, is_labeled.sum()))
+    is_labeled = is_labeled & (fund_df.increase_of_two_months > fund_df.increase_of_one_month * 1.0).values
+    print('Top %s funds in past one AND two month and increase_of_two_months > increase_of_one_month*0.8 is %s' %(num_of_candidates, is_labeled.sum()))
+
+    fund_df_tmp = rank.select(is_labeled, by = 'increase_of_one_month')
     print('Label %d funds: %s' %(len(fund_df_tmp), fund_df_tmp.index.values))
-    labeled_fund_file = r'.\data\processingdata\mix_fund_label_past_one_and_two_month.csv'
-    fund_df_tmp.to_csv(labeled_fund_file, encoding = 'utf-8', index_col = 'symbol')
-    print('Saved %s with labels' %(labeled_fund_file))
+    label_funds['label_past_one_and_two_month'] = fund_df_tmp
 
     #------------------------------------------------------------------------#
-    fund_df_tmp = fund_df.sort_values(by = 'increase_of_one_month', ascending = False)
-    cutting_value_of_one_month = fund_df_tmp.iloc[num_of_candidates]['increase_of_one_month']
     print('The increasement of the %sth fund in past one month is %s' %(num_of_candidates, cutting_value_of_one_month))
 
     # Filter criteria.
-    fund_df_tmp = fund_df_tmp[fund_df_tmp.increase_of_one_month > cutting_value_of_one_month] 
+    fund_df_tmp = rank.select(top_funds['increase_of_one_month'], by = 'increase_of_one_month')
     # fund_df_tmp = fund_df_tmp[fund_df_tmp.increase_of_two_months > cutting_value_of_two_months]
     # fund_df_tmp = fund_df_tmp[fund_df_tmp.increase_of_two_months > fund_df_tmp.increase_of_one_month * 0.8]
 
     print('Label %d funds: %s' %(len(fund_df_tmp), fund_df_tmp.index.values))
-    labeled_fund_file = r'.\data\processingdata\mix_fund_label_past_one_month_only.csv'
-    fund_df_tmp.to_csv(labeled_fund_file, encoding = 'utf-8', index_col = 'symbol')
-    print('Saved %s with labels' %(labeled_fund_file))
+    label_funds['label_past_one_month_only'] = fund_df_tmp
+
+    return label_funds
 
 
 def AddLabelAttributes(file_long_path, label_file_long_path, label_name):
@@ -293,17 +644,48 @@ def AddLabelAttributes(file_long_path, label_file_long_path, label_name):
     print('Read %s' %(label_file_long_path))
     print('Total labeled funds %s' %(len(label_fund_df)))
 
-    for fund_symbol in label_fund_df.index.values:
-        (fund_df.loc[fund_symbol, label_name]) = 1
+    fund_df = add_label_attributes(fund_df, label_fund_df, label_name)
+
+    fund_df.to_csv(file_long_path, encoding = 'utf-8')
+    print('Saved %s with labels' %(file_long_path))
+
+
+def add_label_attributes(fund_df, label_fund_df, label_name):
+    '''
+    Returns a copy of fund_df with the column label_name,
+    1 for the funds in label_fund_df and 0 for the others.
+    '''
+    fund_df = fund_df.copy()
+    fund_df[label_name] = fund_df.index.isin(label_fund_df.index).astype(int)
+
+    return fund_df
+
+
+def AddLabels(file_long_path, label_rules = None):
+    '''
+    Add all the label columns of label_rules to a file in one pass, no label file is read.
+
+    Inputs:
+        file_long_path - the funds with the feature columns, it is saved with the labels.
+        label_rules - (universe, rules) of labelengine, default is labelengine.default_label_rules().
+    '''
+    fund_df = pd.read_csv(file_long_path, encoding = 'utf-8', dtype = {'symbol' : str}).set_index('symbol')
+    print('Read %s' %(file_long_path))
+    print('Total funds %s' %(len(fund_df)))
 
-    fund_df[label_name].fillna(0, inplace = True)
-    fund_df[label_name] = fund_df[label_name].astype(int)
+    label_universe, rules = labelengine.default_label_rules() if label_rules is None else label_rules
+    fund_df = labelengine.add_labels(fund_df, rules, label_universe)
+    for rule in rules:
+        print('%s funds with %s' %(fund_df[rule['name']].sum(), rule['name']))
 
-    fund_df.to_csv(file_long_path, encoding = 'utf-8', index_col = 'symbol')
+    fund_df.to_csv(file_long_path, encoding = 'utf-8')
     print('Saved %s with labels' %(file_long_path))
 
 
-def MakeTopFundsPlot(file_long_path):
+def MakeTopFundsPlot(file_long_path, fund_type = 'mix'):
+    # matplotlib is slow to import, only the plot needs it.
+    import matplotlib.pyplot as plt
+
     fund_df = pd.read_csv(file_long_path, encoding = 'utf-8', dtype = {'symbol' : str}).set_index('symbol')
 
     # Drop the outlier data.
@@ -314,38 +696,24 @@ def MakeTopFundsPlot(file_long_path):
     print('Proccess %s funds.' %(len(fund_df)))
 
     top_num = 50
-    fund_df_tmp1 = fund_df.sort_values(by = 'increase_of_one_month', ascending = False)[:top_num]
-    _makeSubplot(plot_loc = 231, fund_df = fund_df_tmp1, months = 1)
-
-    fund_df_tmp2 = fund_df.sort_values(by = 'increase_of_two_months', ascending = False)[:top_num]
-    _makeSubplot(plot_loc = 232, fund_df = fund_df_tmp2, months = 2)
-
-    fund_df_tmp3 = fund_df.sort_values(by = 'increase_of_three_months', ascending = False)[:top_num]
-    _makeSubplot(plot_loc = 233, fund_df = fund_df_tmp3, months = 3)
-
-    fund_df_tmp4 = fund_df.sort_values(by = 'increase_of_four_months', ascending = False)[:top_num]
-    _makeSubplot(plot_loc = 234, fund_df = fund_df_tmp4, months = 4)
+    rank = ranking.Ranking(fund_df, [increase_column_name(days) for days in dy.INCREASE_HORIZONS])
 
-    fund_df_tmp5 = fund_df.sort_values(by = 'increase_of_five_months', ascending = False)[:top_num]
-    _makeSubplot(plot_loc = 235, fund_df = fund_df_tmp5, months = 5)
+    # Only the top_num funds of each month are selected and sorted, not the whole frame.
+    top_positions = list()
+    for months, column in enumerate(rank.columns, start = 1):
+        top_positions.append(rank.top_positions(column, top_num))
+        _makeSubplot(plot_loc = 230 + months, fund_df = fund_df.iloc[top_positions[-1]], months = months)
 
-    fund_df_tmp6 = fund_df.sort_values(by = 'increase_of_six_months', ascending = False)[:top_num]
-    _makeSubplot(plot_loc = 236, fund_df = fund_df_tmp6, months = 6)
 
 
 
+    fund_basic = pd.read_csv('./data/processingdata/fund/%s_fund_basic.csv' %(fund_type), encoding='utf-8', dtype={'symbol' : str}).set_index('symbol')
 
-    fund_basic = pd.read_csv('./data/processingdata/fund/mix_fund_basic.csv', encoding='utf-8', dtype={'symbol' : str}).set_index('symbol')
+    # In the top of the past one, two and three months, and the fund scale is larger than 5.
+    is_target = rank.top_mask(rank.columns[0], top_num) & rank.top_mask(rank.columns[1], top_num) & rank.top_mask(rank.columns[2], top_num)
+    is_target &= (fund_basic['fund_scale'].reindex(fund_df.index) > 5).values
 
-    symbols1 = fund_df_tmp1.index.values
-    symbols2 = fund_df_tmp2.index.values
-    symbols3 = fund_df_tmp3.index.values
-
-    targets = list()
-    for symbol in symbols1:
-        if symbol in symbols2 and symbol in symbols3:
-            if fund_basic.loc[symbol, 'fund_scale'] > 5:
-                targets.append(symbol)
+    targets = list(fund_df.index.values[top_positions[0][is_target[top_positions[0]]]])
 
 
     print("targets: {}".format(targets))
@@ -356,6 +724,8 @@ def MakeTopFundsPlot(file_long_path):
 
 
 def _makeSubplot(plot_loc, fund_df, months = ''):
+    import matplotlib.pyplot as plt
+
     plt.subplot(plot_loc)
 
     x_axis = [1, 2 ,3 ,4 ,5, 6]
@@ -381,55 +751,315 @@ def MergeFundData(file_long_path_hist, file_long_path_basic, output_file_long_pa
     fund_df_hist  = pd.read_csv(file_long_path_hist, encoding = 'utf-8', dtype = {'symbol' : str}).set_index('symbol')
     print('There are %s funds in %s' %(len(fund_df_hist), file_long_path_hist))
 
+    fund_df = merge_fund_data(fund_df_hist, file_long_path_basic)
+
+    # file_long_path = r'.\data\processingdata\mix_fund_merged.csv'
+    fund_df.to_csv(output_file_long_path, encoding = 'utf-8')
+    metrics.METRICS.add_written(output_file_long_path, len(fund_df), kind = 'features')
+    print('Saved merged %s funds to %s' %(len(fund_df), output_file_long_path))
+
+
+def merge_fund_data(fund_df_hist, file_long_path_basic):
+    '''
+    Returns the funds in fund_df_hist merged with their basic information.
+    '''
     # file_long_path_basic = r'.\data\processingdata\mixfund_basic.csv'
     fund_df_basic = pd.read_csv(file_long_path_basic, encoding = 'utf-8', dtype = {'symbol' : str}).set_index('symbol')
     print('There are %s funds in %s' %(len(fund_df_basic), file_long_path_basic))
 
-    fund_df = pd.merge(fund_df_hist, fund_df_basic, left_index = True, right_index = True, how = 'inner')
+    return pd.merge(fund_df_hist, fund_df_basic, left_index = True, right_index = True, how = 'inner')
 
-    # file_long_path = r'.\data\processingdata\mix_fund_merged.csv'
-    fund_df.to_csv(output_file_long_path, index_col = 'symbol', encoding = 'utf-8')
-    print('Saved merged %s funds to %s' %(len(fund_df), output_file_long_path))
 
-def GenerateLatestData():
+# The directory that the output of each stage is cached in.
+STAGE_CACHE_PATH = r'.\data\processingdata\cache'
+
+# The types of each fund that main.py saves with the fetched data.
+FUND_TYPES_FILE = r'.\data\processingdata\fund\fund_types.csv'
+
+
+def _type_fund_symbols(fund_type):
+    '''
+    Returns the symbols of fund_type in FUND_TYPES_FILE,
+    None if there is no such file, then all the funds in the history are used.
+    '''
+    if not os.path.exists(FUND_TYPES_FILE):
+        return None
+
+    return symboluniverse.SymbolUniverse.load(FUND_TYPES_FILE).symbols(fund_type)
+
+
+def GenerateLatestData(fund_type = 'mix', panel_path = None, workers = 1, cache_path = STAGE_CACHE_PATH,
+                       risk_horizons = dy.RISK_HORIZONS, max_memory_mb = None, benchmarks = None):
     # Analysis the fund history data with ALL days that scraped from the net.
     # So that we can choose which funds we can buy and make the label.
     # This daa will be used to predict.
-    process_fund_history_data(is_analysis_label = True,
-        output_file_long_path = r'.\data\processingdata\mix_fund_hist_latest.csv')
+    # The stages pass the data in memory, only the merged data is saved.
+    # risk_horizons is the horizons of the risk attributes, an empty list does not add them.
+    # max_memory_mb is the memory budget of each process, see process_fund_history_data.
+    # benchmarks are compared with besides SCI, default is every benchmark whose file is there.
+    file_short_path = r'.\data\processingdata\fund\historyinfo'
+    history_fingerprint = pipeline.path_fingerprint(file_short_path if panel_path is None else panel_path)
+    sci_fingerprint     = pipeline.path_fingerprint(r'.\data\processingdata\fund\sh_index.csv')
+    benchmarks          = available_benchmarks() if benchmarks is None else list(benchmarks)
+    benchmark_inputs    = [pipeline.path_fingerprint(benchmark_file(name)) for name in benchmarks]
+    basic_file          = r'.\data\processingdata\fund\%s_fund_basic.csv' %(fund_type)
+    options             = {'panel_path' : panel_path, 'workers' : workers, 'max_memory_mb' : max_memory_mb}
+
+    stages = pipeline.Pipeline(cache_path)
+
+    fund_df, history_key = stages.run('history_latest', process_fund_history_data,
+                                      params = {'is_analysis_label' : True, 'output_file_long_path' : None,
+                                                'fund_symbols' : _type_fund_symbols(fund_type), 'benchmarks' : benchmarks},
+                                      inputs = [history_fingerprint, sci_fingerprint] + benchmark_inputs,
+                                      options = options)
+
+    fund_df, increase_key = stages.run('increase_latest', add_increase_attributes, args = (fund_df,),
+                                       inputs = [history_key, history_fingerprint],
+                                       options = options)
+
+    if risk_horizons:
+        fund_df, increase_key = stages.run('risk_latest', add_risk_attributes, args = (fund_df,),
+                                           params = {'horizons' : list(risk_horizons)},
+                                           inputs = [increase_key, history_fingerprint, sci_fingerprint],
+                                           options = options)
+
+    fund_df, _ = stages.run('merge_latest', merge_fund_data, args = (fund_df, basic_file),
+                            inputs = [increase_key, pipeline.path_fingerprint(basic_file)])
+
+    output_file_long_path = r'.\data\processingdata\%s_fund_merged_latest.csv' %(fund_type)
+    fund_df.to_csv(output_file_long_path, encoding = 'utf-8')
+    metrics.METRICS.add_written(output_file_long_path, len(fund_df), kind = 'features')
+    print('Saved merged %s funds to %s' %(len(fund_df), output_file_long_path))
 
-    AddIncreaseAttributes(file_long_path = r'.\data\processingdata\mix_fund_hist_latest.csv')
+    return fund_df
+
+
+def GenerateTrainingData(fund_type = 'mix', panel_path = None, workers = 1, cache_path = STAGE_CACHE_PATH, label_params = None,
+                         risk_horizons = dy.RISK_HORIZONS, label_rules = None, max_memory_mb = None, benchmarks = None):
+    # The stages pass the data in memory, only the training data is saved.
+    # Each stage is cached, so changing only the labels skips the history and increase stages.
+    # label_rules is (universe, rules) of labelengine, default is the labels of select_label_funds with label_params.
+    # risk_horizons is the horizons of the risk attributes, an empty list does not add them.
+    # max_memory_mb is the memory budget of each process, see process_fund_history_data.
+    # benchmarks are compared with besides SCI, default is every benchmark whose file is there.
+    file_short_path = r'.\data\processingdata\fund\historyinfo'
+    history_fingerprint = pipeline.path_fingerprint(file_short_path if panel_path is None else panel_path)
+    sci_fingerprint     = pipeline.path_fingerprint(r'.\data\processingdata\fund\sh_index.csv')
+    benchmarks          = available_benchmarks() if benchmarks is None else list(benchmarks)
+    benchmark_inputs    = [pipeline.path_fingerprint(benchmark_file(name)) for name in benchmarks]
+    basic_file          = r'.\data\processingdata\fund\%s_fund_basic.csv' %(fund_type)
+    options             = {'panel_path' : panel_path, 'workers' : workers, 'max_memory_mb' : max_memory_mb}
 
-    MergeFundData(  file_long_path_hist = r'.\data\processingdata\mix_fund_hist_latest.csv',
-                    file_long_path_basic = r'.\data\processingdata\fund\mix_fund_basic.csv',
-                    output_file_long_path = r'.\data\processingdata\mix_fund_merged_latest.csv')
+    stages = pipeline.Pipeline(cache_path)
 
-def GenerateTrainingData():
     # Filter out the latest one or two months data, we cannot use these data to build the model.
-    process_fund_history_data(is_analysis_label = False,
-        output_file_long_path = r'.\data\processingdata\mix_fund_hist_training.csv')
+    fund_df, history_key = stages.run('history_training', process_fund_history_data,
+                                      params = {'is_analysis_label' : False, 'output_file_long_path' : None,
+                                                'fund_symbols' : _type_fund_symbols(fund_type), 'benchmarks' : benchmarks},
+                                      inputs = [history_fingerprint, sci_fingerprint] + benchmark_inputs,
+                                      options = options)
+
+    # Merge the history data and the basic data.
+    fund_df, merge_key = stages.run('merge_training', merge_fund_data, args = (fund_df, basic_file),
+                                    inputs = [history_key, pipeline.path_fingerprint(basic_file)])
+
+    # Add the rate of increasement in the past several months.
+    fund_df, increase_key = stages.run('increase_training', add_increase_attributes, args = (fund_df,),
+                                       inputs = [merge_key, history_fingerprint],
+                                       options = options)
+
+    # Add the risk attributes, like the history data they do not use the latest two months.
+    if risk_horizons:
+        fund_df, increase_key = stages.run('risk_training', add_risk_attributes, args = (fund_df,),
+                                           params = {'horizons' : list(risk_horizons), 'offset' : dy.TWO_MONTHS},
+                                           inputs = [increase_key, history_fingerprint, sci_fingerprint],
+                                           options = options)
+
+    # Add all the label columns in one pass over the data.
+    if label_rules is None:
+        label_rules = labelengine.default_label_rules(**(label_params or {}))
+    label_universe, rules = label_rules
+    fund_df, _ = stages.run('label_training', labelengine.add_labels, args = (fund_df,),
+                            params = {'rules' : rules, 'universe' : label_universe}, inputs = [increase_key])
+
+    output_file_long_path = r'.\data\processingdata\%s_fund_merged_training.csv' %(fund_type)
+    fund_df.to_csv(output_file_long_path, encoding = 'utf-8')
+    metrics.METRICS.add_written(output_file_long_path, len(fund_df), kind = 'features')
+    print('Saved %s funds with labels to %s' %(len(fund_df), output_file_long_path))
+
+    return fund_df
+   
 
-    # Merge the history data and the basic data in one file.
-    MergeFundData(  file_long_path_hist = r'.\data\processingdata\mix_fund_hist_training.csv',
-                    file_long_path_basic = r'.\data\processingdata\fund\mix_fund_basic.csv',
-                    output_file_long_path = r'.\data\processingdata\mix_fund_merged_training.csv')
+def _map_fund_shards(function, fund_symbols, workers, *args):
+    '''
+    Call function(shard, *args) on shards of fund_symbols and return the results in the order of the shards,
+    so merging them gives the same result whatever the number of workers is.
 
-    # Add the rate of increasement in the past several months in the input file.
-    AddIncreaseAttributes(file_long_path = r'.\data\processingdata\mix_fund_merged_training.csv')
+    workers <= 1 calls function once with all the funds in this process.
+    '''
+    return list(_iter_fund_shards(function, fund_symbols, workers, None, *args))
 
-    # Generate label funds when analysis the funds, not in the training dataset generation stage.
-    GenerateLabelFundsToFiles(file_long_path = r'.\data\processingdata\mix_fund_merged_training.csv')
 
-    # Add label in the data file.
-    AddLabelAttributes(file_long_path = r'.\data\processingdata\mix_fund_merged_training.csv',
-                        label_file_long_path = r'.\data\processingdata\mix_fund_label_past_one_and_two_month.csv',
-                        label_name = 'label_past_one_and_two_month')
+def _iter_fund_shards(function, fund_symbols, workers, batch_size, *args):
+    '''
+    Like _map_fund_shards, but yield each result as soon as it and the ones before it are done,
+    and no shard has more than batch_size funds. None does not limit the shards.
+    '''
+    num_of_shards = 1 if workers <= 1 else workers * 4
+    if batch_size is not None:
+        num_of_shards = max(num_of_shards, -(-len(fund_symbols) // batch_size))
+
+    if num_of_shards <= 1 or len(fund_symbols) <= 1:
+        yield function(fund_symbols, *args)
+        return
+
+    # Some more shards than workers, so a slow shard does not keep the other workers waiting.
+    shards = [list(shard) for shard in np.array_split(np.asarray(fund_symbols, dtype = object), num_of_shards) if len(shard) > 0]
+
+    if workers <= 1:
+        for shard in shards:
+            yield function(shard, *args)
+        return
+
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        for result in executor.map(function, shards, *[[arg] * len(shards) for arg in args]):
+            yield result
+
+
+# The bytes that each stage takes per fund and per day of the rows it reads, the arrays and the temporaries
+# of the features with some margin, measured with tracemalloc. A panel adds PANEL_BYTES_PER_DAY for every day of the panel,
+# and the fields it maps are counted whole, taking a few columns of them touches every page.
+# Every benchmark other than SCI adds BENCHMARK_BYTES_PER_DAY to the history stage.
+WINDOW_BYTES_PER_DAY = {'history' : 64, 'increase' : 32, 'risk' : 128}
+BENCHMARK_BYTES_PER_DAY = 24
+PANEL_BYTES_PER_DAY = 48
+
+
+def _memory_batch_size(max_memory_mb, bytes_per_fund, fixed_bytes = 0):
+    '''
+    Returns the number of funds of a batch that fits in max_memory_mb with the memory the process already uses
+    and fixed_bytes more, None if max_memory_mb is None.
+    '''
+    if max_memory_mb is None:
+        return None
+
+    available = max_memory_mb * 1024 * 1024 - utility.memory_usage() - fixed_bytes
+    batch_size = int(available // bytes_per_fund)
+    if batch_size < 1:
+        print('The process already uses %.0f MB, more than max_memory_mb %s, the funds are processed one by one'
+              %(utility.memory_usage() / 1024.0 / 1024.0, max_memory_mb))
+        batch_size = 1
+
+    print('Processing at most %s funds at a time in %s MB' %(batch_size, max_memory_mb))
+
+    return batch_size
+
+
+def _add_shard_columns(fund_df, results, output_file_long_path = None):
+    '''
+    Returns a copy of fund_df with the columns of the shard results, which are in the order of fund_df,
+    existing columns are replaced. Each batch is appended to output_file_long_path when it is done, if it is not None.
+    '''
+    batches = list()
+    row = 0
+    for result_df in results:
+        # Set the whole column block at once.
+        batch_df = fund_df.iloc[row:row + len(result_df)].copy()
+        for column in result_df.columns:
+            batch_df[column] = result_df[column].values
+        row += len(result_df)
+
+        if output_file_long_path is not None:
+            _append_to_csv(batch_df, output_file_long_path, is_first = len(batches) == 0)
+        batches.append(batch_df)
+
+    fund_df = pd.concat(batches)
+    if output_file_long_path is not None:
+        metrics.METRICS.add_written(output_file_long_path, len(fund_df), kind = 'features')
+
+    return fund_df
+
+
+def _append_to_csv(df, file_long_path, is_first):
+    '''
+    Write df to a csv file, the first batch creates the file with the header, the others are appended.
+    '''
+    df.to_csv(file_long_path, encoding = 'utf-8', mode = 'w' if is_first else 'a', header = is_first)
+
+
+class _FundHistoryLoader():
+    '''
+    Read the history of each fund, either from the per fund csv files
+    or from one navpanel.NavPanelStore that is loaded only once.
+    '''
+    def __init__(self, file_short_path, panel_path = None, symbols = None, fields = None):
+        self.file_short_path = file_short_path
+        self.panel = None
+        self._symbols = None if symbols is None else [str(symbol) for symbol in symbols]
+
+        if panel_path is not None:
+            self.panel = navpanel.NavPanelStore(panel_path).load(symbols = self._symbols, fields = fields, mmap = True)
+
+    def __len__(self):
+        return len(self.symbols())
+
+    def symbols(self):
+        if self.panel is not None:
+            return list(self.panel.symbols)
+
+        if self._symbols is not None:
+            return self._symbols
+
+        # file_name is 000001.csv
+        return [file_name.split('.')[0] for file_name in os.listdir(self.file_short_path)]
+
+    def bytes_per_fund(self, num_days, bytes_per_day):
+        '''
+        Returns the memory that reading and computing num_days rows of one fund takes.
+        '''
+        if self.panel is not None:
+            return num_days * bytes_per_day + len(self.panel.dates) * PANEL_BYTES_PER_DAY
+
+        return num_days * bytes_per_day
+
+    def mapped_bytes(self):
+        '''
+        Returns the size of the memory-mapped panel, 0 for the csv files.
+        '''
+        if self.panel is None:
+            return 0
+
+        return sum(array.nbytes for array in self.panel.data.values()) + self.panel.present.nbytes
+
+    def load(self, fund_symbol):
+        if self.panel is not None:
+            return self.panel.fund_frame(fund_symbol)
+
+        return pd.read_csv(self.file_short_path + dy.sep + fund_symbol + '.csv', index_col = 'date')
+
+    def latest_rows(self, num_days, fields):
+        '''
+        Returns (symbols, dates, data, lengths) of the latest num_days rows of every fund,
+        see navpanel.NavPanel.latest_rows.
+        '''
+        if self.panel is not None:
+            dates, data, lengths = self.panel.latest_rows(num_days, fields)
+            return self.symbols(), dates, data, lengths
+
+        symbols = self.symbols()
+        dates = np.full((len(symbols), num_days), -1, dtype = np.int64)
+        data = dict((field, np.full((len(symbols), num_days), np.nan)) for field in fields)
+        lengths = np.zeros(len(symbols), dtype = int)
+
+        for i, fund_symbol in enumerate(symbols):
+            per_fund_df = self.load(fund_symbol)[:num_days]
+            lengths[i] = len(per_fund_df)
+            dates[i, :lengths[i]] = pd.to_datetime(per_fund_df.index).values.astype('datetime64[D]').astype(np.int64)
+            for field in fields:
+                data[field][i, :lengths[i]] = per_fund_df[field].values
+
+        return symbols, dates, data, lengths
 
-    # Add label in the data file.
-    AddLabelAttributes(file_long_path = r'.\data\processingdata\mix_fund_merged_training.csv',
-                        label_file_long_path = r'.\data\processingdata\mix_fund_label_past_one_month_only.csv',
-                        label_name = 'label_past_one_month_only')
-   
 
 if __name__ == "__main__":
     # MakeTopFundsPlot(r'.\data\processingdata\mix_fund_hist.csv')
@@ -439,6 +1069,7 @@ if __name__ == "__main__":
     #GenerateTrainingData()
 
 
-    MakeTopFundsPlot(r'.\data\processingdata\mix_fund_label_past_one_and_two_month.csv')
-    MakeTopFundsPlot(r'.\data\processingdata\mix_fund_label_past_one_month_only.csv')
+    fund_type = 'mix'
+    MakeTopFundsPlot(LABEL_FILES['label_past_one_and_two_month'] %(fund_type), fund_type)
+    MakeTopFundsPlot(LABEL_FILES['label_past_one_month_only'] %(fund_type), fund_type)
 
@@ -1,23 +1,91 @@
 import pandas as pd
 import numpy as np
-import tushare as ts
-from tushare.fund import nav
 import sys
 import os
 import datetime
+import time
 import logging
-from tqdm import tqdm
 
 import utility
+import metrics
+import fundbasic
+import navpanel
+import responsecache
+import symboluniverse
+import fetchpipeline
 import datatypes as dt
 
 
 class Fecther():
     """
     Fecth the fund information from website.
+
+
+    Parameters
+    ----------
+    nav_api : module, default is tushare.fund.nav
+        The module that serves get_nav_open, get_fund_info and get_nav_history.
+        Pass a fake one to run without network.
+
+    ts_api : module, default is tushare
+        The module that serves get_hist_data.
+
+    cache : responsecache.ResponseCache, default is None
+        Answer the requests from this on-disk cache while its responses are fresh.
+
+    The latency of every request that is sent is recorded in metrics.METRICS, the cached ones are not.
     """
 
-    def fetch_fund_basic_data(self, fund_types, path):
+    def __init__(self, nav_api = None, ts_api = None, cache = None):
+        # tushare is slow to import, it is only imported when no api is given.
+        if nav_api is None:
+            from tushare.fund import nav as nav_api
+        if ts_api is None:
+            import tushare as ts_api
+
+        self.nav = metrics.InstrumentedApi(nav_api)
+        self.ts  = metrics.InstrumentedApi(ts_api)
+
+        if cache is not None:
+            self.nav = responsecache.CachedApi(self.nav, cache)
+            self.ts  = responsecache.CachedApi(self.ts, cache)
+
+        # fund types --> SymbolUniverse, the symbol lists are downloaded once per Fecther.
+        self._universes = dict()
+
+
+    def get_symbol_universe(self, fund_types):
+        """
+        Get the symbols of the fund types and the types of each symbol.
+
+        The symbol lists are downloaded the first time only,
+        the fetch methods given the same fund_types share them.
+
+
+        Parameters
+        ----------
+        fund_types : list or symboluniverse.SymbolUniverse
+            The type of fund, e.g. ['all', 'equity', 'mix', 'bond', 'monetary'].
+            A SymbolUniverse is returned as it is.
+
+
+        Returns
+        -------
+        universe : symboluniverse.SymbolUniverse
+        """
+
+        if isinstance(fund_types, symboluniverse.SymbolUniverse):
+            return fund_types
+
+        key = tuple(fund_types)
+        if key not in self._universes:
+            self._universes[key] = symboluniverse.SymbolUniverse(
+                dict((fund_type, self._get_fund_symbols(fund_type)) for fund_type in fund_types))
+
+        return self._universes[key]
+
+
+    def fetch_fund_basic_data(self, fund_types, path, type_path = None, max_workers = 8, resume = True, max_attempts = 5):
         """
         Fecth the fund basic information.
 
@@ -25,7 +93,7 @@ class Fecther():
         Parameters
         ----------
 
-        fund_types : list
+        fund_types : list or symboluniverse.SymbolUniverse
             The type of fund.
             For example:
                 ['all']
@@ -33,7 +101,22 @@ class Fecther():
 
 
         path : string
-            The file full spec to save the data.
+            The file full spec to save the data of all the fund types.
+
+        type_path : string, default is None
+            The file full spec with a %s for the fund type, e.g. '.\\mix_fund_basic.csv' for '.\\%s_fund_basic.csv',
+            the data of each fund type is also saved to its own file.
+
+        max_workers : int, default is 8
+            The number of requests in flight at the same time.
+
+        resume : bool, default is True
+            True: the information of every fund is saved to path + '.parts' as it arrives and
+            recorded in the manifest path + '.manifest', a run restarted on the same day only
+            fetches the funds that are not completed. False starts again.
+
+        max_attempts : int, default is 5
+            A fund fails after this number of requests, see fetchpipeline.run_fetch_pipeline.
 
 
         Returns
@@ -60,92 +143,56 @@ class Fecther():
                 tgr       --> fund_trustee       : 基金托管人
         """
         
-        fund_symbols = list()
-        for fund_type in fund_types:
-            fund_symbols += self._get_fund_symbols(fund_type)
-
-        # Remove duplicated symbols
-        fund_symbols = list(set(fund_symbols))
-
+        universe = self.get_symbol_universe(fund_types)
+        fund_symbols = universe.symbols()
 
         if fund_symbols is None or len(fund_symbols) <= 0:
             print("ERROR!!! fund_symbols is None or len(fund_symbols) <= 0")
 
             return None
 
-        info_df = nav.get_fund_info(fund_symbols[0])
+        info_df = None
 
         try:
             print("Getting fund basic information...")
 
 
-            failed_symbols = list()
-
-            for fund_symbol in tqdm(fund_symbols[1:]):
-                try:
-                    info_df = info_df.append(nav.get_fund_info(fund_symbol))
-                except Exception as e:
-                    failed_symbols.append(fund_symbol)
-                    print("fund_symbol={}".format(fund_symbol))
-                    print(e)
-                    pass
-
-            # Try to get the failed fund again.
-            failed_symbols2 = list()
-            if len(failed_symbols) > 0:
-                for symbol in failed_symbols:
-                    try:
-                        info_df = info_df.append(nav.get_fund_info(symbol))
-                    except Exception as e:
-                        failed_symbols2.append(symbol)
-                        print(e)
-                        pass
-
-            if len(failed_symbols2) > 0:
-                print("Still failed to get {} funds information.".format(len(failed_symbols2)))
-                print(failed_symbols2)
-
-
-            # Give the column an english name, I think it's better than the old Chinese name.
-            info_df = info_df.rename(columns = {
-                                                'jjqc'      : 'fund_full_name',
-                                                'jjjc'      : 'fund_short_name',
-                                                'clrq'      : 'foundation_date',
-                                                'ssrq'      : 'listing_date',
-                                                'xcr'       : 'renew_period',
-                                                'ssdd'      : 'listed_location',
-                                                'Type1Name' : 'operation_mode',
-                                                'Type2Name' : 'fund_category',
-                                                'Type3Name' : 'secondary_category',
-                                                'jjgm'      : 'fund_scale',
-                                                'jjfe'      : 'fund_amount',
-                                                'jjltfe'    : 'circulation_share',
-                                                'jjferq'    : 'fund_share_date',
-                                                'quarter'   : 'listed_quarter',
-                                                'glr'       : 'fund_company',
-                                                'tgr'       : 'fund_trustee'})
-
-
-            info_df = info_df.sort_index()
-
-            # TODO: think out a more efficient way
-            for symbol in info_df.index:
-                # Change time format from "%Y-%m-%d %H:%M:%S" to "%Y-%m-%d".
-                date = datetime.datetime.strptime(info_df.loc[symbol, 'foundation_date'], "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d")
-                info_df.loc[symbol, 'foundation_date'] = date
-        
-                date = datetime.datetime.strptime(info_df.loc[symbol, 'fund_share_date'], "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d")
-                info_df.loc[symbol, 'fund_share_date'] = date
+            # Save every frame as it arrives, then concatenate them only once at the end.
+            parts_file = path + '.parts'
+            manifest_file = path + '.manifest'
+            if not resume and os.path.exists(manifest_file):
+                os.remove(manifest_file)
+
+            manifest = fetchpipeline.FetchManifest(manifest_file, {'day' : datetime.date.today().strftime("%Y-%m-%d")})
+            if not manifest.is_resumed and os.path.exists(parts_file):
+                os.remove(parts_file)
+
+            summary = fetchpipeline.run_fetch_pipeline(fund_symbols, self.nav.get_fund_info,
+                                                       lambda fund_symbol, info: fetchpipeline.append_part(parts_file, fund_symbol, info),
+                                                       manifest = manifest,
+                                                       max_workers = max_workers,
+                                                       max_attempts = max_attempts,
+                                                       name = 'fund_basic')
 
-                # Remain 3 decimals
-                # need to convert to float first
-                #info_df.loc[symbol, 'fund_amount'] = round(info_df.loc[symbol, 'fund_amount'], 3)
-                #info_df.loc[symbol, 'circulation_share'] = round(info_df.loc[symbol, 'circulation_share'], 3)
+            if len(summary['failed']) > 0:
+                print("Still failed to get {} funds information.".format(len(summary['failed'])))
+                print(list(summary['failed'].keys()))
 
+            parts = fetchpipeline.read_parts(parts_file)
+            info_frames = [parts[fund_symbol] for fund_symbol in summary['succeeded']]
+
+            info_df = fundbasic.build_fund_basic_df(info_frames)
 
             info_df.to_csv(path, encoding='utf-8')
+            metrics.METRICS.add_written(path, len(info_df), kind = 'fund_basic')
             print("Savd {} basic information to {}".format(len(fund_symbols), path))
 
+            if type_path is not None:
+                for fund_type, type_df in universe.partition(info_df).items():
+                    type_df.to_csv(type_path %(fund_type), encoding='utf-8')
+                    metrics.METRICS.add_written(type_path %(fund_type), len(type_df), kind = 'fund_basic')
+                    print("Savd {} {} basic information to {}".format(len(type_df), fund_type, type_path %(fund_type)))
+
         except Exception as e:
             print("ERROR happened in fetch_fund_basic_data")
             print(str(e))
@@ -154,14 +201,25 @@ class Fecther():
         return info_df
 
 
-    def fetch_fund_history_data(self, fund_types, path, start_day = '2011-09-11', end_day = None):
+    def fetch_fund_history_data(self, fund_types, path, start_day = '2011-09-11', end_day = None, max_workers = 8,
+                                incremental = False, base_path = None, panel_path = None, resume = True, max_attempts = 5):
         '''
         Get the fund history information and save it to a csv file per fund.
 
+        The requests are sent from a pool of max_workers threads, because nearly
+        all the time is spent waiting on the network. Each file is written as soon
+        as its result arrives and recorded in a manifest next to path, so a
+        restarted run only fetches the funds that are not completed. A failed request
+        is sent again after a growing delay, see fetchpipeline.run_fetch_pipeline.
+
+        In incremental mode the last stored date of every fund is read from
+        base_path, only the missing days are requested and the new rows are
+        merged into the stored series.
+
 
         Parameters
         ----------
-        fund_types : list of string
+        fund_types : list of string or symboluniverse.SymbolUniverse
             the fund types
             For example:
                 ['all']
@@ -169,7 +227,7 @@ class Fecther():
                 ...
 
         path : string
-            the path to save the funds files
+            the path to save the funds files, None does not save the csv files
 
         start_day : string, default is '2011-09-11'
             the start day of the fund information
@@ -178,9 +236,33 @@ class Fecther():
         end_day : string, default is today
             end day for fund history
 
+        max_workers : int, default is 8
+            the number of requests in flight at the same time,
+            1 fetches the funds one after another.
+
+        incremental : bool, default is False
+            True: only fetch the days after the last stored date of each fund.
+
+        base_path : string, default is path
+            the path of the stored funds files that incremental mode extends,
+            for example the historyinfo directory of the previous day.
+
+        panel_path : string, default is None
+            the directory of a navpanel.NavPanelStore,
+            the fetched history is appended to it when all the funds are done.
+
+        resume : bool, default is True
+            False fetches all the funds again, even if the manifest has them as completed.
+            The csv files are needed to resume, without path every run starts again.
+
+        max_attempts : int, default is 5
+            A fund fails after this number of requests.
+
         Returns
         -------
-        None
+        summary : dict
+            succeeded : list of the symbols that were saved
+            failed    : dict of symbol --> error message
 
         '''
 
@@ -188,32 +270,59 @@ class Fecther():
             end_day = datetime.date.today().strftime("%Y-%m-%d")
 
 
-        fund_symbols = list()
-        for fund_type in fund_types:
-            fund_symbols += self._get_fund_symbols(fund_type)
+        # The union of the fund types, every symbol is fetched once.
+        fund_symbols = self.get_symbol_universe(fund_types).symbols()
 
+        if not incremental:
+            base_path = None
+        elif base_path is None:
+            base_path = path
 
-        # Remove duplicated symbols
-        fund_symbols = list(set(fund_symbols))
+        manifest_file = None
+        if path is not None:
+            # Next to the history directory, not in it, the directory only has the fund files.
+            manifest_file = path.rstrip('\\/') + '.manifest'
+            if not resume and os.path.exists(manifest_file):
+                os.remove(manifest_file)
+        manifest = fetchpipeline.FetchManifest(manifest_file, {'start_day' : start_day, 'end_day' : end_day,
+                                                               'incremental' : incremental, 'base_path' : base_path})
 
-        for fund_symbol in tqdm(fund_symbols[:]):
-            try:
-                # print('Getting %s history infortation...' %(fund_symbol))
-                his_df = nav.get_nav_history(fund_symbol,
-                                   start = start_day,
-                                   end = end_day,
-                                   retry_count = 5,
-                                   timeout = 20)
-        
+        panel_frames = dict()
+
+        def _save_fund_history(fund_symbol, his_df):
+            if his_df is None:
+                raise ValueError('No history data of %s between %s and %s' %(fund_symbol, start_day, end_day))
+
+            if path is not None:
                 file_spec = path + fund_symbol +'.csv'
                 his_df.to_csv(file_spec)
-                print('\n Saved %s' %(file_spec))
-            except Exception as e:
-                print(e)
-                pass
+                metrics.METRICS.add_written(file_spec, len(his_df), kind = 'fund_history')
+            if panel_path is not None:
+                panel_frames[fund_symbol] = his_df
+
+        summary = fetchpipeline.run_fetch_pipeline(fund_symbols,
+                                                   lambda fund_symbol: self._fetch_fund_history(fund_symbol, start_day, end_day, base_path),
+                                                   _save_fund_history,
+                                                   manifest = manifest,
+                                                   max_workers = max_workers,
+                                                   max_attempts = max_attempts,
+                                                   name = 'fund_history')
 
+        if panel_path is not None:
+            # The funds of a resumed run were saved before, read them back for the panel.
+            for fund_symbol in summary['succeeded']:
+                if fund_symbol not in panel_frames:
+                    panel_frames[fund_symbol] = _read_stored_history(path + fund_symbol + '.csv', parse_dates = False)
 
-    def fetch_shanghai_index(self, filename, start_day = '2011-09-11' , end_day = None):
+        if panel_path is not None and len(panel_frames) > 0:
+            navpanel.NavPanelStore(panel_path).append(panel_frames)
+
+        print('Saved %s funds history to %s, failed %s' %(len(summary['succeeded']), path if path is not None else panel_path, len(summary['failed'])))
+
+        return summary
+
+
+    def fetch_shanghai_index(self, filename, start_day = '2011-09-11' , end_day = None, incremental = False, base_file = None):
         '''
         Get the Shanghai Composite Index data and save it to a csv file.
 
@@ -225,20 +334,104 @@ class Fecther():
             start_day : string, default is '2011-09-11'
 
             end_day : string, default is today
+
+            incremental : bool, default is False
+                True: only fetch the days after the last date in base_file
+                and merge them into it.
+
+            base_file : string, default is filename
+                the stored SCI data that incremental mode extends.
         '''
 
         if end_day is None:
             end_day = datetime.date.today().strftime("%Y-%m-%d")
 
-        index_data = ts.get_hist_data('sh', start = start_day, end = end_day)
+        if not incremental:
+            base_file = None
+        elif base_file is None:
+            base_file = filename
+
+        index_data = self._fetch_index('sh', start_day, end_day, base_file)
 
         index_data.to_csv(filename, encoding = 'utf-8')
+        metrics.METRICS.add_written(filename, len(index_data), kind = 'index')
         print('Saved Shanghai Composite Index data to %s\n' %(filename))
 
 
-    def _get_fund_symbols(self, fund_type):
+    def fetch_benchmark_indices(self, path, benchmarks = None, start_day = '2011-09-11', end_day = None, incremental = False,
+                                base_path = None, max_workers = 4, max_attempts = 5):
+        '''
+        Get several benchmark indices at the same time and save each one to its own csv file.
+
+        The indices are requested from a pool of threads with the retries of
+        fetchpipeline.run_fetch_pipeline, every file is written as soon as its index arrives.
+
+
+        Parameters
+        ----------
+        path : string
+            the directory to save the files in, the file of each index is dt.BENCHMARK_FILE with its code,
+            e.g. sh_index.csv and hs300_index.csv
+
+        benchmarks : list of string, default is all the names of dt.BENCHMARKS
+            e.g. ['sci', 'hs300']
+
+        start_day, end_day : see fetch_shanghai_index
+
+        incremental : bool, default is False
+            True: only fetch the days after the last date of the file of each index in base_path
+            and merge them into it.
+
+        base_path : string, default is path
+            the directory of the stored indices that incremental mode extends.
+
+        max_workers : int, default is 4
+
+        max_attempts : int, default is 5
+            An index fails after this number of requests.
+
+        Returns
+        -------
+        summary : dict
+            succeeded : list of the names that were saved
+            failed    : dict of name --> error message
+        '''
+
+        if end_day is None:
+            end_day = datetime.date.today().strftime("%Y-%m-%d")
+        if benchmarks is None:
+            benchmarks = list(dt.BENCHMARKS.keys())
+
+        if not incremental:
+            base_path = None
+        elif base_path is None:
+            base_path = path
+
+        def _fetch_benchmark(name):
+            code = dt.BENCHMARKS[name]
+            base_file = None if base_path is None else base_path + dt.BENCHMARK_FILE %(code)
+            return self._fetch_index(code, start_day, end_day, base_file)
+
+        def _save_benchmark(name, index_data):
+            file_spec = path + dt.BENCHMARK_FILE %(dt.BENCHMARKS[name])
+            index_data.to_csv(file_spec, encoding = 'utf-8')
+            metrics.METRICS.add_written(file_spec, len(index_data), kind = 'index')
+
+        # The indices are few and small, the manifest is kept in memory and every run fetches the missing days again.
+        summary = fetchpipeline.run_fetch_pipeline(benchmarks, _fetch_benchmark, _save_benchmark,
+                                                   max_workers = max_workers,
+                                                   max_attempts = max_attempts,
+                                                   name = 'index')
+
+        print('Saved %s benchmark indices to %s, failed %s' %(len(summary['succeeded']), path, len(summary['failed'])))
+
+        return summary
+
+
+    def _get_fund_symbols(self, fund_type, max_attempts = 5):
         """
         Get the fund symbols of the specific fund type.
+        A failed request is sent again after a growing delay, at most max_attempts times.
 
 
         Parameters
@@ -257,13 +450,129 @@ class Fecther():
 
         fund_symbols = []
 
-        try:
-            fund_info = nav.get_nav_open(fund_type)
-            fund_symbols = fund_info['symbol'].astype(str)
-        except Exception as e:
-            print(e)
-            pass
+        for attempts in range(1, max_attempts + 1):
+            try:
+                fund_info = self.nav.get_nav_open(fund_type)
+                fund_symbols = fund_info['symbol'].astype(str)
+                break
+            except Exception as e:
+                print(e)
+                if attempts < max_attempts:
+                    metrics.METRICS.increment('fetch_retries', pipeline = 'fund_symbols')
+                    time.sleep(fetchpipeline.retry_delay(attempts))
+                else:
+                    metrics.METRICS.increment('fetch_failures', pipeline = 'fund_symbols')
 
         return list(fund_symbols)
 
 
+    def _get_nav_history(self, fund_symbol, start_day, end_day):
+        """
+        Get the history of one fund, it is called from the worker threads.
+        """
+
+        return self.nav.get_nav_history(fund_symbol,
+                                        start = start_day,
+                                        end = end_day,
+                                        retry_count = 5,
+                                        timeout = 20)
+
+
+    def _fetch_index(self, code, start_day, end_day, base_file = None):
+        """
+        Get the index of code, it is called from the worker threads.
+
+        If base_file is given, the stored index is extended with the days after its last stored date.
+        """
+
+        stored_df = None
+        if base_file is not None:
+            stored_df = _read_stored_history(base_file, parse_dates = False)
+            if stored_df is not None:
+                start_day = max(start_day, _next_day(stored_df.index.max()))
+
+        if start_day > end_day:
+            index_data = None
+        else:
+            index_data = self.ts.get_hist_data(code, start = start_day, end = end_day)
+
+        index_data = _merge_history(stored_df, index_data)
+        if index_data is None:
+            raise ValueError('No data of the index %s between %s and %s' %(code, start_day, end_day))
+
+        return index_data
+
+
+    def _fetch_fund_history(self, fund_symbol, start_day, end_day, base_path = None):
+        """
+        Get the history of one fund, it is called from the worker threads.
+
+        If base_path is given, the stored history of the fund is extended
+        with the days after its last stored date.
+        """
+
+        stored_df = None
+        if base_path is not None:
+            stored_df = _read_stored_history(base_path + fund_symbol + '.csv')
+            if stored_df is not None:
+                start_day = max(start_day, _next_day(stored_df.index.max()))
+
+        if start_day > end_day:
+            return stored_df
+
+        his_df = self._get_nav_history(fund_symbol, start_day, end_day)
+
+        if stored_df is None:
+            return his_df
+
+        his_df = _merge_history(stored_df, his_df)
+
+        # The oldest fetched day has no previous value in its own response,
+        # so work out the change again on the merged series, the same way as tushare.
+        his_df['change'] = (his_df['value'] / his_df['value'].shift(-1) - 1) * 100
+
+        return his_df
+
+
+def _read_stored_history(file_spec, parse_dates = True):
+    """
+    Read a stored history file indexed by date, returns None if there is no such file.
+    """
+
+    if not os.path.exists(file_spec):
+        return None
+
+    stored_df = pd.read_csv(file_spec, index_col = 'date', parse_dates = parse_dates, encoding = 'utf-8')
+    if len(stored_df) == 0:
+        return None
+
+    return stored_df
+
+
+def _next_day(date):
+    """
+    Returns the day after date as "%Y-%m-%d", date can be a string or a datetime.
+    """
+
+    date = pd.Timestamp(date) + datetime.timedelta(days = 1)
+
+    return date.strftime("%Y-%m-%d")
+
+
+def _merge_history(stored_df, new_df):
+    """
+    Merge the newly fetched rows into the stored ones.
+    The fetched row wins when a date is in both, the result is sorted by date descending like tushare does.
+    """
+
+    if stored_df is None:
+        return new_df
+
+    if new_df is None or len(new_df) == 0:
+        return stored_df
+
+    merged_df = pd.concat([new_df, stored_df[stored_df.columns.intersection(new_df.columns)]])
+    merged_df = merged_df[~merged_df.index.duplicated(keep = 'first')]
+    merged_df.index.name = 'date'
+
+    return merged_df.sort_index(ascending = False)
@@ -0,0 +1,301 @@
+'''
+A streaming fetch of many symbols that can be resumed.
+
+Worker threads fetch the symbols and put the results on a bounded queue, the
+calling thread takes them off and saves each one as soon as it arrives, so a
+crash only loses the requests that were in flight. Every result is recorded
+in a manifest, a restarted run reads it and only fetches what is not completed.
+A failed request goes to a retry queue and is sent again after a delay that
+doubles with every attempt, up to a cap.
+'''
+
+import os
+import json
+import time
+import heapq
+import pickle
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+class FetchManifest():
+    """
+    The completed, failed and pending symbols of a fetch.
+
+    The manifest is a json lines file that every result is appended to,
+    the first line holds the parameters of the fetch. A manifest with
+    other parameters, e.g. another end day, is started again.
+
+
+    Parameters
+    ----------
+    file_spec : string, default is None
+        The manifest file, None keeps the manifest in memory only.
+
+    params : dict, default is None
+        The parameters of the fetch, e.g. {'start_day' : '2011-09-11', 'end_day' : '2016-11-15'}.
+    """
+
+    def __init__(self, file_spec = None, params = None):
+        self.file_spec = file_spec
+        self.params = params or {}
+
+        self._symbols = list()
+        self._completed = dict()
+        self._failed = dict()
+        self._file = None
+        self._lock = threading.Lock()
+
+        # True if the file has results of a fetch with the same parameters.
+        self.is_resumed = False
+
+        if file_spec is not None and os.path.exists(file_spec):
+            self._read()
+
+
+    def start(self, symbols):
+        """
+        Start or resume the fetch of symbols.
+
+        Returns: list of the symbols that are not completed yet, in the order of symbols.
+        """
+
+        self._symbols = list(symbols)
+
+        if self.file_spec is not None:
+            # Write the parameters and the results so far to a new file, then append to it.
+            with open(self.file_spec + '.tmp', 'w', encoding = 'utf-8') as f:
+                f.write(json.dumps({'params' : self.params}) + '\n')
+                for symbol in self._completed:
+                    f.write(json.dumps({'symbol' : symbol, 'status' : 'completed'}) + '\n')
+                for symbol, failure in self._failed.items():
+                    f.write(json.dumps(dict(failure, symbol = symbol, status = 'failed')) + '\n')
+            os.replace(self.file_spec + '.tmp', self.file_spec)
+            self._file = open(self.file_spec, 'a', encoding = 'utf-8')
+
+        return self.pending()
+
+
+    def completed(self):
+        return [symbol for symbol in self._symbols if symbol in self._completed]
+
+
+    def failed(self):
+        """
+        Returns: dict of symbol --> {'error' : message, 'attempts' : number of attempts}
+        """
+
+        return dict((symbol, self._failed[symbol]) for symbol in self._symbols if symbol in self._failed)
+
+
+    def pending(self):
+        """
+        Returns the symbols that are not completed, the failed ones included.
+        """
+
+        return [symbol for symbol in self._symbols if symbol not in self._completed]
+
+
+    def mark_completed(self, symbol):
+        with self._lock:
+            self._completed[symbol] = True
+            self._failed.pop(symbol, None)
+            self._append({'symbol' : symbol, 'status' : 'completed'})
+
+
+    def mark_failed(self, symbol, error, attempts):
+        with self._lock:
+            self._failed[symbol] = {'error' : error, 'attempts' : attempts}
+            self._append({'symbol' : symbol, 'status' : 'failed', 'error' : error, 'attempts' : attempts})
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+    def _append(self, record):
+        if self._file is not None:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+
+    def _read(self):
+        with open(self.file_spec, 'r', encoding = 'utf-8') as f:
+            lines = f.read().splitlines()
+
+        records = list()
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # The last line of a crashed run can be cut off.
+                pass
+
+        if len(records) == 0 or records[0].get('params') != json.loads(json.dumps(self.params)):
+            return
+
+        self.is_resumed = True
+
+        for record in records[1:]:
+            if record.get('status') == 'completed':
+                self._completed[record['symbol']] = True
+                self._failed.pop(record['symbol'], None)
+            elif record.get('status') == 'failed':
+                self._failed[record['symbol']] = {'error' : record.get('error'), 'attempts' : record.get('attempts')}
+
+
+def append_part(file_spec, key, value):
+    '''
+    Append one result to a parts file, a stream of pickled (key, value) records.
+    '''
+    with open(file_spec, 'ab') as f:
+        pickle.dump((key, value), f, protocol = pickle.HIGHEST_PROTOCOL)
+
+
+def read_parts(file_spec):
+    '''
+    Returns the dict of key --> value of a parts file, the last value of a key wins.
+    A record that a crash cut off is ignored.
+    '''
+    parts = dict()
+    if not os.path.exists(file_spec):
+        return parts
+
+    with open(file_spec, 'rb') as f:
+        while True:
+            try:
+                key, value = pickle.load(f)
+            except EOFError:
+                break
+            except Exception:
+                # The last record of a crashed run can be cut off.
+                break
+            parts[key] = value
+
+    return parts
+
+
+def retry_delay(attempts, backoff = 0.5, max_backoff = 30.0):
+    '''
+    Returns the seconds to wait before the next attempt, doubled after every attempt and at most max_backoff.
+    '''
+    return min(backoff * 2 ** (attempts - 1), max_backoff)
+
+
+def run_fetch_pipeline(symbols, fetch, consume, manifest = None, max_workers = 8, queue_size = None,
+                       max_attempts = 5, backoff = 0.5, max_backoff = 30.0, name = 'fetch'):
+    '''
+    Fetch the symbols in worker threads and consume each result in the calling thread.
+
+    Inputs:
+        symbols - the symbols to fetch.
+        fetch - fetch(symbol) returns the result, it runs in the worker threads.
+                An exception sends the symbol to the retry queue.
+        consume - consume(symbol, result) saves the result, it runs in the calling thread.
+                  An exception fails the symbol without retrying it.
+        manifest - FetchManifest, the symbols that it has as completed are not fetched again.
+                   Default is a new manifest in memory.
+        max_workers - the number of requests in flight at the same time.
+        queue_size - the most results that wait to be consumed, default is max_workers * 4.
+        max_attempts - the symbol fails after this number of attempts.
+        backoff, max_backoff - see retry_delay.
+        name - the label of the retries, failures and completed symbols in metrics.METRICS,
+               and of the progress lines.
+
+    Returns: dict
+        succeeded - list of the completed symbols, the ones of a resumed run included.
+        failed    - dict of symbol --> error message.
+    '''
+    if manifest is None:
+        manifest = FetchManifest()
+    if queue_size is None:
+        queue_size = max_workers * 4
+
+    pending = manifest.start(symbols)
+    if len(pending) < len(symbols):
+        print('Resuming the fetch, %d of %d symbols are completed' %(len(symbols) - len(pending), len(symbols)))
+
+    # The workers put (symbol, attempts, result, error) on results, at most queue_size are submitted and not consumed,
+    # so the queue never blocks a worker and a slow consumer holds the producers back.
+    results = queue.Queue(maxsize = queue_size)
+    retries = list()
+    next_symbols = iter(pending)
+    is_exhausted = False
+    in_flight = 0
+    failed = dict()
+
+    def _fetch(symbol, attempts):
+        try:
+            results.put((symbol, attempts, fetch(symbol), None))
+        except BaseException as e:
+            # Whatever is raised, the result must reach the queue or the calling thread waits for it forever.
+            results.put((symbol, attempts, None, e))
+
+    progress = metrics.ProgressLogger(name, len(pending))
+    try:
+        with ThreadPoolExecutor(max_workers = max(1, max_workers)) as executor:
+            while True:
+                # Submit the retries that are due first, then the new symbols.
+                while in_flight < queue_size:
+                    if len(retries) > 0 and retries[0][0] <= time.time():
+                        _, attempts, symbol = heapq.heappop(retries)
+                    elif not is_exhausted:
+                        symbol = next(next_symbols, None)
+                        if symbol is None:
+                            is_exhausted = True
+                            continue
+                        attempts = 1
+                    else:
+                        break
+                    executor.submit(_fetch, symbol, attempts)
+                    in_flight += 1
+
+                if in_flight == 0:
+                    if len(retries) == 0:
+                        break
+                    time.sleep(max(0.0, retries[0][0] - time.time()))
+                    continue
+
+                timeout = None if len(retries) == 0 else max(0.0, retries[0][0] - time.time())
+                try:
+                    symbol, attempts, result, error = results.get(timeout = timeout)
+                except queue.Empty:
+                    continue
+                in_flight -= 1
+
+                if error is not None:
+                    if attempts < max_attempts:
+                        metrics.METRICS.increment('fetch_retries', pipeline = name)
+                        heapq.heappush(retries, (time.time() + retry_delay(attempts, backoff, max_backoff), attempts + 1, symbol))
+                        continue
+                else:
+                    try:
+                        consume(symbol, result)
+                        manifest.mark_completed(symbol)
+                        failed.pop(symbol, None)
+                        metrics.METRICS.increment('fetch_completed', pipeline = name)
+                        progress.update(1)
+                        continue
+                    except Exception as e:
+                        error = e
+
+                # The error is kept in the manifest and the summary, not printed for every symbol.
+                failed[symbol] = str(error)
+                manifest.mark_failed(symbol, str(error), attempts)
+                metrics.METRICS.increment('fetch_failures', pipeline = name)
+                progress.update(0, 1)
+    finally:
+        progress.close()
+        manifest.close()
+
+    if len(failed) > 0:
+        metrics.METRICS.skip('fetch_failed', failed.keys())
+        symbol = next(iter(failed))
+        print('%d symbols failed, e.g. %s: %s' %(len(failed), symbol, failed[symbol]))
+
+    return {'succeeded' : manifest.completed(), 'failed' : failed}
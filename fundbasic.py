@@ -0,0 +1,67 @@
+import pandas as pd
+
+
+# Give the column an english name, I think it's better than the old Chinese name.
+BASIC_INFO_COLUMNS = {
+                        'jjqc'      : 'fund_full_name',
+                        'jjjc'      : 'fund_short_name',
+                        'clrq'      : 'foundation_date',
+                        'ssrq'      : 'listing_date',
+                        'xcr'       : 'renew_period',
+                        'ssdd'      : 'listed_location',
+                        'Type1Name' : 'operation_mode',
+                        'Type2Name' : 'fund_category',
+                        'Type3Name' : 'secondary_category',
+                        'jjgm'      : 'fund_scale',
+                        'jjfe'      : 'fund_amount',
+                        'jjltfe'    : 'circulation_share',
+                        'jjferq'    : 'fund_share_date',
+                        'quarter'   : 'listed_quarter',
+                        'glr'       : 'fund_company',
+                        'tgr'       : 'fund_trustee'
+                     }
+
+# The columns that are "%Y-%m-%d %H:%M:%S" in tushare and saved as "%Y-%m-%d".
+DATE_COLUMNS = ['foundation_date', 'fund_share_date']
+
+# The columns that remain 3 decimals.
+DECIMAL_COLUMNS = ['fund_amount', 'circulation_share']
+
+
+def build_fund_basic_df(frames, drop_columns = None, decimals = 3):
+    '''
+    Build the fund basic information DataFrame from the per fund frames.
+
+    The frames are concatenated once, then the columns are renamed and the
+    dates and decimals are normalized column by column, not row by row.
+
+    Inputs:
+        frames - list of DataFrame indexed by symbol, like nav.get_fund_info() returns.
+        drop_columns - list of tushare column names that are not kept, e.g. ['jjqc', 'ssrq', 'xcr'].
+        decimals - the number of decimals that DECIMAL_COLUMNS remain, None keeps them as they are.
+
+    Returns: DataFrame indexed by symbol and sorted by symbol.
+    '''
+    frames = [frame for frame in frames if frame is not None]
+    if len(frames) == 0:
+        return pd.DataFrame()
+
+    info_df = pd.concat(frames)
+
+    if drop_columns is not None:
+        info_df = info_df.drop([column for column in drop_columns if column in info_df.columns], axis = 1)
+
+    info_df = info_df.rename(columns = BASIC_INFO_COLUMNS)
+    info_df = info_df.sort_index()
+
+    for column in DATE_COLUMNS:
+        if column in info_df.columns:
+            # Change time format from "%Y-%m-%d %H:%M:%S" to "%Y-%m-%d".
+            info_df[column] = pd.to_datetime(info_df[column], format = "%Y-%m-%d %H:%M:%S").dt.strftime("%Y-%m-%d")
+
+    if decimals is not None:
+        for column in DECIMAL_COLUMNS:
+            if column in info_df.columns:
+                info_df[column] = pd.to_numeric(info_df[column], errors = 'coerce').round(decimals)
+
+    return info_df
@@ -0,0 +1,181 @@
+'''
+Declarative labelling of the funds.
+
+A label is a list of conditions on the feature columns, all of them must hold.
+Every label is computed in one vectorized pass over the merged frame: each
+condition is a bool mask, the top-k cutoffs of all the labels are found with
+one partial selection per k, and no label file is written or read. A new
+labelling strategy is a new list of rules. The features can also be arrays of
+days x funds, then the labels of every day are computed at once, which is how
+the backtest reuses the same rules.
+
+The rules are plain dicts, so they can be saved and they are part of the
+cache key of a pipeline stage. A condition is one of:
+
+    {'column' : 'increase_of_one_month', 'op' : '<', 'value' : 0.3}
+        the column compared to a value.
+
+    {'column' : 'increase_of_two_months', 'op' : '>', 'other' : 'increase_of_one_month', 'factor' : 1.0}
+        the column compared to another column times factor, factor is 1 if it is missing.
+
+    {'top' : 'increase_of_one_month', 'k' : 100}
+        the column is larger than its k-th largest value (k = 0 is the largest), the top k funds.
+
+    {'bottom' : 'max_drawdown_of_six_months', 'k' : 100}
+        the column is smaller than its k-th smallest value, the bottom k funds.
+
+The top and bottom ranks are taken among the funds of the universe, the
+conditions that every labeled fund must meet first, e.g. not an outlier.
+'''
+
+import operator
+
+import numpy as np
+import pandas as pd
+
+import ranking
+
+
+OPERATORS = {
+                '>'  : operator.gt,
+                '>=' : operator.ge,
+                '<'  : operator.lt,
+                '<=' : operator.le,
+                '==' : operator.eq,
+                '!=' : operator.ne
+            }
+
+
+def default_label_rules(num_of_candidates = 100, min_days_of_processed = 100,
+                        max_increase_of_one_month = 0.3, max_increase_of_three_months = 0.5):
+    '''
+    Returns (universe, rules) of the labels that featureengineer.select_label_funds gives,
+    with the same parameters.
+    '''
+    universe = [
+                {'column' : 'days_of_processed', 'op' : '>', 'value' : min_days_of_processed},
+                {'column' : 'increase_of_one_month', 'op' : '<', 'value' : max_increase_of_one_month},
+                {'column' : 'increase_of_three_months', 'op' : '<', 'value' : max_increase_of_three_months}
+               ]
+
+    rules = [
+                {'name' : 'label_past_one_and_two_month',
+                 'conditions' : [{'top' : 'increase_of_one_month', 'k' : num_of_candidates},
+                                 {'top' : 'increase_of_two_months', 'k' : num_of_candidates},
+                                 {'column' : 'increase_of_two_months', 'op' : '>', 'other' : 'increase_of_one_month', 'factor' : 1.0}]},
+                {'name' : 'label_past_one_month_only',
+                 'conditions' : [{'top' : 'increase_of_one_month', 'k' : num_of_candidates}]}
+            ]
+
+    return universe, rules
+
+
+def top_funds_rule(top_num = 50, min_fund_scale = 5):
+    '''
+    Returns the rule of the targets of featureengineer.MakeTopFundsPlot, the funds in the top top_num
+    of the past one, two and three months whose fund_scale is larger than min_fund_scale.
+    A tie at the top_num-th fund is left out, MakeTopFundsPlot breaks it by the row order.
+    '''
+    return {'name' : 'top_funds',
+            'conditions' : [{'top' : 'increase_of_one_month', 'k' : top_num},
+                            {'top' : 'increase_of_two_months', 'k' : top_num},
+                            {'top' : 'increase_of_three_months', 'k' : top_num},
+                            {'column' : 'fund_scale', 'op' : '>', 'value' : min_fund_scale}]}
+
+
+def label_masks(features, rules, universe = None):
+    '''
+    Compute every label of rules in one pass.
+
+    Inputs:
+        features - DataFrame of the funds, or dict of column --> array whose last axis is the funds,
+                   e.g. (rebalance days x funds), then the ranks are taken on every day at once.
+        rules - list of dict, {'name' : label name, 'conditions' : list of conditions}.
+        universe - list of conditions that a fund must meet to get any label, default is every fund.
+
+    Returns: dict of label name --> bool array of the shape of the feature columns.
+    '''
+    values_of = dict()
+    def values(column):
+        if column not in values_of:
+            values_of[column] = np.asarray(features[column], dtype = float)
+        return values_of[column]
+
+    in_universe = _conditions_mask(values, universe or [], True, {})
+
+    # All the cutoffs of the same k are found in one partial selection over the funds axis,
+    # the funds out of the universe are NaN, which is sorted last.
+    cutoffs = dict()
+    for side in ('top', 'bottom'):
+        columns_of_k = dict()
+        for rule in rules:
+            for condition in rule['conditions']:
+                if side in condition:
+                    columns_of_k.setdefault(condition['k'], set()).add(condition[side])
+
+        for k, columns in columns_of_k.items():
+            columns = sorted(columns)
+            stacked = np.stack([np.where(in_universe, values(column), np.nan) for column in columns])
+            if side == 'bottom':
+                stacked = -stacked
+            kth = ranking.kth_largest(np.moveaxis(stacked, -1, 0), k)
+            for column, cutoff in zip(columns, kth):
+                cutoffs[(side, column, k)] = np.asarray(cutoff)[..., np.newaxis]
+
+    # The masks of the conditions are shared by the rules that have the same condition.
+    masks = dict()
+    labels = dict()
+    for rule in rules:
+        labels[rule['name']] = _conditions_mask(values, rule['conditions'], in_universe, masks, cutoffs)
+
+    return labels
+
+
+def compute_labels(fund_df, rules, universe = None):
+    '''
+    Returns a DataFrame indexed like fund_df, one int column per label of rules,
+    1 for the labeled funds and 0 for the others, see label_masks.
+    '''
+    labels = label_masks(fund_df, rules, universe)
+
+    return pd.DataFrame(dict((name, np.broadcast_to(mask, len(fund_df)).astype(int)) for name, mask in labels.items()),
+                        index = fund_df.index, columns = [rule['name'] for rule in rules])
+
+
+def add_labels(fund_df, rules, universe = None):
+    '''
+    Returns a copy of fund_df with the label columns of rules, existing columns are replaced.
+    '''
+    label_df = compute_labels(fund_df, rules, universe)
+
+    fund_df = fund_df.copy()
+    for column in label_df.columns:
+        fund_df[column] = label_df[column]
+
+    return fund_df
+
+
+def _conditions_mask(values, conditions, mask, masks, cutoffs = None):
+    for condition in conditions:
+        key = repr(sorted(condition.items()))
+        if key not in masks:
+            masks[key] = _condition_mask(values, condition, cutoffs)
+        mask = mask & masks[key]
+
+    return mask
+
+
+def _condition_mask(values, condition, cutoffs):
+    with np.errstate(invalid = 'ignore'):
+        if 'top' in condition:
+            return values(condition['top']) > cutoffs[('top', condition['top'], condition['k'])]
+
+        if 'bottom' in condition:
+            return values(condition['bottom']) < -cutoffs[('bottom', condition['bottom'], condition['k'])]
+
+        compare = OPERATORS[condition['op']]
+
+        if 'other' in condition:
+            return compare(values(condition['column']), values(condition['other']) * condition.get('factor', 1.0))
+
+        return compare(values(condition['column']), condition['value'])
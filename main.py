@@ -1,50 +1,331 @@
-﻿import pandas as pd
-import querydata
-import tushare as ts
-import fetcher
-import datatypes as dt
+﻿'''
+The command line of SmartInvest.
+
+    python main.py                                 fetch everything, like before
+    python main.py fetch basic --fund-types mix bond
+    python main.py fetch history --workers 16 --full
+    python main.py fetch index --start-day 2011-09-11 --end-day 2016-11-15
+    python main.py fetch index --benchmarks sci hs300
+    python main.py features latest --fund-type mix --workers 4
+    python main.py features training --panel-path .\data\processingdata\fund\navpanel
+    python main.py features training --max-memory-mb 2048
+    python main.py label --fund-type mix
+    python main.py plot --label label_past_one_month_only
+    python main.py backtest / sweep / train / predict
+    python main.py snapshot add --prune --dry-run
+    python main.py snapshot restore --day 20161115 --output .\data\restored\20161115
+    python main.py import-time
+
+The metrics of every run are saved to METRICS_PATH as <command>.json and
+<command>.prom, see metrics.py.
+
+Only the modules of the chosen command are imported: tushare is imported by
+fetch, matplotlib by plot and sklearn by train and predict, so a small job
+does not pay for the others when it starts.
+'''
+
+import sys
+import argparse
 import datetime
+
+import datatypes as dt
 import utility
-#import featureengineering as fe
+import metrics
 
 today_string = datetime.date.today().strftime("%Y-%m-%d").replace('-', '')
 ORIGINAL_DATA_PATH  = '.' + dt.sep + 'data' + dt.sep + 'originaldata' + dt.sep + today_string + dt.sep
 ORIGINAL_FUND_DATA_PATH = ORIGINAL_DATA_PATH + 'fund' + dt.sep 
 
+# The responses of tushare, a run that is started again does not send the same requests again.
+RESPONSE_CACHE_PATH = '.' + dt.sep + 'data' + dt.sep + 'cache' + dt.sep + 'responses' + dt.sep
 
+# The deduplicated snapshots of the days in originaldata, see snapshotstore.py.
+SNAPSHOT_PATH = '.' + dt.sep + 'data' + dt.sep + 'snapshots' + dt.sep
 
-if __name__ == "__main__":
-    # Generate all types of funds information to local csv file.
-    # First, save each fund info to a single file.
-    # Second, combine the single files to one file,
-    # For example, save to file .\originaldata\20161116\fundbasic\mixfund_basic.csv.
-    # querydata.generate_fund_basic_data('mix')
-
-    # Generate all funds history information to local csv file.
-    # Like the net value, change every day.
-    # Each fund will be saved to one csv file,
-    # for example, save to file .\originaldata\20161116\fundhistory\mixfund\000363.csv
-    # querydata.generate_fund_history_data('mix')
+# The JSON and Prometheus metrics of the runs, the file of a command is replaced by its next run.
+METRICS_PATH = '.' + dt.sep + 'data' + dt.sep + 'metrics' + dt.sep
 
-    # Get index information and saving to local file.
-    # querydata.generate_shanghai_index_data(end_day = '2016-10-22')
-    # querydata.generate_shanghai_index_data()
+# The fund types to fetch, the union is fetched once and the basic data is also saved per type,
+# e.g. ['all', 'equity', 'mix', 'bond', 'monetary'].
+FUND_TYPES = ['mix']
 
-    ###########################################
-    # Feature engineering
-    # Run in featureengineering.py main() function.
-    # fe.process_fund_daily_data(is_accuracy = True)
+# The modules that import-time measures by default.
+IMPORT_TIME_MODULES = ['main', 'pandas', 'tushare', 'sklearn', 'matplotlib.pyplot',
+                       'fetcher', 'featureengineer', 'backtest', 'model']
 
 
+def fetch(args):
+    import fetcher
+    import responsecache
 
-    fund_types = ['mix']
-    path = utility.check_path(ORIGINAL_FUND_DATA_PATH) + "mix_fund_basic.csv"
+    path = utility.check_path(ORIGINAL_FUND_DATA_PATH) + "fund_basic.csv"
+    type_path = ORIGINAL_FUND_DATA_PATH + "%s_fund_basic.csv"
     history_info_path = utility.check_path(ORIGINAL_FUND_DATA_PATH + 'historyinfo' + dt.sep)
-    sh_index_file = utility.check_path(ORIGINAL_FUND_DATA_PATH) + "sh_index.csv"
+    nav_panel_path = ORIGINAL_FUND_DATA_PATH + 'navpanel' + dt.sep
+
+    # The data of the previous run, the history is only extended with the missing days.
+    previous_data_path = None
+    if not args.full:
+        previous_data_path = utility.find_previous_data_path('.' + dt.sep + 'data' + dt.sep + 'originaldata' + dt.sep, today_string)
+
+    cache = None if args.no_cache else responsecache.ResponseCache(RESPONSE_CACHE_PATH)
+    fc = fetcher.Fecther(cache=cache)
+
+    # Download the symbols of every type once, the types of each symbol are saved for the feature stages.
+    universe = fc.get_symbol_universe(args.fund_types)
+    universe.save(ORIGINAL_FUND_DATA_PATH + "fund_types.csv")
+
+    if args.target in ('basic', 'all'):
+        with metrics.METRICS.stage('fetch_basic'):
+            fc.fetch_fund_basic_data(universe, path, type_path=type_path, max_workers=args.workers)
+
+    if previous_data_path is None:
+        if args.target in ('history', 'all'):
+            with metrics.METRICS.stage('fetch_history'):
+                fc.fetch_fund_history_data(universe, path=history_info_path, start_day=args.start_day, end_day=args.end_day,
+                                           max_workers=args.workers, panel_path=nav_panel_path)
+        if args.target in ('index', 'all'):
+            with metrics.METRICS.stage('fetch_index'):
+                fc.fetch_benchmark_indices(utility.check_path(ORIGINAL_FUND_DATA_PATH), benchmarks=args.benchmarks,
+                                           start_day=args.start_day, end_day=args.end_day)
+    else:
+        previous_fund_data_path = previous_data_path + 'fund' + dt.sep
+        if args.target in ('history', 'all'):
+            with metrics.METRICS.stage('fetch_history'):
+                fc.fetch_fund_history_data(universe, path=history_info_path, start_day=args.start_day, end_day=args.end_day,
+                                           max_workers=args.workers, incremental=True,
+                                           base_path=previous_fund_data_path + 'historyinfo' + dt.sep, panel_path=nav_panel_path)
+        if args.target in ('index', 'all'):
+            with metrics.METRICS.stage('fetch_index'):
+                fc.fetch_benchmark_indices(utility.check_path(ORIGINAL_FUND_DATA_PATH), benchmarks=args.benchmarks,
+                                           start_day=args.start_day, end_day=args.end_day,
+                                           incremental=True, base_path=previous_fund_data_path)
+
+    if cache is not None:
+        metrics.METRICS.increment('response_cache_hits', cache.hits)
+        metrics.METRICS.increment('response_cache_misses', cache.misses)
+
+
+def features(args):
+    import featureengineer as fe
+
+    cache_path = None if args.no_cache else fe.STAGE_CACHE_PATH
+    if args.target == 'latest':
+        fe.GenerateLatestData(args.fund_type, panel_path=args.panel_path, workers=args.workers, cache_path=cache_path,
+                              max_memory_mb=args.max_memory_mb)
+    else:
+        fe.GenerateTrainingData(args.fund_type, panel_path=args.panel_path, workers=args.workers, cache_path=cache_path,
+                                max_memory_mb=args.max_memory_mb)
+
+
+def label(args):
+    import featureengineer as fe
+
+    input_file = args.input or r'.\data\processingdata\%s_fund_merged_latest.csv' %(args.fund_type)
+    fe.GenerateLabelFundsToFiles(input_file, args.fund_type)
+
+
+def plot(args):
+    import featureengineer as fe
+
+    for label_name in args.label or list(fe.LABEL_FILES.keys()):
+        fe.MakeTopFundsPlot(fe.LABEL_FILES[label_name] %(args.fund_type), args.fund_type)
+
+
+def run_backtest(args):
+    import backtest
+
+    backtest.RunBacktest(args.fund_type, panel_path=args.panel_path, step=args.step, holding=args.holding,
+                         output_file_long_path=args.output)
+
+
+def run_sweep(args):
+    import sweep
+
+    sweep.RunSweep(args.fund_type, panel_path=args.panel_path, workers=args.workers, output_file_long_path=args.output)
+
+
+def train(args):
+    import model
+
+    model.TrainModels(args.fund_type, batch_size=args.batch_size, epochs=args.epochs)
+
 
-    fc = fetcher.Fecther()
-    fc.fetch_fund_basic_data(fund_types, path)
-    fc.fetch_fund_history_data(fund_types, path=history_info_path)
-    fc.fetch_shanghai_index(sh_index_file)
+def predict(args):
+    import model
 
+    model.PredictLatest(args.fund_type, batch_size=args.batch_size)
 
+
+def snapshot(args):
+    import os
+    import shutil
+    import navpanel
+    import snapshotstore
+
+    store = snapshotstore.SnapshotStore(SNAPSHOT_PATH)
+    original_path = '.' + dt.sep + 'data' + dt.sep + 'originaldata' + dt.sep
+
+    if args.action == 'add':
+        days = sorted(name for name in os.listdir(original_path)
+                      if name.isdigit() and os.path.isdir(os.path.join(original_path, name)))
+        # Only the days that are not stored yet, unless they are asked for.
+        for day in args.day or [day for day in days if day not in store.days()]:
+            with metrics.METRICS.stage('snapshot_add'):
+                stats = store.add_snapshot(day, os.path.join(original_path, day))
+            print('Stored %s: %d files, %.2fMB in %d chunks, %d new chunks of %.2fMB stored in %.2fMB, skipped %d files of %.2fMB'
+                  %(day, stats['files'], stats['bytes'] / 2**20, stats['chunks'], stats['new_chunks'],
+                    stats['new_bytes'] / 2**20, stats['stored_bytes'] / 2**20, stats['excluded_files'],
+                    stats['excluded_bytes'] / 2**20))
+            metrics.METRICS.increment('snapshot_bytes', stats['bytes'])
+            metrics.METRICS.increment('snapshot_stored_bytes', stats['stored_bytes'])
+
+        # The day that the next fetch extends is kept, and the days after it, only the older stored ones are removed.
+        if args.prune:
+            previous_data_path = utility.find_previous_data_path(original_path, today_string)
+            keep_day = None if previous_data_path is None else os.path.basename(previous_data_path.rstrip('\\/'))
+            prune_days = [day for day in days if keep_day is not None and day < keep_day and day in store.days()
+                          and len(store.verify(day, os.path.join(original_path, day))) == 0]
+
+            if len(prune_days) == 0:
+                print('No stored day to remove from %s' %(original_path))
+            elif args.dry_run:
+                print('Would remove %d stored days from %s: %s' %(len(prune_days), original_path, ' '.join(prune_days)))
+            elif args.yes or _confirm('Remove %d stored days from %s: %s?' %(len(prune_days), original_path, ' '.join(prune_days))):
+                for day in prune_days:
+                    shutil.rmtree(os.path.join(original_path, day))
+                    print('Removed %s, it is in the store' %(day))
+
+    elif args.action == 'restore':
+        for day in args.day or store.days()[-1:]:
+            output = args.output or os.path.join(original_path, day)
+            print('Restored %d files of %s to %s' %(store.materialize(day, output), day, output))
+
+            # The navpanel is not stored, it is built again from the history files.
+            history_path = os.path.join(output, 'fund', 'historyinfo')
+            if os.path.isdir(history_path):
+                panel = navpanel.NavPanelStore(os.path.join(output, 'fund', 'navpanel')).append(navpanel.NavPanel.from_csv_dir(history_path))
+                print('Rebuilt the navpanel of %d funds of %s' %(len(panel), day))
+
+    else:
+        for day in args.day or store.days():
+            bad_paths = store.verify(day)
+            print('%s: %d files%s' %(day, len(store.files(day)), ', %d broken' %(len(bad_paths)) if bad_paths else ''))
+        usage = store.storage_usage()
+        print('%d days in %d chunks, %.2fMB of chunks and %.2fMB of manifests'
+              %(usage['days'], usage['chunks'], usage['chunk_bytes'] / 2**20, usage['manifest_bytes'] / 2**20))
+
+
+def _confirm(question):
+    # No answer, e.g. when the input is not a terminal, is no.
+    try:
+        return input(question + ' [y/N] ').strip().lower() in ('y', 'yes')
+    except EOFError:
+        return False
+
+
+def import_time(args):
+    import benchmark
+
+    benchmark.benchmark_import_times(args.modules or IMPORT_TIME_MODULES, repeat=args.repeat)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Fetch the fund data, make the features and labels, and train the models.')
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser('fetch', help='fetch the basic data, the history and the index of the funds')
+    command.add_argument('target', nargs='?', default='all', choices=['basic', 'history', 'index', 'all'])
+    command.add_argument('--fund-types', nargs='+', default=FUND_TYPES)
+    command.add_argument('--benchmarks', nargs='+', default=None, choices=sorted(dt.BENCHMARKS.keys()),
+                         help='the indices to fetch, default is all of them')
+    command.add_argument('--start-day', default='2011-09-11')
+    command.add_argument('--end-day', default=None, help='default is today')
+    command.add_argument('--workers', type=int, default=16)
+    command.add_argument('--full', action='store_true', help='fetch the whole history, not only the days after the previous run')
+    command.add_argument('--no-cache', action='store_true', help='do not answer from the response cache')
+    command.set_defaults(function=fetch)
+
+    command = commands.add_parser('features', help='make the merged latest or training data')
+    command.add_argument('target', choices=['latest', 'training'])
+    command.add_argument('--fund-type', default='mix')
+    command.add_argument('--panel-path', default=None)
+    command.add_argument('--workers', type=int, default=1)
+    command.add_argument('--max-memory-mb', type=int, default=None, help='process the funds in batches that fit in it')
+    command.add_argument('--no-cache', action='store_true', help='run every stage again')
+    command.set_defaults(function=features)
+
+    command = commands.add_parser('label', help='save the funds of each label')
+    command.add_argument('--fund-type', default='mix')
+    command.add_argument('--input', default=None, help='default is the merged latest data')
+    command.set_defaults(function=label)
+
+    command = commands.add_parser('plot', help='plot the top funds of the labels')
+    command.add_argument('--fund-type', default='mix')
+    command.add_argument('--label', nargs='+', default=None, help='default is every label')
+    command.set_defaults(function=plot)
+
+    command = commands.add_parser('backtest', help='backtest the labels')
+    command.add_argument('--fund-type', default='mix')
+    command.add_argument('--panel-path', default=None)
+    command.add_argument('--step', type=int, default=dt.ONE_MONTH)
+    command.add_argument('--holding', type=int, default=None)
+    command.add_argument('--output', default=None)
+    command.set_defaults(function=run_backtest)
+
+    command = commands.add_parser('sweep', help='backtest a grid of the label thresholds')
+    command.add_argument('--fund-type', default='mix')
+    command.add_argument('--panel-path', default=None)
+    command.add_argument('--workers', type=int, default=1)
+    command.add_argument('--output', default=None)
+    command.set_defaults(function=run_sweep)
+
+    command = commands.add_parser('train', help='train the models of the labels')
+    command.add_argument('--fund-type', default='mix')
+    command.add_argument('--batch-size', type=int, default=4096)
+    command.add_argument('--epochs', type=int, default=5)
+    command.set_defaults(function=train)
+
+    command = commands.add_parser('predict', help='score the latest data with the trained models')
+    command.add_argument('--fund-type', default='mix')
+    command.add_argument('--batch-size', type=int, default=4096)
+    command.set_defaults(function=predict)
+
+    command = commands.add_parser('snapshot', help='store the days of originaldata once, restore them or check them')
+    command.add_argument('action', choices=['add', 'restore', 'report'])
+    command.add_argument('--day', nargs='+', default=None,
+                         help='default is the days not stored yet for add, the latest day for restore and every day for report')
+    command.add_argument('--output', default=None, help='the directory to restore to, default is the day in originaldata')
+    command.add_argument('--prune', action='store_true',
+                         help='remove the stored days from originaldata that are older than the day the next fetch extends')
+    command.add_argument('--dry-run', action='store_true', help='only print the days that --prune would remove')
+    command.add_argument('--yes', action='store_true', help='remove the days without asking')
+    command.set_defaults(function=snapshot)
+
+    command = commands.add_parser('import-time', help='measure the import time of the modules')
+    command.add_argument('modules', nargs='*')
+    command.add_argument('--repeat', type=int, default=3)
+    command.set_defaults(function=import_time)
+
+    # No command fetches everything, like running main.py always did.
+    argv = list(argv)
+    if len(argv) == 0 or (argv[0].startswith('-') and argv[0] not in ('-h', '--help')):
+        argv = ['fetch'] + argv
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    # The metrics are saved even if the command fails, they show how far it went.
+    try:
+        with metrics.METRICS.stage(args.command):
+            args.function(args)
+    finally:
+        json_file, prometheus_file = metrics.METRICS.save(METRICS_PATH, args.command)
+        print('Saved the metrics to %s and %s' %(json_file, prometheus_file))
+
+
+if __name__ == "__main__":
+    main()
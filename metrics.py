@@ -0,0 +1,350 @@
+'''
+Instrumentation of the fetch and feature runs.
+
+The code records into METRICS, the registry of the process: the wall time of
+every stage, the latency of every call of the tushare endpoints, the retries
+and failures of the fetches, the rows and bytes written and the funds that were
+skipped with the reason. At the end of a run main.py saves it as JSON and as a
+Prometheus text file, which the textfile collector of node_exporter can serve.
+
+The worker threads of a fetch share the registry, the worker processes of the
+feature stages do not, so their results are recorded by the calling process.
+'''
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import utility
+
+
+# The upper bounds in seconds of the latency buckets, a slower call is only counted in +Inf.
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# The most symbols of a skip reason that are kept, the count is always exact.
+MAX_SKIPPED_SYMBOLS = 1000
+
+
+class Metrics():
+    """
+    Counters, stage timings and latency histograms, safe to use from many threads.
+
+
+    Parameters
+    ----------
+    prefix : string, default is 'smartinvest'
+        The prefix of the Prometheus metric names.
+    """
+
+    def __init__(self, prefix = 'smartinvest'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+
+            # (name, ((label, value), ...)) --> value
+            self._counters = dict()
+            # stage --> [seconds, runs]
+            self._stages = dict()
+            # endpoint --> [count per bucket, count, sum, max], the counts are not cumulative
+            self._latencies = dict()
+            # reason --> [count, symbols]
+            self._skipped = dict()
+
+
+    def increment(self, name, value = 1, **labels):
+        """
+        Add value to the counter name with labels, e.g. increment('fetch_retries', pipeline = 'history').
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+
+    def counter(self, name, **labels):
+        """
+        Returns the value of a counter, the sum over all its labels if none is given.
+        """
+
+        with self._lock:
+            if labels:
+                return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+            return sum(value for (counter_name, _), value in self._counters.items() if counter_name == name)
+
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the block as the stage name, the time of a stage that runs again is added up.
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            with self._lock:
+                stage = self._stages.setdefault(name, [0.0, 0])
+                stage[0] += seconds
+                stage[1] += 1
+
+
+    def observe_latency(self, endpoint, seconds):
+        with self._lock:
+            latency = self._latencies.get(endpoint)
+            if latency is None:
+                latency = self._latencies[endpoint] = [[0] * len(LATENCY_BUCKETS), 0, 0.0, 0.0]
+
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    latency[0][i] += 1
+                    break
+            latency[1] += 1
+            latency[2] += seconds
+            latency[3] = max(latency[3], seconds)
+
+
+    def timed(self, endpoint, function):
+        """
+        Returns function that records the latency of every call as endpoint,
+        a call that raises is also counted in api_errors.
+        """
+
+        def timed_function(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                self.increment('api_errors', endpoint = endpoint)
+                raise
+            finally:
+                self.observe_latency(endpoint, time.time() - start)
+
+        return timed_function
+
+
+    def add_written(self, file_long_path, rows, num_bytes = None, kind = 'csv'):
+        """
+        Count rows and bytes written to a file, num_bytes is the size of the file if it is None.
+        kind labels the counters, e.g. 'fund_history', one label per file would be too many.
+        """
+
+        if num_bytes is None:
+            num_bytes = os.path.getsize(file_long_path) if os.path.exists(file_long_path) else 0
+
+        self.increment('rows_written', rows, kind = kind)
+        self.increment('bytes_written', num_bytes, kind = kind)
+        self.increment('files_written', 1, kind = kind)
+
+
+    def skip(self, reason, symbols):
+        """
+        Record the funds that were skipped for reason.
+        """
+
+        symbols = [str(symbol) for symbol in symbols]
+        with self._lock:
+            skipped = self._skipped.setdefault(reason, [0, list()])
+            skipped[0] += len(symbols)
+            skipped[1].extend(symbols[:max(0, MAX_SKIPPED_SYMBOLS - len(skipped[1]))])
+
+
+    def to_dict(self):
+        """
+        Returns the metrics as a dict that json can save.
+        """
+
+        with self._lock:
+            latencies = dict()
+            for endpoint, (buckets, count, total, slowest) in sorted(self._latencies.items()):
+                cumulative = 0
+                counts = dict()
+                for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                    cumulative += bucket_count
+                    counts[repr(bound)] = cumulative
+                counts['+Inf'] = count
+                latencies[endpoint] = {'buckets' : counts, 'count' : count, 'sum' : total,
+                                       'mean' : total / count if count > 0 else None, 'max' : slowest}
+
+            return {
+                        'started' : time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                        'elapsed_seconds' : time.time() - self.started,
+                        'stages' : dict((name, {'seconds' : seconds, 'runs' : runs})
+                                        for name, (seconds, runs) in self._stages.items()),
+                        'counters' : [{'name' : name, 'labels' : dict(labels), 'value' : value}
+                                      for (name, labels), value in sorted(self._counters.items())],
+                        'latency_seconds' : latencies,
+                        'skipped' : dict((reason, {'count' : count, 'symbols' : symbols})
+                                         for reason, (count, symbols) in sorted(self._skipped.items()))
+                   }
+
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+
+        values = self.to_dict()
+        lines = list()
+
+        def add(name, kind, help_text, samples):
+            if len(samples) == 0:
+                return
+            name = '%s_%s' %(self.prefix, name)
+            lines.append('# HELP %s %s' %(name, help_text))
+            lines.append('# TYPE %s %s' %(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('%s%s%s %s' %(name, suffix, _format_labels(labels), _format_value(value)))
+
+        add('run_seconds', 'gauge', 'Wall time of the run so far.', [('', {}, values['elapsed_seconds'])])
+
+        add('stage_seconds_total', 'counter', 'Wall time of each stage.',
+            [('', {'stage' : name}, stage['seconds']) for name, stage in values['stages'].items()])
+        add('stage_runs_total', 'counter', 'Number of times each stage ran.',
+            [('', {'stage' : name}, stage['runs']) for name, stage in values['stages'].items()])
+
+        counters = dict()
+        for counter in values['counters']:
+            counters.setdefault(counter['name'], list()).append(('', counter['labels'], counter['value']))
+        for name, samples in sorted(counters.items()):
+            add(name + '_total', 'counter', 'Number of %s.' %(name.replace('_', ' ')), samples)
+
+        samples = list()
+        for endpoint, latency in values['latency_seconds'].items():
+            for bound, count in latency['buckets'].items():
+                samples.append(('_bucket', {'endpoint' : endpoint, 'le' : bound}, count))
+            samples.append(('_sum', {'endpoint' : endpoint}, latency['sum']))
+            samples.append(('_count', {'endpoint' : endpoint}, latency['count']))
+        add('api_latency_seconds', 'histogram', 'Latency of the calls of each endpoint.', samples)
+
+        add('funds_skipped_total', 'counter', 'Number of funds skipped for each reason.',
+            [('', {'reason' : reason}, skipped['count']) for reason, skipped in values['skipped'].items()])
+
+        return '\n'.join(lines) + '\n'
+
+
+    def save(self, path, name):
+        """
+        Save the metrics to path as name.json and name.prom.
+
+        Returns: (json file, prometheus file)
+        """
+
+        json_file = os.path.join(utility.check_path(path), name + '.json')
+        prometheus_file = os.path.join(path, name + '.prom')
+
+        # Write to a temporary file first, a collector never reads a half written file.
+        for file_spec, text in ((json_file, json.dumps(self.to_dict(), indent = 2, sort_keys = True)),
+                                (prometheus_file, self.to_prometheus())):
+            with open(file_spec + '.tmp', 'w', encoding = 'utf-8') as f:
+                f.write(text)
+            os.replace(file_spec + '.tmp', file_spec)
+
+        return json_file, prometheus_file
+
+
+class InstrumentedApi():
+    """
+    Wrap tushare, tushare.fund.nav or a fake of them and time every call of their functions.
+
+    Like responsecache.CachedApi, any attribute that is not callable is passed to the api.
+
+
+    Parameters
+    ----------
+    api : module or object
+
+    metrics : Metrics, default is METRICS
+    """
+
+    def __init__(self, api, metrics = None):
+        self.api = api
+        self.metrics = METRICS if metrics is None else metrics
+
+
+    def __getattr__(self, name):
+        function = getattr(self.api, name)
+        if name.startswith('_') or not callable(function):
+            return function
+
+        return self.metrics.timed(name, function)
+
+
+class ProgressLogger():
+    """
+    Print the progress of a long loop at most once every interval seconds,
+    instead of one line or one redraw per item.
+
+
+    Parameters
+    ----------
+    name : string
+        What is done, e.g. 'Fetching history'.
+
+    total : int
+
+    interval : float, default is 10
+        The least seconds between two lines.
+    """
+
+    def __init__(self, name, total, interval = 10.0):
+        self.name = name
+        self.total = total
+        self.interval = interval
+
+        self.done = 0
+        self.failed = 0
+        self._started = time.time()
+        self._printed = self._started
+
+
+    def update(self, done = 1, failed = 0):
+        self.done += done
+        self.failed += failed
+
+        now = time.time()
+        if now - self._printed >= self.interval:
+            self._printed = now
+            self._print(now)
+
+
+    def close(self):
+        self._print(time.time())
+
+
+    def _print(self, now):
+        # The failed items are finished too, only not done.
+        finished = self.done + self.failed
+        seconds = now - self._started
+        rate = finished / seconds if seconds > 0 else 0.0
+
+        line = '%s: %d/%d done, %d failed, %.1f/s' %(self.name, self.done, self.total, self.failed, rate)
+        if 0 < rate and finished < self.total:
+            line += ', %.0fs left' %((self.total - finished) / rate)
+        print(line)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' %(','.join('%s="%s"' %(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in sorted(labels.items())))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+
+# The registry of the process.
+METRICS = Metrics()
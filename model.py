@@ -0,0 +1,340 @@
+'''
+Train the label models on the merged training data and score the latest data.
+
+The merged csv files are turned into numeric feature matrices once, read in
+chunks and written to .npy files that are memory-mapped afterwards, so a
+matrix is never in memory as a whole. The models are fitted with partial_fit
+batch by batch, and the latest funds are scored batch by batch too.
+'''
+
+import os
+import json
+import time
+import pickle
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import SGDClassifier
+from sklearn.preprocessing import StandardScaler
+
+import utility
+import pipeline
+
+
+# The directory that the feature matrices are cached in, one directory per source file version.
+MATRIX_CACHE_PATH = r'.\data\processingdata\cache\matrix'
+
+# The directory that the fitted models are saved in.
+MODEL_PATH = r'.\data\processingdata\model'
+
+# The columns that are not features: the labels, and the increases of the training data,
+# which are the latest ones that the labels are made of.
+EXCLUDED_PREFIXES = ['label_', 'increase_of_']
+
+
+class FeatureMatrix():
+    """
+    The numeric features and the labels of the funds, saved as .npy files in a directory.
+
+    features.npy is float32 of funds x feature columns, NaN where the value is missing,
+    labels.npy is int8 of funds x label columns.
+
+
+    Parameters
+    ----------
+    path : string
+        The directory of the matrix.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, 'columns.json'), 'r', encoding = 'utf-8') as f:
+            columns = json.load(f)
+        self.feature_columns = columns['features']
+        self.label_columns = columns['labels']
+
+        self.symbols  = np.load(os.path.join(path, 'symbols.npy'))
+        self.features = np.load(os.path.join(path, 'features.npy'), mmap_mode = 'r')
+        self.labels   = np.load(os.path.join(path, 'labels.npy'), mmap_mode = 'r')
+
+
+    @classmethod
+    def build(cls, file_long_path, path, feature_columns = None, label_columns = None, chunksize = 10000):
+        """
+        Read a merged csv file in chunks and save its matrix to path.
+
+        Parameters
+        ----------
+        file_long_path : string
+            The merged file, e.g. mix_fund_merged_training.csv.
+
+        path : string
+            The directory of the matrix.
+
+        feature_columns : list of string, default is the numeric columns of the first chunk
+            that do not start with EXCLUDED_PREFIXES. The missing columns are NaN.
+
+        label_columns : list of string, default is the columns that start with label_
+
+        chunksize : int, default is 10000
+            The rows that are read at a time.
+        """
+
+        # Count the rows first, so the matrix is written in place chunk by chunk.
+        num_of_rows = 0
+        for chunk in pd.read_csv(file_long_path, encoding = 'utf-8', usecols = ['symbol'], dtype = {'symbol' : str}, chunksize = chunksize):
+            num_of_rows += len(chunk)
+
+        utility.check_path(path)
+
+        features = labels = None
+        symbols = list()
+        row = 0
+        for chunk in pd.read_csv(file_long_path, encoding = 'utf-8', dtype = {'symbol' : str}, chunksize = chunksize):
+            chunk = chunk.set_index('symbol')
+
+            if features is None:
+                if feature_columns is None:
+                    feature_columns = [column for column in chunk.select_dtypes(include = [np.number]).columns
+                                       if not any(column.startswith(prefix) for prefix in EXCLUDED_PREFIXES)]
+                if label_columns is None:
+                    label_columns = [column for column in chunk.columns if column.startswith('label_')]
+
+                features = np.lib.format.open_memmap(os.path.join(path, 'features.npy.tmp'), mode = 'w+',
+                                                     dtype = np.float32, shape = (num_of_rows, len(feature_columns)))
+                labels = np.lib.format.open_memmap(os.path.join(path, 'labels.npy.tmp'), mode = 'w+',
+                                                   dtype = np.int8, shape = (num_of_rows, len(label_columns)))
+
+            values = chunk.reindex(columns = feature_columns).apply(pd.to_numeric, errors = 'coerce')
+            features[row:row + len(chunk)] = values.to_numpy(dtype = np.float32)
+            labels[row:row + len(chunk)] = chunk.reindex(columns = label_columns).fillna(0).to_numpy(dtype = np.int8)
+            symbols.extend(chunk.index.astype(str))
+            row += len(chunk)
+
+        if features is None:
+            raise ValueError('There is no fund in %s' %(file_long_path))
+
+        features.flush()
+        labels.flush()
+        del features, labels
+
+        # Replace the files only when all of them are written.
+        np.save(os.path.join(path, 'symbols.npy'), np.asarray(symbols, dtype = str))
+        os.replace(os.path.join(path, 'features.npy.tmp'), os.path.join(path, 'features.npy'))
+        os.replace(os.path.join(path, 'labels.npy.tmp'), os.path.join(path, 'labels.npy'))
+        with open(os.path.join(path, 'columns.json'), 'w', encoding = 'utf-8') as f:
+            json.dump({'features' : list(feature_columns), 'labels' : list(label_columns)}, f)
+
+        return cls(path)
+
+
+    @classmethod
+    def cached(cls, file_long_path, cache_path = MATRIX_CACHE_PATH, feature_columns = None, label_columns = None):
+        """
+        Returns the matrix of a merged csv file, built only if the file changed since it was cached.
+        """
+
+        key = pipeline.stage_key('matrix', {'file' : os.path.basename(file_long_path),
+                                            'feature_columns' : feature_columns, 'label_columns' : label_columns},
+                                 inputs = [pipeline.path_fingerprint(file_long_path)])
+        path = os.path.join(cache_path, key)
+
+        if os.path.exists(os.path.join(path, 'columns.json')):
+            print('Feature matrix of %s is cached in %s' %(file_long_path, path))
+            return cls(path)
+
+        print('Building the feature matrix of %s...' %(file_long_path))
+        return cls.build(file_long_path, path, feature_columns, label_columns)
+
+
+    def __len__(self):
+        return len(self.symbols)
+
+
+    def batches(self, batch_size):
+        """
+        Yield (start, stop) of the rows of every batch.
+        """
+
+        for start in range(0, len(self), batch_size):
+            yield start, min(start + batch_size, len(self))
+
+
+class LabelModel():
+    """
+    A linear model of one label, fitted batch by batch.
+
+    The features are standardized with the mean and the deviation of the training data,
+    the missing values are the mean. The two classes are weighted by their counts,
+    few funds have a label.
+
+
+    Parameters
+    ----------
+    label_name : string
+
+    feature_columns : list of string
+
+    random_state : int, default is 0
+    """
+
+    def __init__(self, label_name, feature_columns, random_state = 0):
+        self.label_name = label_name
+        self.feature_columns = list(feature_columns)
+
+        self.scaler = StandardScaler()
+        self.classifier = SGDClassifier(loss = 'log_loss', alpha = 1e-4, random_state = random_state)
+        self.class_weights = None
+
+
+    def fit(self, matrix, batch_size = 4096, epochs = 5, random_state = 0):
+        """
+        Fit the model to a FeatureMatrix, one batch in memory at a time.
+        """
+
+        label = matrix.label_columns.index(self.label_name)
+
+        # The first pass learns the scaling and the class counts.
+        class_counts = np.zeros(2)
+        for start, stop in matrix.batches(batch_size):
+            self.scaler.partial_fit(np.asarray(matrix.features[start:stop], dtype = float))
+            class_counts += np.bincount(np.asarray(matrix.labels[start:stop, label]), minlength = 2)[:2]
+
+        self.class_weights = class_counts.sum() / (2 * np.maximum(class_counts, 1))
+
+        random_state = np.random.RandomState(random_state)
+        batches = list(matrix.batches(batch_size))
+        for _ in range(epochs):
+            for i in random_state.permutation(len(batches)):
+                start, stop = batches[i]
+                y = np.asarray(matrix.labels[start:stop, label], dtype = int)
+                self.classifier.partial_fit(self.transform(matrix.features[start:stop]), y, classes = [0, 1],
+                                            sample_weight = self.class_weights[y])
+
+        return self
+
+
+    def transform(self, features):
+        X = self.scaler.transform(np.asarray(features, dtype = float))
+
+        # The missing values are the mean, which is 0 after the scaling.
+        return np.nan_to_num(X, nan = 0.0, posinf = 0.0, neginf = 0.0)
+
+
+    def predict_proba(self, features):
+        """
+        Returns the probability of the label of each row.
+        """
+
+        return self.classifier.predict_proba(self.transform(features))[:, 1]
+
+
+def train_models(matrix, batch_size = 4096, epochs = 5):
+    '''
+    Fit one LabelModel per label column of matrix.
+
+    Returns: (models, report)
+        models - dict of label name --> LabelModel.
+        report - dict of label name --> {'rows', 'seconds', 'rows_per_second'}, the rows of all the epochs.
+    '''
+    models = dict()
+    report = dict()
+    for label_name in matrix.label_columns:
+        start_time = time.perf_counter()
+        models[label_name] = LabelModel(label_name, matrix.feature_columns).fit(matrix, batch_size, epochs)
+        seconds = time.perf_counter() - start_time
+
+        report[label_name] = {'rows' : len(matrix) * epochs, 'seconds' : seconds,
+                              'rows_per_second' : len(matrix) * epochs / max(seconds, 1e-9)}
+        print('Trained %s on %s funds in %.3f s' %(label_name, len(matrix), seconds))
+
+    return models, report
+
+
+def predict(models, matrix, batch_size = 4096):
+    '''
+    Score the funds of matrix with every model, one batch at a time.
+
+    Returns: (predict_df, report)
+        predict_df - DataFrame indexed by symbol, the probability of each label.
+        report - {'rows', 'seconds', 'rows_per_second'}.
+    '''
+    start_time = time.perf_counter()
+
+    probabilities = dict((label_name, np.empty(len(matrix))) for label_name in models)
+    for start, stop in matrix.batches(batch_size):
+        batch = np.asarray(matrix.features[start:stop])
+        for label_name, model in models.items():
+            features = batch
+            if model.feature_columns != matrix.feature_columns:
+                features = pd.DataFrame(batch, columns = matrix.feature_columns).reindex(columns = model.feature_columns).values
+            probabilities[label_name][start:stop] = model.predict_proba(features)
+
+    seconds = time.perf_counter() - start_time
+
+    predict_df = pd.DataFrame(probabilities, index = pd.Index(matrix.symbols, name = 'symbol'), columns = list(models.keys()))
+
+    return predict_df, {'rows' : len(matrix), 'seconds' : seconds, 'rows_per_second' : len(matrix) / max(seconds, 1e-9)}
+
+
+def TrainModels(fund_type = 'mix', batch_size = 4096, epochs = 5, cache_path = MATRIX_CACHE_PATH, model_path = MODEL_PATH):
+    '''
+    Train the models of the labels on %s_fund_merged_training.csv and save them.
+
+    Returns: (models, report), see train_models.
+    '''
+    matrix = FeatureMatrix.cached(r'.\data\processingdata\%s_fund_merged_training.csv' %(fund_type), cache_path)
+    print('Training on %s funds with %s features' %(len(matrix), len(matrix.feature_columns)))
+
+    models, report = train_models(matrix, batch_size, epochs)
+
+    model_file = os.path.join(utility.check_path(model_path), '%s_models.pkl' %(fund_type))
+    with open(model_file, 'wb') as f:
+        pickle.dump(models, f, protocol = pickle.HIGHEST_PROTOCOL)
+    print('Saved %s models to %s' %(len(models), model_file))
+
+    return models, report
+
+
+def PredictLatest(fund_type = 'mix', batch_size = 4096, cache_path = MATRIX_CACHE_PATH, model_path = MODEL_PATH):
+    '''
+    Score %s_fund_merged_latest.csv with the saved models and save the probabilities, the most likely first.
+
+    Returns: (predict_df, report), see predict.
+    '''
+    with open(os.path.join(model_path, '%s_models.pkl' %(fund_type)), 'rb') as f:
+        models = pickle.load(f)
+
+    feature_columns = next(iter(models.values())).feature_columns
+    matrix = FeatureMatrix.cached(r'.\data\processingdata\%s_fund_merged_latest.csv' %(fund_type), cache_path,
+                                  feature_columns = feature_columns, label_columns = [])
+
+    predict_df, report = predict(models, matrix, batch_size)
+    predict_df = predict_df.sort_values(by = list(models.keys())[0], ascending = False, kind = 'mergesort')
+
+    output_file_long_path = r'.\data\processingdata\%s_fund_predictions.csv' %(fund_type)
+    predict_df.to_csv(output_file_long_path, encoding = 'utf-8')
+    print('Saved the predictions of %s funds to %s' %(len(predict_df), output_file_long_path))
+    print('Scored %s funds in %.3f s, %.0f funds per second' %(report['rows'], report['seconds'], report['rows_per_second']))
+
+    return predict_df, report
+
+
+def TrainAndPredict(fund_type = 'mix', batch_size = 4096, epochs = 5):
+    '''
+    Train the models, score the latest data and report the time of both.
+
+    Returns: dict, the training report of each label and the prediction report.
+    '''
+    _, train_report = TrainModels(fund_type, batch_size, epochs)
+    _, predict_report = PredictLatest(fund_type, batch_size)
+
+    for label_name, label_report in train_report.items():
+        print('%s: trained in %.3f s, %.0f rows per second' %(label_name, label_report['seconds'], label_report['rows_per_second']))
+
+    return {'training' : train_report, 'prediction' : predict_report}
+
+
+if __name__ == "__main__":
+    TrainAndPredict()
@@ -0,0 +1,607 @@
+'''
+Columnar storage of the fund history.
+
+All funds' value/total/change series are kept in one panel of dates x symbols
+instead of one csv file per fund. On disk every field is a .npy file that can
+be memory-mapped, so a reader can slice symbols and date ranges without
+parsing any text.
+'''
+
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+import utility
+import datatypes as dy
+
+
+# The fields that nav.get_nav_history() returns.
+FIELDS = ['value', 'total', 'change']
+
+
+class NavPanel():
+    """
+    The history of many funds on one shared calendar.
+
+
+    Parameters
+    ----------
+    dates : array of datetime64[D]
+        The trading days, ascending.
+
+    symbols : array of string
+        The fund symbols.
+
+    data : dict
+        field --> 2-D float array, shape is (len(dates), len(symbols)).
+        NaN where the fund has no value on that day.
+
+    present : 2-D bool array, default is any field not NaN
+        True where the fund has a row on that day.
+    """
+
+    def __init__(self, dates, symbols, data, present = None):
+        self.dates   = np.asarray(dates, dtype = 'datetime64[D]')
+        self.symbols = np.asarray(symbols, dtype = str)
+        self.data    = data
+
+        if present is None:
+            present = np.zeros((len(self.dates), len(self.symbols)), dtype = bool)
+            for field in data:
+                present |= ~np.isnan(data[field])
+        self.present = present
+
+        self._positions = None
+
+
+    @classmethod
+    def from_frames(cls, frames, fields = None):
+        """
+        Build a panel from the per fund frames.
+
+        Parameters
+        ----------
+        frames : dict
+            symbol --> DataFrame indexed by date, like nav.get_nav_history() returns
+            or pd.read_csv(fund_file, index_col = 'date') reads.
+
+        fields : list of string, default is FIELDS
+        """
+
+        if fields is None:
+            fields = FIELDS
+
+        symbols = sorted(frames.keys())
+        fund_dates = [pd.to_datetime(frames[symbol].index).values.astype('datetime64[D]') for symbol in symbols]
+
+        if len(fund_dates) > 0:
+            dates = np.unique(np.concatenate(fund_dates))
+        else:
+            dates = np.array([], dtype = 'datetime64[D]')
+
+        data = dict((field, np.full((len(dates), len(symbols)), np.nan)) for field in fields)
+        present = np.zeros((len(dates), len(symbols)), dtype = bool)
+
+        for column, symbol in enumerate(symbols):
+            rows = np.searchsorted(dates, fund_dates[column])
+            present[rows, column] = True
+            for field in fields:
+                if field in frames[symbol].columns:
+                    data[field][rows, column] = frames[symbol][field].values
+
+        return cls(dates, symbols, data, present)
+
+
+    @classmethod
+    def from_csv_dir(cls, path, fields = None):
+        """
+        Build a panel from a directory of per fund csv files, e.g. historyinfo.
+        """
+
+        frames = dict()
+        for file_name in os.listdir(path):
+            fund_symbol = file_name.split('.')[0]
+            frames[fund_symbol] = pd.read_csv(path + dy.sep + file_name, index_col = 'date')
+
+        return cls.from_frames(frames, fields)
+
+
+    def __len__(self):
+        return len(self.symbols)
+
+
+    def fields(self):
+        return list(self.data.keys())
+
+
+    def memory_usage(self):
+        """
+        Returns dict of part --> bytes, and total.
+        """
+
+        usage = {'dates' : self.dates.nbytes, 'symbols' : self.symbols.nbytes, 'present' : np.asarray(self.present).nbytes}
+        for field in self.data:
+            usage[field] = np.asarray(self.data[field]).nbytes
+        usage['total'] = sum(usage.values())
+
+        return usage
+
+
+    def positions(self, symbols):
+        """
+        Returns the column of each symbol in the panel.
+        """
+
+        if self._positions is None:
+            self._positions = dict((symbol, i) for i, symbol in enumerate(self.symbols))
+
+        return np.array([self._positions[symbol] for symbol in symbols], dtype = int)
+
+
+    def select(self, symbols = None, start = None, end = None):
+        """
+        Returns a panel with only the given symbols and the dates between start and end, both included.
+        """
+
+        first, last = self._date_range(start, end)
+
+        if symbols is None:
+            columns = slice(None)
+        else:
+            columns = self.positions(symbols)
+
+        data = dict((field, np.asarray(array[first:last][:, columns])) for field, array in self.data.items())
+
+        return NavPanel(self.dates[first:last], self.symbols[columns], data, np.asarray(self.present[first:last][:, columns]))
+
+
+    def frame(self, field):
+        """
+        Returns one field as a DataFrame, index is date and columns are the symbols.
+        """
+
+        return pd.DataFrame(self.data[field], index = pd.Index(self.dates, name = 'date'), columns = self.symbols)
+
+
+    def fund_frame(self, symbol):
+        """
+        Returns the history of one fund the same way as it is read from its csv file:
+        indexed by the date string, the latest day first.
+        """
+
+        column = self.positions([symbol])[0]
+        rows = np.flatnonzero(self.present[:, column])[::-1]
+
+        index = pd.Index(self.dates[rows].astype(str), name = 'date')
+
+        return pd.DataFrame(dict((field, self.data[field][rows, column]) for field in self.data),
+                            index = index, columns = self.fields())
+
+
+    def latest_rows(self, num_days, fields = None):
+        """
+        Stack the latest num_days rows of every fund, the latest day first,
+        the same rows as per_fund_df[:num_days] of the csv file.
+
+        Returns: (dates, data, lengths)
+            dates   - 2-D int64 array of shape (len(symbols), num_days), days since 1970-01-01, -1 after the last row.
+            data    - dict of field --> 2-D float array of the same shape, NaN after the last row.
+            lengths - number of rows of each fund, at most num_days.
+        """
+
+        if fields is None:
+            fields = self.fields()
+
+        # Count the rows of each fund from the latest day backward.
+        present = np.asarray(self.present)[::-1]
+        rank = np.cumsum(present, axis = 0) - 1
+        rows, columns = np.nonzero(present & (rank < num_days))
+        ranks = rank[rows, columns]
+
+        dates = np.full((len(self.symbols), num_days), -1, dtype = np.int64)
+        dates[columns, ranks] = self.dates[::-1][rows].astype(np.int64)
+
+        data = dict()
+        for field in fields:
+            data[field] = np.full((len(self.symbols), num_days), np.nan)
+            data[field][columns, ranks] = np.asarray(self.data[field])[::-1][rows, columns]
+
+        lengths = np.minimum(present.sum(axis = 0), num_days)
+
+        return dates, data, lengths
+
+
+    def merge(self, other):
+        """
+        Merge other panel into this one, the rows of other win when both have a value on the same day.
+        """
+
+        dates   = np.union1d(self.dates, other.dates)
+        symbols = np.union1d(self.symbols, other.symbols)
+        fields  = self.fields() + [field for field in other.fields() if field not in self.data]
+
+        data = dict((field, np.full((len(dates), len(symbols)), np.nan)) for field in fields)
+        present = np.zeros((len(dates), len(symbols)), dtype = bool)
+
+        for panel in (self, other):
+            rows    = np.searchsorted(dates, panel.dates)[:, np.newaxis]
+            columns = np.searchsorted(symbols, panel.symbols)[np.newaxis, :]
+            for field in panel.data:
+                target = data[field][rows, columns]
+                data[field][rows, columns] = np.where(panel.present, panel.data[field], target)
+            present[rows, columns] |= panel.present
+
+        return NavPanel(dates, symbols, data, present)
+
+
+    def _date_range(self, start, end):
+        first = 0 if start is None else np.searchsorted(self.dates, np.datetime64(start, 'D'), side = 'left')
+        last  = len(self.dates) if end is None else np.searchsorted(self.dates, np.datetime64(end, 'D'), side = 'right')
+
+        return first, last
+
+
+class CompactNavHistory():
+    """
+    The history of many funds in a compact layout, for holding a whole universe in memory.
+
+    Only the rows that each fund has are kept, one after another, the oldest first.
+    The values are float32 and the date of a row is an int32 position in one
+    shared trading calendar, so no fund has its own date index and a fund that
+    was set up late takes no room before its first day.
+
+
+    Parameters
+    ----------
+    calendar : array of datetime64[D]
+        The trading days of all the funds, ascending.
+
+    symbols : array of string
+        The fund symbols.
+
+    offsets : int64 array of len(symbols) + 1
+        The rows of the i-th fund are offsets[i]:offsets[i + 1].
+
+    days : int32 array
+        The position in calendar of each row.
+
+    data : dict
+        field --> float32 array, one value per row.
+    """
+
+    def __init__(self, calendar, symbols, offsets, days, data):
+        self.calendar = np.asarray(calendar, dtype = 'datetime64[D]')
+        self.symbols  = np.asarray(symbols, dtype = str)
+        self.offsets  = np.asarray(offsets, dtype = np.int64)
+        self.days     = np.asarray(days, dtype = np.int32)
+        self.data     = dict((field, np.asarray(values, dtype = np.float32)) for field, values in data.items())
+
+        self._positions = None
+
+
+    @classmethod
+    def from_frames(cls, frames, fields = None):
+        """
+        Build the history from the per fund frames, see NavPanel.from_frames.
+        """
+
+        return cls._from_items(((symbol, frames[symbol]) for symbol in sorted(frames.keys())), fields)
+
+
+    @classmethod
+    def from_csv_dir(cls, path, fields = None):
+        """
+        Build the history from a directory of per fund csv files, e.g. historyinfo.
+        The files are read one at a time, only the compact rows are kept.
+        """
+
+        file_names = sorted(file_name for file_name in os.listdir(path) if file_name.endswith('.csv'))
+
+        return cls._from_items(((file_name.split('.')[0], pd.read_csv(path + dy.sep + file_name, index_col = 'date'))
+                                for file_name in file_names), fields)
+
+
+    @classmethod
+    def from_panel(cls, panel):
+        """
+        Build the history from a NavPanel.
+        """
+
+        present = np.asarray(panel.present)
+        columns, rows = np.nonzero(present.T)
+
+        offsets = np.zeros(len(panel.symbols) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum(present.sum(axis = 0))
+
+        return cls(panel.dates, panel.symbols, offsets, rows,
+                   dict((field, np.asarray(panel.data[field])[rows, columns]) for field in panel.fields()))
+
+
+    @classmethod
+    def _from_items(cls, items, fields):
+        if fields is None:
+            fields = FIELDS
+
+        symbols = list()
+        fund_days = list()
+        fund_values = dict((field, list()) for field in fields)
+        for symbol, fund_df in items:
+            fund_df = fund_df.sort_index()
+            symbols.append(symbol)
+            fund_days.append(pd.to_datetime(fund_df.index).values.astype('datetime64[D]'))
+            for field in fields:
+                if field in fund_df.columns:
+                    fund_values[field].append(fund_df[field].values.astype(np.float32))
+                else:
+                    fund_values[field].append(np.full(len(fund_df), np.nan, dtype = np.float32))
+
+        offsets = np.zeros(len(symbols) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum([len(days) for days in fund_days])
+
+        if len(fund_days) > 0:
+            all_days = np.concatenate(fund_days)
+        else:
+            all_days = np.array([], dtype = 'datetime64[D]')
+        calendar = np.unique(all_days)
+
+        data = dict((field, np.concatenate(values) if len(values) > 0 else np.array([], dtype = np.float32))
+                    for field, values in fund_values.items())
+
+        return cls(calendar, symbols, offsets, np.searchsorted(calendar, all_days), data)
+
+
+    def __len__(self):
+        return len(self.symbols)
+
+
+    def fields(self):
+        return list(self.data.keys())
+
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+    def positions(self, symbols):
+        """
+        Returns the index of each symbol.
+        """
+
+        if self._positions is None:
+            self._positions = dict((symbol, i) for i, symbol in enumerate(self.symbols))
+
+        return np.array([self._positions[symbol] for symbol in symbols], dtype = int)
+
+
+    def fund_frame(self, symbol):
+        """
+        Returns the history of one fund the same way as it is read from its csv file:
+        indexed by the date string, the latest day first, the values are float64.
+        """
+
+        i = self.positions([symbol])[0]
+        rows = np.arange(self.offsets[i], self.offsets[i + 1])[::-1]
+
+        index = pd.Index(self.calendar[self.days[rows]].astype(str), name = 'date')
+
+        return pd.DataFrame(dict((field, self.data[field][rows].astype(float)) for field in self.data),
+                            index = index, columns = self.fields())
+
+
+    def latest_rows(self, num_days, fields = None):
+        """
+        Stack the latest num_days rows of every fund, the latest day first, see NavPanel.latest_rows.
+        The values are the float32 values as float64.
+        """
+
+        if fields is None:
+            fields = self.fields()
+
+        lengths = np.minimum(self.lengths(), num_days)
+
+        # The rank of each taken row from the latest one of its fund.
+        columns = np.repeat(np.arange(len(self.symbols)), lengths)
+        ranks = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        rows = self.offsets[1:][columns] - 1 - ranks
+
+        dates = np.full((len(self.symbols), num_days), -1, dtype = np.int64)
+        dates[columns, ranks] = self.calendar[self.days[rows]].astype(np.int64)
+
+        data = dict()
+        for field in fields:
+            data[field] = np.full((len(self.symbols), num_days), np.nan)
+            data[field][columns, ranks] = self.data[field][rows]
+
+        return dates, data, lengths
+
+
+    def to_panel(self, dtype = float):
+        """
+        Returns the NavPanel of the history, the values are of dtype.
+        """
+
+        columns = np.repeat(np.arange(len(self.symbols)), self.lengths())
+
+        present = np.zeros((len(self.calendar), len(self.symbols)), dtype = bool)
+        present[self.days, columns] = True
+
+        data = dict()
+        for field, values in self.data.items():
+            data[field] = np.full((len(self.calendar), len(self.symbols)), np.nan, dtype = dtype)
+            data[field][self.days, columns] = values
+
+        return NavPanel(self.calendar, self.symbols, data, present)
+
+
+    def memory_usage(self):
+        """
+        Returns dict of part --> bytes, and total.
+        """
+
+        usage = {'calendar' : self.calendar.nbytes, 'symbols' : self.symbols.nbytes,
+                 'offsets' : self.offsets.nbytes, 'days' : self.days.nbytes}
+        for field in self.data:
+            usage[field] = self.data[field].nbytes
+        usage['total'] = sum(usage.values())
+
+        return usage
+
+
+def frames_memory_usage(frames):
+    '''
+    Returns the bytes of the per fund frames, their string date indexes included,
+    e.g. of pd.read_csv(fund_file, index_col = 'date') of every fund.
+    '''
+    return int(sum(fund_df.memory_usage(index = True, deep = True).sum() for fund_df in frames.values()))
+
+
+class NavPanelStore():
+    """
+    A NavPanel saved in a directory, one .npy file per field.
+
+    Each field is saved in Fortran order, so the history of one fund is
+    contiguous on disk and loading some symbols only touches their columns.
+
+    Every append writes a new generation of the files, <name>.<generation>.npy,
+    and then meta.json, which names the generation and its shapes. The panel is
+    only what meta.json names, so an append that is stopped halfway leaves the
+    previous panel as it was.
+
+
+    Parameters
+    ----------
+    path : string
+        The directory of the panel, e.g. ./data/originaldata/20161116/fund/navpanel/
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def exists(self):
+        return self._meta() is not None
+
+
+    def append(self, panel):
+        """
+        Merge panel into the stored one and save it.
+
+        Parameters
+        ----------
+        panel : NavPanel or dict of symbol --> DataFrame
+        """
+
+        if not isinstance(panel, NavPanel):
+            panel = NavPanel.from_frames(panel)
+
+        meta = self._meta()
+        if meta is not None:
+            panel = self.load(mmap = False).merge(panel)
+
+        utility.check_path(self.path)
+
+        generation = 1 if meta is None else meta['generation'] + 1
+        self._save('dates', generation, panel.dates)
+        self._save('symbols', generation, panel.symbols)
+        self._save('present', generation, panel.present)
+        for field in panel.fields():
+            self._save(field, generation, panel.data[field])
+
+        # The new generation is the panel only once meta.json is replaced, the files are all written by then.
+        new_meta = {'generation' : generation, 'dates' : len(panel.dates), 'symbols' : len(panel.symbols),
+                    'fields' : list(panel.fields())}
+        meta_file = os.path.join(self.path, 'meta.json')
+        with open(meta_file + '.tmp', 'w') as f:
+            json.dump(new_meta, f)
+        os.replace(meta_file + '.tmp', meta_file)
+
+        self._remove_other_generations(new_meta)
+
+        return panel
+
+
+    def load(self, symbols = None, start = None, end = None, fields = None, mmap = True):
+        """
+        Load the stored panel.
+
+        Parameters
+        ----------
+        symbols : list of string, default is all the symbols
+
+        start, end : string, e.g. '2016-01-01', default is all the days
+
+        fields : list of string, default is all the stored fields
+
+        mmap : bool, default is True
+            True: memory-map the files, only the selected part is read from disk.
+
+        Raises ValueError if a file does not have the shape of the panel.
+        """
+
+        meta = self._meta()
+        if meta is None:
+            raise IOError('No panel in %s' %(self.path))
+
+        generation = meta['generation']
+        mmap_mode = 'r' if mmap else None
+
+        dates   = np.load(self._file('dates', generation))
+        all_symbols = np.load(self._file('symbols', generation))
+
+        if fields is None:
+            fields = meta['fields']
+
+        data = dict((field, np.load(self._file(field, generation), mmap_mode = mmap_mode)) for field in fields)
+        present = np.load(self._file('present', generation), mmap_mode = mmap_mode)
+
+        # Every file must have the shape of the panel, a misaligned panel is never returned.
+        shape = (len(dates), len(all_symbols))
+        for name, array in [('present', present)] + sorted(data.items()):
+            if array.shape != shape:
+                raise ValueError('%s of the panel in %s has the shape %s, not %s'
+                                 %(name, self.path, array.shape, shape))
+        if shape != (meta['dates'], meta['symbols']):
+            raise ValueError('The panel in %s has the shape %s, not %s of meta.json'
+                             %(self.path, shape, (meta['dates'], meta['symbols'])))
+
+        panel = NavPanel(dates, all_symbols, data, present)
+
+        # The whole panel is not copied, a memory-mapped one is read only where it is used.
+        if symbols is None and start is None and end is None:
+            return panel
+
+        return panel.select(symbols, start, end)
+
+
+    def _meta(self):
+        # Returns the meta of the stored generation, None if there is no panel.
+        meta_file = os.path.join(self.path, 'meta.json')
+        if not os.path.exists(meta_file):
+            return None
+
+        with open(meta_file) as f:
+            return json.load(f)
+
+
+    def _file(self, name, generation):
+        return os.path.join(self.path, '%s.%d.npy' %(name, generation))
+
+
+    def _save(self, name, generation, array):
+        # The files of a generation are not read before meta.json names it, a half written one is never used.
+        with open(self._file(name, generation), 'wb') as f:
+            np.save(f, np.asfortranarray(array) if np.ndim(array) == 2 else array)
+
+
+    def _remove_other_generations(self, meta):
+        # The files of the older generations and of a stopped append, a file that is still mapped is left for the next append.
+        names = ['dates', 'symbols', 'present'] + meta['fields']
+        keep = set(os.path.basename(self._file(name, meta['generation'])) for name in names)
+        for file_name in os.listdir(self.path):
+            if (file_name.endswith('.npy') or file_name.endswith('.npy.tmp')) and file_name not in keep:
+                try:
+                    os.remove(os.path.join(self.path, file_name))
+                except OSError:
+                    pass
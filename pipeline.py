@@ -0,0 +1,124 @@
+'''
+Run the feature stages in memory and cache the output of each stage on disk.
+
+The cache key of a stage is made of its name, its parameters and its inputs
+(the keys of the upstream stages and the fingerprints of the files it reads),
+so changing only the parameters of a later stage skips the earlier ones.
+'''
+
+import os
+import pickle
+import hashlib
+
+import utility
+import metrics
+
+
+def path_fingerprint(path):
+    '''
+    Returns a string that changes when the file, or any file in the directory, changes.
+    The files are not read, only their names, sizes and modification times.
+    '''
+    if path is None or not os.path.exists(path):
+        return 'missing:%s' %(path)
+
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return 'file:%s:%d:%d' %(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8'))
+    for entry in sorted(os.scandir(path), key = lambda entry: entry.name):
+        stat = entry.stat()
+        digest.update(('%s:%d:%d;' %(entry.name, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+
+    return 'dir:' + digest.hexdigest()
+
+
+def stage_key(name, params = None, inputs = None):
+    '''
+    Returns the cache key of a stage.
+
+    Inputs:
+        name - the stage name.
+        params - dict of the parameters that change the output of the stage.
+        inputs - list of strings, the keys of the upstream stages and the fingerprints of the files.
+    '''
+    digest = hashlib.sha1(name.encode('utf-8'))
+    for param_name in sorted((params or {}).keys()):
+        digest.update(('%s=%r;' %(param_name, params[param_name])).encode('utf-8'))
+    for stage_input in (inputs or []):
+        digest.update(('%s;' %(stage_input)).encode('utf-8'))
+
+    return '%s-%s' %(name, digest.hexdigest()[:16])
+
+
+class Pipeline():
+    """
+    Run stages that pass DataFrames to each other in memory.
+    The wall time of every stage that runs is recorded in metrics.METRICS.
+
+
+    Parameters
+    ----------
+    cache_path : string, default is None
+        The directory to cache the output of each stage in, None does not cache.
+    """
+
+    def __init__(self, cache_path = None):
+        self.cache_path = cache_path
+
+
+    def run(self, name, function, args = (), params = None, inputs = None, options = None):
+        """
+        Run function(*args, **params, **options), or load its output from the cache.
+
+        Parameters
+        ----------
+        name : string
+            The stage name.
+
+        function : callable
+
+        args : tuple
+            The outputs of the upstream stages, their keys must be in inputs.
+
+        params : dict
+            The parameters that change the output, they are part of the key.
+
+        inputs : list of string
+            The keys of the upstream stages and the fingerprints of the files the stage reads.
+
+        options : dict
+            The parameters that do not change the output, e.g. the number of workers.
+
+        Returns
+        -------
+        (output, key)
+        """
+
+        params  = params or {}
+        options = options or {}
+        key = stage_key(name, params, inputs)
+
+        cache_file = None
+        if self.cache_path is not None:
+            cache_file = os.path.join(utility.check_path(self.cache_path), key + '.pkl')
+            if os.path.exists(cache_file):
+                print('Stage %s is cached in %s' %(name, cache_file))
+                metrics.METRICS.increment('stage_cache_hits', stage = name)
+                with open(cache_file, 'rb') as f:
+                    return pickle.load(f), key
+
+        print('Running stage %s...' %(name))
+        kwargs = dict(params)
+        kwargs.update(options)
+        with metrics.METRICS.stage(name):
+            output = function(*args, **kwargs)
+
+        if cache_file is not None:
+            # Write to a temporary file first, so a broken run never leaves a half written cache.
+            with open(cache_file + '.tmp', 'wb') as f:
+                pickle.dump(output, f, protocol = pickle.HIGHEST_PROTOCOL)
+            os.replace(cache_file + '.tmp', cache_file)
+
+        return output, key
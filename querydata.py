@@ -13,6 +13,7 @@ import os
 import datetime
 import logging
 import utility
+import fundbasic
 import datatypes as dy
 
 today_string = datetime.date.today().strftime("%Y-%m-%d").replace('-', '')
@@ -83,55 +84,16 @@ def _combine_fund_basic_data(short_path):
         tgr       --> fund_trustee       : 基金托管人
     '''
     # Read all the fund basic data file and combine them into one file.
-    fund_basic_df = pd.DataFrame()
     file_long_names = os.listdir(short_path)
 
-    # Read the first fund to initialize fund_basic_df
-    first_file_full_name = short_path + dy.sep + file_long_names[0]
-    fund_basic_df = pd.read_csv(first_file_full_name, dtype = {'symbol':str}, encoding = 'utf-8')
-    
-    for file_long_name in file_long_names[1:]:
-        print('Processing fund %s ...' %(file_long_name.split('.')[0]))
-
+    per_fund_list = []
+    for file_long_name in file_long_names:
         file_full_name = short_path + dy.sep + file_long_name
         per_fund = pd.read_csv(file_full_name, encoding = 'utf-8', dtype = {'symbol' : str})
-        # fund_basic_df = pd.merge(fund_basic_df, per_fund, on = 'symbol')
-        fund_basic_df = fund_basic_df.append(per_fund)
-
-    del fund_basic_df['jjqc'] # 基金全称
-    del fund_basic_df['ssrq'] # 上市日期
-    del fund_basic_df['xcr']  # 存续期限
-
-    # Give the column an english name, I think it's better than the old Chinese name.
-    fund_basic_df = fund_basic_df.rename(columns = {
-                                                    'jjjc'      : 'fund_short_name',
-                                                    'clrq'      : 'foundation_date',
-                                                    'ssdd'      : 'listed_location',
-                                                    'Type1Name' : 'operation_mode',
-                                                    'Type2Name' : 'fund_category',
-                                                    'Type3Name' : 'secondary_category',
-                                                    'jjgm'      : 'fund_scale',
-                                                    'jjfe'      : 'fund_amount',
-                                                    'jjltfe'    : 'circulation_share',
-                                                    'jjferq'    : 'fund_share_date',
-                                                    'quarter'   : 'listed_quarter',
-                                                    'glr'       : 'fund_company',
-                                                    'tgr'       : 'fund_trustee'
-                                                   })
-
-    fund_basic_df = fund_basic_df.set_index('symbol')
-
-    for fund_symbol in fund_basic_df.index:
-        # Change time format from "%Y-%m-%d %H:%M:%S" to "%Y-%m-%d".
-        date = datetime.datetime.strptime(fund_basic_df.loc[fund_symbol, 'foundation_date'], "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d")
-        fund_basic_df.loc[fund_symbol, 'foundation_date'] = date
-        
-        date = datetime.datetime.strptime(fund_basic_df.loc[fund_symbol, 'fund_share_date'], "%Y-%m-%d %H:%M:%S").strftime("%Y-%m-%d")
-        fund_basic_df.loc[fund_symbol, 'fund_share_date'] = date
+        per_fund_list.append(per_fund.set_index('symbol'))
 
-        # Remain 3 decimals
-        fund_basic_df.loc[fund_symbol, 'fund_amount'] = round(fund_basic_df.loc[fund_symbol, 'fund_amount'], 3)
-        fund_basic_df.loc[fund_symbol, 'circulation_share'] = round(fund_basic_df.loc[fund_symbol, 'circulation_share'], 3)
+    # 基金全称, 上市日期, 存续期限 are not used.
+    fund_basic_df = fundbasic.build_fund_basic_df(per_fund_list, drop_columns = ['jjqc', 'ssrq', 'xcr'])
 
     fund_info_file = utility.check_path(short_path) + '_basic' +'.csv'
     print('Saving fund basic infortation to %s ...' %(fund_info_file))
@@ -0,0 +1,139 @@
+'''
+Rank the funds by many criteria with partial selection.
+
+Finding the k-th largest value, or the k largest rows, does not need a full
+sort: np.partition and np.argpartition do it in linear time, for all the
+criteria in one call. The selections are bool masks over the rows, so the
+intersections and filters of many criteria are element-wise & and |.
+'''
+
+import numpy as np
+import pandas as pd
+
+
+def kth_largest(values, k):
+    '''
+    Returns the value that is k-th in a descending sort, k = 0 is the largest,
+    the same as sort_values(ascending = False).iloc[k]. NaN is sorted last.
+
+    Inputs:
+        values - 1-D array, or 2-D array of rows x criteria, then one value per criterion is returned.
+        k - the rank, NaN is returned if there are not more than k rows.
+    '''
+    values = np.asarray(values, dtype = float)
+    if values.shape[0] <= k:
+        return np.full(values.shape[1:], np.nan) if values.ndim > 1 else np.nan
+
+    # NaN stays NaN when negated and np.partition puts it last, like the descending sort does.
+    return -np.partition(-values, k, axis = 0)[k]
+
+
+def top_k_positions(values, k):
+    '''
+    Returns the positions of the k largest values, the largest first,
+    the same rows as sort_values(ascending = False)[:k]. NaN is taken last.
+    '''
+    values = np.asarray(values, dtype = float)
+    if k <= 0:
+        return np.array([], dtype = int)
+
+    if len(values) > k:
+        positions = np.argpartition(-values, k - 1)[:k]
+    else:
+        positions = np.arange(len(values))
+
+    # Only the k selected values are sorted, ties keep the row order.
+    return positions[np.lexsort((positions, -values[positions]))]
+
+
+class Ranking():
+    """
+    The criteria of a set of funds, ranked with partial selection.
+
+
+    Parameters
+    ----------
+    fund_df : DataFrame
+        The funds, one row per fund.
+
+    columns : list of string
+        The criteria, the larger the better.
+
+    mask : bool array, default is all the rows
+        Only these rows are ranked, e.g. the funds that are not outliers.
+    """
+
+    def __init__(self, fund_df, columns, mask = None):
+        self.fund_df = fund_df
+        self.columns = list(columns)
+        self.mask = np.ones(len(fund_df), dtype = bool) if mask is None else np.asarray(mask, dtype = bool)
+
+        self._values = fund_df[self.columns].to_numpy(dtype = float)
+
+
+    def values(self, column):
+        """
+        Returns the values of a criterion, NaN for the rows out of the mask.
+        """
+
+        return np.where(self.mask, self._values[:, self.columns.index(column)], np.nan)
+
+
+    def cutoffs(self, k):
+        """
+        Returns a Series of column --> the k-th largest value of the masked rows, k = 0 is the largest.
+        All the criteria are partitioned in one call.
+        """
+
+        return pd.Series(kth_largest(self._values[self.mask], k), index = self.columns)
+
+
+    def above(self, column, value):
+        """
+        Returns the mask of the ranked rows whose criterion is larger than value.
+        """
+
+        with np.errstate(invalid = 'ignore'):
+            return self.mask & (self._values[:, self.columns.index(column)] > value)
+
+
+    def top(self, k, columns = None):
+        """
+        Returns a dict of column --> mask of the rows that are larger than the k-th largest value,
+        the top k rows without the ties of the k-th one.
+        """
+
+        cutoffs = self.cutoffs(k)
+
+        return dict((column, self.above(column, cutoffs[column])) for column in (columns or self.columns))
+
+
+    def top_positions(self, column, k):
+        """
+        Returns the positions of the k largest rows of a criterion, the largest first.
+        """
+
+        return top_k_positions(self.values(column), k)
+
+
+    def top_mask(self, column, k):
+        """
+        Returns the mask of the k largest rows of a criterion.
+        """
+
+        mask = np.zeros(len(self.mask), dtype = bool)
+        mask[self.top_positions(column, k)] = True
+
+        return mask & self.mask
+
+
+    def select(self, mask, by = None):
+        """
+        Returns the rows of fund_df in mask, sorted by the criterion by from the largest, if it is given.
+        """
+
+        selected_df = self.fund_df[np.asarray(mask, dtype = bool)]
+        if by is not None:
+            selected_df = selected_df.sort_values(by = by, ascending = False, kind = 'mergesort')
+
+        return selected_df
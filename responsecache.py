@@ -0,0 +1,218 @@
+'''
+On-disk cache of the responses of tushare.
+
+A crash halfway through a fetch, or running a stage again to debug it, does
+not send the same thousands of requests again: CachedApi answers them from
+the cache while they are fresh. Every response is saved as a gzip compressed
+pickle, one file per endpoint and arguments, and the least recently used files
+are removed when the cache grows over its size.
+'''
+
+import os
+import gzip
+import time
+import pickle
+import hashlib
+import threading
+
+import utility
+
+
+# Seconds that a response of each endpoint stays fresh.
+# The symbol lists and the fund information change rarely, the NAV and the index change daily.
+DEFAULT_TTLS = {
+                'get_nav_open'    : 7 * 24 * 3600,
+                'get_fund_info'   : 7 * 24 * 3600,
+                'get_nav_history' : 12 * 3600,
+                'get_hist_data'   : 12 * 3600
+               }
+
+# The arguments that only change how a request is sent, not its response.
+TRANSPORT_ARGUMENTS = ['retry_count', 'pause', 'timeout']
+
+
+class ResponseCache():
+    """
+    A directory of cached responses, evicted by size.
+
+
+    Parameters
+    ----------
+    path : string
+        The directory of the cache, e.g. ./data/cache/responses/
+
+    ttls : dict, default is DEFAULT_TTLS
+        endpoint --> seconds that its responses stay fresh.
+        An endpoint that is not in ttls is not cached.
+
+    max_size_mb : float, default is 512
+        The cache removes the least recently used responses when its files are larger.
+    """
+
+    def __init__(self, path, ttls = None, max_size_mb = 512):
+        self.path = utility.check_path(path)
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.max_size = int(max_size_mb * 1024 * 1024)
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+        # file name --> [size, last used time], the eviction works on it without listing the directory.
+        self._entries = dict()
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl.gz'):
+                stat = entry.stat()
+                self._entries[entry.name] = [stat.st_size, stat.st_mtime]
+
+
+    def key(self, endpoint, args = (), kwargs = None):
+        """
+        Returns the file name of the response of endpoint(*args, **kwargs).
+        """
+
+        kwargs = dict((name, value) for name, value in (kwargs or {}).items() if name not in TRANSPORT_ARGUMENTS)
+
+        digest = hashlib.sha1(endpoint.encode('utf-8'))
+        digest.update(repr(tuple(args)).encode('utf-8'))
+        digest.update(repr(sorted(kwargs.items())).encode('utf-8'))
+
+        return '%s-%s.pkl.gz' %(endpoint, digest.hexdigest()[:24])
+
+
+    def get(self, endpoint, args = (), kwargs = None):
+        """
+        Returns (is_found, response), is_found is False if there is no fresh response.
+        """
+
+        if endpoint not in self.ttls:
+            return False, None
+
+        file_name = self.key(endpoint, args, kwargs)
+        cache_file = os.path.join(self.path, file_name)
+
+        try:
+            with gzip.open(cache_file, 'rb') as f:
+                saved_time, response = pickle.load(f)
+        except Exception:
+            # Missing, removed by another thread or broken, it is fetched again.
+            with self._lock:
+                self.misses += 1
+            return False, None
+
+        now = time.time()
+        with self._lock:
+            if now - saved_time > self.ttls[endpoint]:
+                self.misses += 1
+                return False, None
+
+            self.hits += 1
+            if file_name in self._entries:
+                self._entries[file_name][1] = now
+
+        # The modification time is the last use, so a cache opened again evicts by it too.
+        # The freshness is the saved time in the file, a hit does not make a response fresh again.
+        try:
+            os.utime(cache_file, (now, now))
+        except OSError:
+            pass
+
+        return True, response
+
+
+    def put(self, endpoint, args, kwargs, response):
+        """
+        Save a response, then remove the least recently used ones if the cache is too large.
+        """
+
+        if endpoint not in self.ttls or response is None:
+            return
+
+        file_name = self.key(endpoint, args, kwargs)
+        cache_file = os.path.join(self.path, file_name)
+
+        # Write to a temporary file first, a reader never sees a half written response.
+        temp_file = '%s.%d.tmp' %(cache_file, threading.get_ident())
+        with gzip.open(temp_file, 'wb', compresslevel = 6) as f:
+            pickle.dump((time.time(), response), f, protocol = pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(temp_file)
+        os.replace(temp_file, cache_file)
+
+        with self._lock:
+            self._entries[file_name] = [size, time.time()]
+            self._evict()
+
+
+    def size(self):
+        """
+        Returns the size of the cached files in bytes.
+        """
+
+        with self._lock:
+            return sum(entry[0] for entry in self._entries.values())
+
+
+    def clear(self):
+        with self._lock:
+            for file_name in list(self._entries):
+                self._remove(file_name)
+
+
+    def _evict(self):
+        total = sum(entry[0] for entry in self._entries.values())
+        if total <= self.max_size:
+            return
+
+        for file_name in sorted(self._entries, key = lambda name: self._entries[name][1]):
+            if total <= self.max_size:
+                break
+            total -= self._entries[file_name][0]
+            self._remove(file_name)
+
+
+    def _remove(self, file_name):
+        del self._entries[file_name]
+        try:
+            os.remove(os.path.join(self.path, file_name))
+        except OSError:
+            pass
+
+
+class CachedApi():
+    """
+    Wrap tushare, tushare.fund.nav or a fake of them and answer from a ResponseCache.
+
+    Every endpoint of the cache ttls is cached, any other attribute is passed to the api,
+    so an instance can be given to fetcher.Fecther as nav_api or ts_api.
+
+
+    Parameters
+    ----------
+    api : module or object
+        e.g. tushare.fund.nav
+
+    cache : ResponseCache
+    """
+
+    def __init__(self, api, cache):
+        self.api = api
+        self.cache = cache
+
+
+    def __getattr__(self, name):
+        function = getattr(self.api, name)
+        if name not in self.cache.ttls or not callable(function):
+            return function
+
+        def cached_function(*args, **kwargs):
+            is_found, response = self.cache.get(name, args, kwargs)
+            if is_found:
+                return response
+
+            response = function(*args, **kwargs)
+            self.cache.put(name, args, kwargs, response)
+
+            return response
+
+        return cached_function
@@ -0,0 +1,359 @@
+'''
+Content-addressed store of the daily data directories.
+
+Every run of main.py writes the whole history of every fund to a new
+directory of the day, which is nearly the same as the one of the day before.
+The store splits every file into chunks and keeps each distinct chunk once,
+compressed and named by the hash of its content, and a manifest per day lists
+the chunks of every file. A past day can be read file by file or written back
+to a directory whole, and the chunks of an unchanged part are shared by all
+the days that have it.
+
+The chunks end on a line whose last bytes hash to a multiple of a period, so
+the cut points depend only on the content around them. The history files have
+the latest day first, a new day changes the first chunk of a file and the rest
+of its chunks are found in the store already.
+
+The files that a day can be built again from are not stored: the navpanel,
+which main.py snapshot restore rebuilds from the history files, and the
+manifests and parts of the fetches, which only matter to a fetch that is
+running.
+'''
+
+import os
+import io
+import fnmatch
+import gzip
+import json
+import time
+import zlib
+import hashlib
+
+import numpy as np
+
+import utility
+
+
+# The bytes before the end of a line that decide if a chunk ends there.
+WINDOW_SIZE = 16
+
+# The hex digits of the sha256 of a chunk that name it, 128 bits.
+CHUNK_ID_LENGTH = 32
+
+# The relative paths that add_snapshot skips, the .npy files of a navpanel are binary and all of them
+# change every day, the bookkeeping of the fetches is of no use once they are done.
+EXCLUDED_PATTERNS = ['*navpanel/*', '*.manifest', '*.parts', '*.tmp']
+
+# Odd multipliers of the bytes of the window, fixed so that the cut points never change between runs.
+_WINDOW_WEIGHTS = np.random.RandomState(20161115).randint(1, 2 ** 62, WINDOW_SIZE, dtype = np.int64).astype(np.uint64) | np.uint64(1)
+
+
+def chunk_boundaries(data, period = 16, min_lines = 16, max_lines = 128):
+    '''
+    Split data at content defined line ends.
+    The chunk of a change is stored again, so smaller chunks store less per day but need longer manifests.
+
+    Inputs:
+        data - bytes.
+        period - a line end is a cut point with the probability 1 / period.
+        min_lines, max_lines - the least and the most lines of a chunk, the last chunk can be shorter.
+                               A chunk has about min_lines + period lines.
+
+    Returns: list of the end offset of every chunk, the last one is len(data).
+    '''
+    if len(data) == 0:
+        return []
+
+    buffer = np.frombuffer(data, dtype = np.uint8)
+    line_ends = np.flatnonzero(buffer == ord('\n')) + 1
+
+    # Hash the window of bytes before every line end at once, the first lines read the start of the data again.
+    window = np.maximum(line_ends[:, np.newaxis] - 1 - np.arange(WINDOW_SIZE)[np.newaxis, :], 0)
+    hashes = (buffer[window].astype(np.uint64) * _WINDOW_WEIGHTS).sum(axis = 1)
+    hashes ^= hashes >> np.uint64(29)
+    hashes *= np.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> np.uint64(32)
+    candidates = np.flatnonzero(hashes % np.uint64(period) == 0) + 1
+
+    # The line counts of the chunk ends, the forced cuts of max_lines are the only sequential part.
+    ends = list()
+    last = 0
+    for candidate in candidates.tolist():
+        while candidate - last > max_lines:
+            last += max_lines
+            ends.append(last)
+        if candidate - last >= min_lines:
+            ends.append(candidate)
+            last = candidate
+    while len(line_ends) - last > max_lines:
+        last += max_lines
+        ends.append(last)
+
+    # The last chunk has the lines after the last cut and the bytes after the last line end.
+    boundaries = line_ends[np.asarray(ends, dtype = np.int64) - 1].tolist()
+    if len(boundaries) == 0 or boundaries[-1] < len(data):
+        boundaries.append(len(data))
+
+    return boundaries
+
+
+class SnapshotStore():
+    """
+    The chunks and the manifests of the snapshots of the daily data directories.
+
+    The store is a directory with chunks/<2 hex>/<id>.z, the zlib compressed chunks,
+    and manifests/<day>.json.gz, the files of each day with their size, sha256 and chunks.
+
+
+    Parameters
+    ----------
+    path : string
+        The directory of the store, e.g. .\\data\\snapshots\\
+
+    period, min_lines, max_lines : int
+        See chunk_boundaries, a store must keep the same ones or the new days share nothing with the old.
+
+    compress_level : int, default is 6
+        The zlib level of the chunks.
+
+    exclude : list of string, default is EXCLUDED_PATTERNS
+        The fnmatch patterns of the relative paths, separated by /, that are not stored.
+    """
+
+    def __init__(self, path, period = 16, min_lines = 16, max_lines = 128, compress_level = 6, exclude = None):
+        self.path = path
+        self.exclude = EXCLUDED_PATTERNS if exclude is None else exclude
+        self.period = period
+        self.min_lines = min_lines
+        self.max_lines = max_lines
+        self.compress_level = compress_level
+
+        self._chunks_path = utility.check_path(os.path.join(path, 'chunks'))
+        self._manifests_path = utility.check_path(os.path.join(path, 'manifests'))
+
+        # The ids of the stored chunks, so adding a day does not ask the disk for every chunk.
+        self._chunk_ids = set()
+        for entry in os.scandir(self._chunks_path):
+            if entry.is_dir():
+                self._chunk_ids.update(name[:-2] for name in os.listdir(entry.path) if name.endswith('.z'))
+
+
+    def days(self):
+        """
+        Returns the sorted days of the stored snapshots.
+        """
+
+        return sorted(name[:-len('.json.gz')] for name in os.listdir(self._manifests_path) if name.endswith('.json.gz'))
+
+
+    def add_snapshot(self, day, directory):
+        """
+        Store every file under directory as the snapshot of day, a stored day is replaced.
+        The files that match exclude are skipped.
+
+        Returns: dict
+            day, files, bytes - the stored files of the day and their size.
+            excluded_files, excluded_bytes - the skipped files and their size.
+            chunks - the number of chunks of the files.
+            new_chunks, new_bytes - the chunks that were not in the store and their size.
+            stored_bytes - the size of the new chunks once compressed.
+        """
+
+        stats = {'day' : day, 'files' : 0, 'bytes' : 0, 'excluded_files' : 0, 'excluded_bytes' : 0,
+                 'chunks' : 0, 'new_chunks' : 0, 'new_bytes' : 0, 'stored_bytes' : 0}
+        files = dict()
+
+        for root, _, file_names in os.walk(directory):
+            for file_name in sorted(file_names):
+                file_spec = os.path.join(root, file_name)
+                relative_path = os.path.relpath(file_spec, directory).replace(os.sep, '/')
+                if self.is_excluded(relative_path):
+                    stats['excluded_files'] += 1
+                    stats['excluded_bytes'] += os.path.getsize(file_spec)
+                    continue
+
+                with open(file_spec, 'rb') as f:
+                    data = f.read()
+
+                chunk_ids = list()
+                start = 0
+                for end in chunk_boundaries(data, self.period, self.min_lines, self.max_lines):
+                    chunk = data[start:end]
+                    chunk_id = hashlib.sha256(chunk).hexdigest()[:CHUNK_ID_LENGTH]
+                    if chunk_id not in self._chunk_ids:
+                        stats['new_chunks'] += 1
+                        stats['new_bytes'] += len(chunk)
+                        stats['stored_bytes'] += self._put_chunk(chunk_id, chunk)
+                    chunk_ids.append(chunk_id)
+                    start = end
+
+                files[relative_path] = {'size' : len(data), 'sha256' : hashlib.sha256(data).hexdigest(), 'chunks' : chunk_ids}
+
+                stats['files'] += 1
+                stats['bytes'] += len(data)
+                stats['chunks'] += len(chunk_ids)
+
+        # The manifest is written last, a day is never listed before all its chunks are stored.
+        manifest = {'day' : day, 'created' : time.strftime('%Y-%m-%d %H:%M:%S'), 'files' : files}
+        manifest_file = self._manifest_file(day)
+        with gzip.open(manifest_file + '.tmp', 'wt', encoding = 'utf-8') as f:
+            json.dump(manifest, f, separators = (',', ':'))
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+        return stats
+
+
+    def is_excluded(self, relative_path):
+        """
+        Returns True if the file is not stored, relative_path is separated by /.
+        """
+
+        return any(fnmatch.fnmatch(relative_path, pattern) for pattern in self.exclude)
+
+
+    def manifest(self, day):
+        """
+        Returns the manifest of day, dict with day, created and files,
+        relative path --> {'size', 'sha256', 'chunks'}, the paths are separated by /.
+        """
+
+        manifest_file = self._manifest_file(day)
+        if not os.path.exists(manifest_file):
+            raise KeyError('No snapshot of %s in %s' %(day, self.path))
+
+        with gzip.open(manifest_file, 'rt', encoding = 'utf-8') as f:
+            return json.load(f)
+
+
+    def files(self, day):
+        """
+        Returns the relative paths of the files of day.
+        """
+
+        return sorted(self.manifest(day)['files'].keys())
+
+
+    def read_file(self, day, relative_path, manifest = None):
+        """
+        Returns the bytes of one file of day, e.g. read_file('20161115', 'fund/historyinfo/000001.csv').
+        The content is checked against its sha256, a broken chunk raises ValueError.
+        """
+
+        manifest = self.manifest(day) if manifest is None else manifest
+        entry = manifest['files'].get(relative_path.replace('\\', '/'))
+        if entry is None:
+            raise KeyError('No file %s in the snapshot of %s' %(relative_path, day))
+
+        data = b''.join(self._get_chunk(chunk_id) for chunk_id in entry['chunks'])
+        if hashlib.sha256(data).hexdigest() != entry['sha256']:
+            raise ValueError('The file %s of %s does not match its sha256, a chunk is broken' %(relative_path, day))
+
+        return data
+
+
+    def read_csv(self, day, relative_path, **kwargs):
+        """
+        Read one csv file of day with pd.read_csv(**kwargs), without writing it out.
+        """
+
+        import pandas as pd
+
+        return pd.read_csv(io.BytesIO(self.read_file(day, relative_path)), **kwargs)
+
+
+    def materialize(self, day, directory):
+        """
+        Write every file of day under directory.
+
+        Returns: the number of files written.
+        """
+
+        manifest = self.manifest(day)
+        for relative_path in sorted(manifest['files'].keys()):
+            file_spec = os.path.join(directory, *relative_path.split('/'))
+            utility.check_path(os.path.dirname(file_spec))
+            with open(file_spec, 'wb') as f:
+                f.write(self.read_file(day, relative_path, manifest))
+
+        return len(manifest['files'])
+
+
+    def verify(self, day, directory = None):
+        """
+        Read every file of day back from the store.
+
+        Returns: list of the relative paths that cannot be read or, if directory is given,
+                 that are not the same as the file under directory or only in one of them,
+                 the files under directory that are excluded are not compared.
+        """
+
+        manifest = self.manifest(day)
+        bad_paths = list()
+        for relative_path, entry in sorted(manifest['files'].items()):
+            try:
+                self.read_file(day, relative_path, manifest)
+            except (ValueError, IOError, OSError, zlib.error):
+                bad_paths.append(relative_path)
+                continue
+
+            if directory is not None:
+                file_spec = os.path.join(directory, *relative_path.split('/'))
+                if not os.path.exists(file_spec) or _file_sha256(file_spec) != entry['sha256']:
+                    bad_paths.append(relative_path)
+
+        if directory is not None:
+            for root, _, file_names in os.walk(directory):
+                for file_name in file_names:
+                    relative_path = os.path.relpath(os.path.join(root, file_name), directory).replace(os.sep, '/')
+                    if relative_path not in manifest['files'] and not self.is_excluded(relative_path):
+                        bad_paths.append(relative_path)
+
+        return bad_paths
+
+
+    def storage_usage(self):
+        """
+        Returns dict of the days, the chunks and the bytes that the chunks and the manifests take on disk.
+        """
+
+        chunk_bytes = 0
+        for entry in os.scandir(self._chunks_path):
+            if entry.is_dir():
+                chunk_bytes += sum(chunk.stat().st_size for chunk in os.scandir(entry.path))
+        manifest_bytes = sum(entry.stat().st_size for entry in os.scandir(self._manifests_path))
+
+        return {'days' : len(self.days()), 'chunks' : len(self._chunk_ids), 'chunk_bytes' : chunk_bytes,
+                'manifest_bytes' : manifest_bytes, 'total_bytes' : chunk_bytes + manifest_bytes}
+
+
+    def _put_chunk(self, chunk_id, chunk):
+        # Returns the compressed size.
+        chunk_file = self._chunk_file(chunk_id)
+        utility.check_path(os.path.dirname(chunk_file))
+
+        compressed = zlib.compress(chunk, self.compress_level)
+        # Write to a temporary file first, a chunk file is never half written.
+        with open(chunk_file + '.tmp', 'wb') as f:
+            f.write(compressed)
+        os.replace(chunk_file + '.tmp', chunk_file)
+        self._chunk_ids.add(chunk_id)
+
+        return len(compressed)
+
+
+    def _get_chunk(self, chunk_id):
+        with open(self._chunk_file(chunk_id), 'rb') as f:
+            return zlib.decompress(f.read())
+
+
+    def _chunk_file(self, chunk_id):
+        return os.path.join(self._chunks_path, chunk_id[:2], chunk_id + '.z')
+
+
+    def _manifest_file(self, day):
+        return os.path.join(self._manifests_path, '%s.json.gz' %(day))
+
+
+def _file_sha256(file_spec):
+    with open(file_spec, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
@@ -0,0 +1,177 @@
+'''
+Sweep the thresholds of the label rules over a grid and rank them by their backtest.
+
+The features and the forward returns of every rebalance day do not depend on
+the thresholds, so they are computed once and put in shared memory. Each worker
+process attaches to the blocks when it starts and evaluates its part of the grid
+on views of them, nothing but the parameters and the summaries is pickled.
+'''
+
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import datatypes as dy
+import backtest
+import labelengine
+
+
+# The thresholds of GenerateLabelFundsToFiles and MakeTopFundsPlot, the middle value is the one they use.
+SWEEP_GRID = {
+                'num_of_candidates'            : [50, 100, 200],
+                'min_days_of_processed'        : [60, 100, 250],
+                'max_increase_of_one_month'    : [0.2, 0.3, 0.5],
+                'max_increase_of_three_months' : [0.3, 0.5, 1.0],
+                'top_num'                      : [25, 50, 100],
+                'min_fund_scale'               : [2, 5, 10]
+             }
+
+# The feature columns that the rules of sweep_rules use.
+SWEEP_HORIZONS = [dy.ONE_MONTH, dy.TWO_MONTHS, dy.THREE_MONTHS]
+
+
+def parameter_grid(grid):
+    '''
+    Returns the list of every combination of the values of grid, a dict of name --> list of values.
+    '''
+    names = list(grid.keys())
+
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def sweep_rules(params):
+    '''
+    Returns (universe, rules) of the labels of GenerateLabelFundsToFiles and the targets of MakeTopFundsPlot
+    with the thresholds of params, the names of SWEEP_GRID.
+    '''
+    universe, rules = labelengine.default_label_rules(params['num_of_candidates'], params['min_days_of_processed'],
+                                                      params['max_increase_of_one_month'], params['max_increase_of_three_months'])
+
+    return universe, rules + [labelengine.top_funds_rule(params['top_num'], params['min_fund_scale'])]
+
+
+def run_sweep(walk_forward, fund_scales, grid = None, step = dy.ONE_MONTH, holding = None, warmup = dy.SIX_MONTHS,
+              workers = 1, rank_by = 'annual_excess_return'):
+    '''
+    Backtest every combination of the grid.
+
+    Inputs:
+        walk_forward - backtest.WalkForward of the funds.
+        fund_scales - Series of symbol --> fund_scale, the funds that are not in it never pass min_fund_scale.
+        grid - dict of name --> list of values, default is SWEEP_GRID.
+        step, holding, warmup - see backtest.WalkForward.run.
+        workers - the number of processes, the result is the same whatever it is.
+        rank_by - the column of backtest.summarize to rank the table by, the largest first.
+
+    Returns: DataFrame, one row per combination and strategy, the parameters, the strategy in label,
+             the columns of backtest.summarize and rank, 1 for the best.
+    '''
+    params_list = parameter_grid(SWEEP_GRID if grid is None else grid)
+    holding = step if holding is None else holding
+
+    days = walk_forward.rebalance_days(step, holding, warmup)
+    fund_returns, sci_returns = walk_forward.forward_returns(days, holding)
+
+    arrays = walk_forward.features(days, SWEEP_HORIZONS)
+    arrays['fund_scale'] = fund_scales.reindex(walk_forward.symbols).values.astype(float)
+    arrays['fund_returns'] = fund_returns
+    arrays['sci_returns'] = sci_returns
+    arrays['dates'] = walk_forward.dates[days]
+
+    print('Sweeping %s combinations on %s rebalance days of %s funds...' %(len(params_list), len(days), len(walk_forward.symbols)))
+
+    if workers <= 1:
+        _init_worker(None, arrays, holding)
+        summaries = [_evaluate_params(params) for params in params_list]
+    else:
+        blocks = dict()
+        try:
+            specs = dict()
+            for name, array in arrays.items():
+                block = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+                blocks[name] = block
+                np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf)[...] = array
+                specs[name] = (block.name, array.shape, array.dtype.str)
+
+            # A few chunks per worker, so the workers that finish first take the rest.
+            chunksize = max(1, len(params_list) // (workers * 4))
+            with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (specs, None, holding)) as executor:
+                summaries = list(executor.map(_evaluate_params, params_list, chunksize = chunksize))
+        finally:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+
+    sweep_df = pd.concat(summaries, ignore_index = True)
+    sweep_df = sweep_df.sort_values(by = rank_by, ascending = False, kind = 'mergesort', na_position = 'last').reset_index(drop = True)
+    sweep_df['rank'] = np.arange(1, len(sweep_df) + 1)
+
+    return sweep_df
+
+
+# The arrays of run_sweep in this process, and the shared memory blocks that they are views of.
+_ARRAYS = None
+_BLOCKS = None
+_HOLDING = None
+
+
+def _init_worker(specs, arrays, holding):
+    global _ARRAYS, _BLOCKS, _HOLDING
+
+    _HOLDING = holding
+    if specs is None:
+        _ARRAYS = arrays
+        return
+
+    # The blocks must stay open as long as the views of them are used.
+    _BLOCKS = dict((name, shared_memory.SharedMemory(name = spec[0])) for name, spec in specs.items())
+    _ARRAYS = dict((name, np.ndarray(spec[1], dtype = np.dtype(spec[2]), buffer = _BLOCKS[name].buf)) for name, spec in specs.items())
+
+
+def _evaluate_params(params):
+    '''
+    Backtest one combination on the arrays of the process, it runs in the worker processes.
+    '''
+    universe, rules = sweep_rules(params)
+
+    results = backtest.evaluate_rules(_ARRAYS['dates'], _ARRAYS, _ARRAYS['fund_returns'], _ARRAYS['sci_returns'], rules, universe)
+    summary_df = backtest.summarize(results, _HOLDING)
+
+    params_df = pd.DataFrame([params] * len(summary_df), columns = list(params.keys()))
+    params_df['label'] = summary_df.index.values
+
+    return pd.concat([params_df, summary_df.reset_index(drop = True)], axis = 1)
+
+
+def RunSweep(fund_type = 'mix', panel_path = None, grid = None, workers = 1, rank_by = 'annual_excess_return',
+             output_file_long_path = None):
+    '''
+    Sweep the thresholds of the funds of fund_type and print the best ones.
+
+    Inputs:
+        fund_type, panel_path - see backtest.RunBacktest.
+        grid, workers, rank_by - see run_sweep.
+        output_file_long_path - save the ranked table to this file, if it is not None.
+
+    Returns: the ranked table, see run_sweep.
+    '''
+    walk_forward = backtest.load_walk_forward(fund_type, panel_path)
+
+    basic_file = r'.\data\processingdata\fund\%s_fund_basic.csv' %(fund_type)
+    fund_scales = pd.read_csv(basic_file, encoding = 'utf-8', dtype = {'symbol' : str}).set_index('symbol')['fund_scale']
+
+    sweep_df = run_sweep(walk_forward, fund_scales, grid = grid, workers = workers, rank_by = rank_by)
+    print(sweep_df.head(20).to_string())
+
+    if output_file_long_path is not None:
+        sweep_df.to_csv(output_file_long_path, encoding = 'utf-8', index = False)
+        print('Saved %s rows of the sweep to %s' %(len(sweep_df), output_file_long_path))
+
+    return sweep_df
+
+
+if __name__ == "__main__":
+    RunSweep(workers = 4, output_file_long_path = r'.\data\processingdata\mix_fund_sweep.csv')
@@ -0,0 +1,97 @@
+'''
+The fund symbols of a run and the fund types of each symbol.
+
+The symbol lists are downloaded once per run, one request per fund type, and
+every fetch shares them: the union of the types is fetched once and the per
+type outputs are written from it.
+'''
+
+import pandas as pd
+
+
+# The fund types that nav.get_nav_open() accepts.
+FUND_TYPES = ['all', 'equity', 'mix', 'bond', 'monetary']
+
+
+class SymbolUniverse():
+    """
+    Fund symbols and the types that each symbol belongs to.
+
+
+    Parameters
+    ----------
+    type_symbols : dict
+        fund type --> list of symbols, e.g. {'mix' : ['000001', ...], 'bond' : [...]}.
+        The symbols keep the order they are given in, the first type first.
+    """
+
+    def __init__(self, type_symbols):
+        self._fund_types = list(type_symbols.keys())
+        self._types = dict()
+
+        for fund_type, symbols in type_symbols.items():
+            for symbol in symbols:
+                symbol_types = self._types.setdefault(str(symbol), [])
+                if fund_type not in symbol_types:
+                    symbol_types.append(fund_type)
+
+
+    def __len__(self):
+        return len(self._types)
+
+
+    def __contains__(self, symbol):
+        return symbol in self._types
+
+
+    def fund_types(self):
+        return list(self._fund_types)
+
+
+    def symbols(self, fund_type = None):
+        """
+        Returns the symbols of fund_type, None returns the union of all the types.
+        """
+
+        if fund_type is None:
+            return list(self._types.keys())
+
+        return [symbol for symbol, symbol_types in self._types.items() if fund_type in symbol_types]
+
+
+    def types_of(self, symbol):
+        return list(self._types.get(symbol, []))
+
+
+    def partition(self, df):
+        """
+        Split a DataFrame indexed by symbol into fund type --> the rows of that type.
+        """
+
+        return dict((fund_type, df[df.index.isin(self.symbols(fund_type))]) for fund_type in self._fund_types)
+
+
+    def save(self, file_spec):
+        """
+        Save the universe to a csv file, one row per symbol, the types joined by '|'.
+        """
+
+        universe_df = pd.DataFrame({'types' : ['|'.join(self._types[symbol]) for symbol in self._types]},
+                                   index = pd.Index(self.symbols(), name = 'symbol'))
+        universe_df.to_csv(file_spec, encoding = 'utf-8')
+
+
+    @classmethod
+    def load(cls, file_spec):
+        """
+        Load a universe saved by save().
+        """
+
+        universe_df = pd.read_csv(file_spec, encoding = 'utf-8', dtype = {'symbol' : str, 'types' : str})
+
+        type_symbols = dict()
+        for symbol, symbol_types in zip(universe_df['symbol'], universe_df['types']):
+            for fund_type in symbol_types.split('|'):
+                type_symbols.setdefault(fund_type, []).append(symbol)
+
+        return cls(type_symbols)
@@ -0,0 +1,279 @@
+'''
+Synthetic fund universe for benchmarks and offline runs.
+
+SyntheticUniverse makes N funds x D days of NAV history, their basic information
+and the benchmark indices. FakeNav serves them with the same functions
+and return formats as tushare.fund.nav and tushare.get_hist_data, with a
+configurable latency and failure rate, so Fecther can run against it without
+network and write the files in exactly the format it writes today.
+'''
+
+import time
+import zlib
+import random
+import threading
+
+import numpy as np
+import pandas as pd
+
+import navpanel
+import fetcher
+import utility
+import datatypes as dy
+
+
+FUND_TYPES = ['equity', 'mix', 'bond', 'monetary']
+
+
+class SyntheticUniverse():
+    """
+    A random but reproducible fund universe.
+
+
+    Parameters
+    ----------
+    num_of_funds : int
+
+    num_of_days : int
+        The number of trading days, ending on end_day.
+
+    end_day : string, default is '2016-11-15'
+
+    seed : int, default is 0
+    """
+
+    def __init__(self, num_of_funds, num_of_days, end_day = '2016-11-15', seed = 0):
+        random_state = np.random.RandomState(seed)
+        self.seed = seed
+
+        self.calendar = pd.bdate_range(end = end_day, periods = num_of_days)
+        self.symbols  = ['%06d' %(i) for i in range(num_of_funds)]
+        self.fund_types = dict((symbol, FUND_TYPES[i % len(FUND_TYPES)]) for i, symbol in enumerate(self.symbols))
+
+        # Each fund starts on a random day, like newly set up funds do.
+        self.start_rows = random_state.randint(0, max(1, num_of_days - dy.ONE_MONTH), num_of_funds)
+
+        returns = random_state.randn(num_of_days, num_of_funds) * 0.012 + 0.0003
+        returns[np.arange(num_of_days)[:, np.newaxis] <= self.start_rows[np.newaxis, :]] = 0.0
+        self.values = np.round(np.cumprod(1 + returns, axis = 0), 4)
+        self.values[np.arange(num_of_days)[:, np.newaxis] < self.start_rows[np.newaxis, :]] = np.nan
+        self.totals = np.round(self.values + random_state.rand(num_of_funds)[np.newaxis, :], 4)
+
+        self.fund_scales = np.round(random_state.rand(num_of_funds) * 30, 4)
+
+        sci_close = 3000 * np.cumprod(1 + random_state.randn(num_of_days) * 0.013)
+        self.sci_close  = np.round(sci_close, 2)
+        self.sci_change = np.round(np.r_[np.nan, np.diff(sci_close) / sci_close[:-1] * 100], 2)
+
+
+    def nav_history(self, fund_symbol, start = None, end = None):
+        """
+        The history of one fund as nav.get_nav_history() returns it, None if there is no day.
+        """
+
+        column = int(fund_symbol)
+        rows = np.flatnonzero(~np.isnan(self.values[:, column]) & self._date_mask(start, end))
+        if len(rows) == 0:
+            return None
+
+        his_df = pd.DataFrame({'value' : self.values[rows, column],
+                               'total' : self.totals[rows, column]},
+                              index = pd.Index(self.calendar[rows], name = 'date'))
+        his_df = his_df.sort_index(ascending = False)
+        his_df['pre_value'] = his_df['value'].shift(-1)
+        his_df['change'] = (his_df['value'] / his_df['pre_value'] - 1) * 100
+        his_df = his_df.drop('pre_value', axis = 1)
+
+        return his_df
+
+
+    def fund_info(self, fund_symbol):
+        """
+        The basic information of one fund as nav.get_fund_info() returns it.
+        """
+
+        column = int(fund_symbol)
+        foundation_date = self.calendar[self.start_rows[column]].strftime('%Y-%m-%d')
+        fund_type = self.fund_types[fund_symbol]
+
+        return pd.DataFrame({
+                                'jjqc'      : ['Synthetic %s fund %s' %(fund_type, fund_symbol)],
+                                'jjjc'      : ['Fund %s' %(fund_symbol)],
+                                'clrq'      : [foundation_date + ' 00:00:00'],
+                                'ssrq'      : [foundation_date + ' 00:00:00'],
+                                'xcr'       : ['--'],
+                                'ssdd'      : ['--'],
+                                'Type1Name' : ['open'],
+                                'Type2Name' : [fund_type],
+                                'Type3Name' : [fund_type],
+                                'jjgm'      : [self.fund_scales[column]],
+                                'jjfe'      : ['%.6f' %(self.fund_scales[column] / 1.3)],
+                                'jjltfe'    : ['%.6f' %(self.fund_scales[column] / 1.7)],
+                                'jjferq'    : [self.calendar[-1].strftime('%Y-%m-%d') + ' 00:00:00'],
+                                'quarter'   : ['4'],
+                                'glr'       : ['Synthetic fund company'],
+                                'tgr'       : ['Synthetic bank'],
+                            },
+                            index = pd.Index([fund_symbol], name = 'symbol'))
+
+
+    def sci_history(self, start = None, end = None):
+        """
+        The Shanghai Composite Index as ts.get_hist_data('sh') returns it.
+        """
+
+        return self.index_history('sh', start, end)
+
+
+    def index_history(self, code, start = None, end = None):
+        """
+        The index of code as ts.get_hist_data(code) returns it, 'sh' is the SCI.
+        The other indices follow the SCI with some noise of their own, the same for the same code.
+        """
+
+        if code == 'sh':
+            index_close, index_change = self.sci_close, self.sci_change
+        else:
+            random_state = np.random.RandomState([self.seed, zlib.crc32(code.encode('utf-8'))])
+            index_close = self.sci_close * np.cumprod(1 + random_state.randn(len(self.calendar)) * 0.006)
+            index_change = np.round(np.r_[np.nan, np.diff(index_close) / index_close[:-1] * 100], 2)
+            index_close = np.round(index_close, 2)
+
+        rows = np.flatnonzero(self._date_mask(start, end))
+        close = index_close[rows]
+        index_df = pd.DataFrame({'open'         : close,
+                                 'high'         : close,
+                                 'close'        : close,
+                                 'low'          : close,
+                                 'volume'       : 1e9,
+                                 'price_change' : np.round(close * index_change[rows] / 100, 2),
+                                 'p_change'     : index_change[rows],
+                                 'ma5'          : close,
+                                 'ma10'         : close,
+                                 'ma20'         : close,
+                                 'v_ma5'        : 1e9,
+                                 'v_ma10'       : 1e9,
+                                 'v_ma20'       : 1e9},
+                                index = pd.Index(self.calendar[rows].strftime('%Y-%m-%d'), name = 'date'))
+
+        return index_df.sort_index(ascending = False)
+
+
+    def panel(self):
+        """
+        The universe as a navpanel.NavPanel.
+        """
+
+        change = np.full(self.values.shape, np.nan)
+        change[1:] = (self.values[1:] / self.values[:-1] - 1) * 100
+
+        return navpanel.NavPanel(self.calendar.values, self.symbols,
+                                 {'value' : self.values, 'total' : self.totals, 'change' : change},
+                                 ~np.isnan(self.values))
+
+
+    def _date_mask(self, start, end):
+        mask = np.ones(len(self.calendar), dtype = bool)
+        if start is not None:
+            mask &= self.calendar >= pd.Timestamp(start)
+        if end is not None:
+            mask &= self.calendar <= pd.Timestamp(end)
+
+        return mask
+
+
+class FakeNav():
+    """
+    Serve a SyntheticUniverse like tushare does.
+
+    It has get_nav_open, get_fund_info and get_nav_history of tushare.fund.nav
+    and get_hist_data of tushare, so it can be passed to fetcher.Fecther as
+    both nav_api and ts_api.
+
+
+    Parameters
+    ----------
+    universe : SyntheticUniverse
+
+    latency : float, default is 0
+        Seconds that every call waits, like a network round trip.
+
+    failure_rate : float, default is 0
+        The probability that a call raises IOError.
+
+    seed : int, default is 0
+    """
+
+    def __init__(self, universe, latency = 0.0, failure_rate = 0.0, seed = 0):
+        self.universe = universe
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = dict()
+
+
+    def get_nav_open(self, fund_type = 'all'):
+        self._call('get_nav_open')
+        symbols = [symbol for symbol in self.universe.symbols
+                   if fund_type == 'all' or self.universe.fund_types[symbol] == fund_type]
+
+        return pd.DataFrame({'symbol' : symbols})
+
+
+    def get_fund_info(self, code):
+        self._call('get_fund_info')
+
+        return self.universe.fund_info(code)
+
+
+    def get_nav_history(self, code, start = None, end = None, retry_count = 3, pause = 0.001, timeout = 10):
+        self._call('get_nav_history')
+
+        return self.universe.nav_history(code, start, end)
+
+
+    def get_hist_data(self, code = None, start = None, end = None, ktype = 'D', retry_count = 3, pause = 0.001):
+        self._call('get_hist_data')
+
+        return self.universe.index_history('sh' if code is None else code, start, end)
+
+
+    def _call(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            is_failed = self._random.random() < self.failure_rate
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if is_failed:
+            raise IOError('Synthetic failure of %s' %(endpoint))
+
+
+def write_processing_data(universe, fund_types = None, max_workers = 8):
+    '''
+    Write the universe to the files that featureengineer reads, relative to the current directory:
+    the per fund history, the basic information of all the funds and of each type, the types
+    of each fund and sh_index.csv, all written by fetcher.Fecther.
+    '''
+    if fund_types is None:
+        fund_types = FUND_TYPES
+
+    fake_nav = FakeNav(universe)
+    start_day = universe.calendar[0].strftime('%Y-%m-%d')
+    end_day   = universe.calendar[-1].strftime('%Y-%m-%d')
+
+    fund_path = r'.\data\processingdata\fund'
+    file_short_path = utility.check_path(fund_path + r'\historyinfo') + dy.sep
+
+    fc = fetcher.Fecther(nav_api = fake_nav, ts_api = fake_nav)
+    symbol_universe = fc.get_symbol_universe(fund_types)
+    symbol_universe.save(fund_path + r'\fund_types.csv')
+
+    # Another universe may have been written here before, so never resume.
+    fc.fetch_fund_basic_data(symbol_universe, fund_path + r'\fund_basic.csv', type_path = fund_path + r'\%s_fund_basic.csv', resume = False)
+    fc.fetch_fund_history_data(symbol_universe, file_short_path, start_day = start_day, end_day = end_day, max_workers = max_workers,
+                               resume = False)
+    fc.fetch_shanghai_index(fund_path + r'\sh_index.csv', start_day = start_day, end_day = end_day)
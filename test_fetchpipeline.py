@@ -0,0 +1,148 @@
+'''
+Tests of the retries, the failures and the resume of fetchpipeline, against a stub nav api.
+
+    python -m pytest -q test_fetchpipeline.py
+'''
+
+import json
+import threading
+
+import pytest
+
+import fetchpipeline
+
+
+class StubNav():
+    """
+    A nav api whose get_nav_history fails the first failures[symbol] calls of a symbol.
+    """
+
+    def __init__(self, failures = None):
+        self.failures = dict(failures or {})
+        self.calls = dict()
+        self._lock = threading.Lock()
+
+
+    def get_nav_history(self, symbol):
+        with self._lock:
+            self.calls[symbol] = self.calls.get(symbol, 0) + 1
+            if self.calls[symbol] <= self.failures.get(symbol, 0):
+                raise IOError('timeout of %s' %(symbol))
+
+        return 'history of %s' %(symbol)
+
+
+def run(symbols, nav, manifest = None, consume = None, max_attempts = 3):
+    consumed = dict()
+
+    def _consume(symbol, result):
+        if consume is not None:
+            consume(symbol, result)
+        consumed[symbol] = result
+
+    summary = fetchpipeline.run_fetch_pipeline(symbols, nav.get_nav_history, _consume, manifest = manifest, max_workers = 4,
+                                               max_attempts = max_attempts, backoff = 0.001, max_backoff = 0.01, name = 'test')
+
+    return summary, consumed
+
+
+def test_retry_delay_doubles_up_to_the_cap():
+    assert [fetchpipeline.retry_delay(attempts, 0.5, 3.0) for attempts in range(1, 6)] == [0.5, 1.0, 2.0, 3.0, 3.0]
+
+
+def test_failed_requests_are_retried():
+    nav = StubNav({'000002' : 2})
+
+    summary, consumed = run(['000001', '000002', '000003'], nav)
+
+    assert sorted(summary['succeeded']) == ['000001', '000002', '000003']
+    assert summary['failed'] == {}
+    assert nav.calls == {'000001' : 1, '000002' : 3, '000003' : 1}
+    assert consumed['000002'] == 'history of 000002'
+
+
+def test_symbol_fails_after_max_attempts(tmp_path):
+    nav = StubNav({'000002' : 10})
+    manifest = fetchpipeline.FetchManifest(str(tmp_path / 'history.manifest'))
+
+    summary, consumed = run(['000001', '000002'], nav, manifest = manifest, max_attempts = 3)
+
+    assert summary['succeeded'] == ['000001']
+    assert list(summary['failed'].keys()) == ['000002']
+    assert nav.calls['000002'] == 3
+    assert '000002' not in consumed
+    assert manifest.failed()['000002'] == {'error' : 'timeout of 000002', 'attempts' : 3}
+
+
+def test_consume_error_is_not_retried():
+    nav = StubNav()
+
+    def consume(symbol, result):
+        if symbol == '000001':
+            raise ValueError('disk full')
+
+    summary, _ = run(['000001', '000002'], nav, consume = consume)
+
+    assert summary['succeeded'] == ['000002']
+    assert summary['failed'] == {'000001' : 'disk full'}
+    assert nav.calls['000001'] == 1
+
+
+def test_resume_fetches_only_the_symbols_not_completed(tmp_path):
+    manifest_file = str(tmp_path / 'history.manifest')
+    params = {'start_day' : '2011-09-11', 'end_day' : '2016-11-15'}
+    symbols = ['000001', '000002', '000003']
+
+    first_nav = StubNav({'000002' : 10})
+    run(symbols, first_nav, manifest = fetchpipeline.FetchManifest(manifest_file, params), max_attempts = 1)
+
+    manifest = fetchpipeline.FetchManifest(manifest_file, params)
+    assert manifest.is_resumed
+
+    second_nav = StubNav()
+    summary, consumed = run(symbols, second_nav, manifest = manifest)
+
+    assert second_nav.calls == {'000002' : 1}
+    assert list(consumed.keys()) == ['000002']
+    assert summary['succeeded'] == symbols
+    assert summary['failed'] == {}
+
+
+def test_manifest_of_other_params_starts_again(tmp_path):
+    manifest_file = str(tmp_path / 'history.manifest')
+    run(['000001'], StubNav(), manifest = fetchpipeline.FetchManifest(manifest_file, {'end_day' : '2016-11-15'}))
+
+    manifest = fetchpipeline.FetchManifest(manifest_file, {'end_day' : '2016-11-16'})
+    nav = StubNav()
+    run(['000001'], nav, manifest = manifest)
+
+    assert not manifest.is_resumed
+    assert nav.calls == {'000001' : 1}
+
+
+def test_resume_ignores_a_cut_off_last_line(tmp_path):
+    manifest_file = tmp_path / 'history.manifest'
+    params = {'end_day' : '2016-11-15'}
+    manifest_file.write_text(json.dumps({'params' : params}) + '\n' +
+                             json.dumps({'symbol' : '000001', 'status' : 'completed'}) + '\n' +
+                             '{"symbol": "000002", "sta', encoding = 'utf-8')
+
+    manifest = fetchpipeline.FetchManifest(str(manifest_file), params)
+
+    assert manifest.is_resumed
+    assert manifest.start(['000001', '000002']) == ['000002']
+    manifest.close()
+
+
+def test_parts_file_keeps_the_records_before_a_cut_off_one(tmp_path):
+    parts_file = str(tmp_path / 'fund_basic.csv.parts')
+    fetchpipeline.append_part(parts_file, '000001', {'name' : 'a'})
+    fetchpipeline.append_part(parts_file, '000002', {'name' : 'b'})
+    with open(parts_file, 'ab') as f:
+        f.write(b'\x80\x05\x95')
+
+    assert fetchpipeline.read_parts(parts_file) == {'000001' : {'name' : 'a'}, '000002' : {'name' : 'b'}}
+
+
+if __name__ == '__main__':
+    pytest.main(['-q', __file__])
@@ -0,0 +1,138 @@
+'''
+Tests of the freshness and the eviction of responsecache, against a stub nav api.
+
+    python -m pytest -q test_responsecache.py
+'''
+
+import os
+import time
+
+import pytest
+
+import responsecache
+
+
+class StubNav():
+    """
+    A nav api that counts the calls of get_nav_history.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+
+    def get_nav_history(self, symbol, start = None, end = None, retry_count = 3):
+        self.calls += 1
+        return 'history of %s' %(symbol)
+
+
+    def get_nav_open(self, fund_type):
+        self.calls += 1
+        return fund_type
+
+
+class FakeClock():
+    """
+    Stands in for the time module of responsecache, the time only moves when it is told to.
+    """
+
+    def __init__(self):
+        self.now = time.time()
+
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(responsecache, 'time', fake_clock)
+    return fake_clock
+
+
+def test_fresh_response_is_answered_from_the_cache(tmp_path, clock):
+    nav = StubNav()
+    api = responsecache.CachedApi(nav, responsecache.ResponseCache(str(tmp_path)))
+
+    assert api.get_nav_history('000001', start = '2016-01-01') == 'history of 000001'
+    # The transport arguments are not part of the key.
+    assert api.get_nav_history('000001', start = '2016-01-01', retry_count = 10) == 'history of 000001'
+    api.get_nav_history('000001', start = '2016-02-01')
+
+    assert nav.calls == 2
+    assert (api.cache.hits, api.cache.misses) == (1, 2)
+
+
+def test_endpoint_without_ttl_is_not_cached(tmp_path, clock):
+    nav = StubNav()
+    api = responsecache.CachedApi(nav, responsecache.ResponseCache(str(tmp_path), ttls = {'get_nav_history' : 60}))
+
+    api.get_nav_open('mix')
+    api.get_nav_open('mix')
+
+    assert nav.calls == 2
+    assert api.cache.size() == 0
+
+
+def test_response_expires_after_its_ttl_and_a_hit_does_not_renew_it(tmp_path, clock):
+    cache = responsecache.ResponseCache(str(tmp_path), ttls = {'get_nav_history' : 60})
+    cache.put('get_nav_history', ('000001',), {}, 'history')
+
+    clock.now += 50
+    assert cache.get('get_nav_history', ('000001',)) == (True, 'history')
+
+    clock.now += 20
+    assert cache.get('get_nav_history', ('000001',)) == (False, None)
+
+
+def test_broken_file_is_a_miss(tmp_path, clock):
+    cache = responsecache.ResponseCache(str(tmp_path))
+    cache.put('get_nav_history', ('000001',), {}, 'history')
+    with open(os.path.join(str(tmp_path), cache.key('get_nav_history', ('000001',))), 'wb') as f:
+        f.write(b'not gzip')
+
+    assert cache.get('get_nav_history', ('000001',)) == (False, None)
+    assert cache.misses == 1
+
+
+def _fill(cache, clock, symbols):
+    for symbol in symbols:
+        cache.put('get_nav_history', (symbol,), {}, 'history of %s' %(symbol))
+        clock.now += 1
+
+
+def _cached_symbols(cache, symbols):
+    return [symbol for symbol in symbols if os.path.exists(os.path.join(cache.path, cache.key('get_nav_history', (symbol,))))]
+
+
+def test_least_recently_used_response_is_evicted(tmp_path, clock):
+    cache = responsecache.ResponseCache(str(tmp_path))
+    _fill(cache, clock, ['000001', '000002'])
+    # Room for two responses but not three, their compressed sizes can differ by some bytes.
+    cache.max_size = cache.size() * 5 // 4
+
+    assert cache.get('get_nav_history', ('000001',))[0]
+    clock.now += 1
+    _fill(cache, clock, ['000003'])
+
+    assert _cached_symbols(cache, ['000001', '000002', '000003']) == ['000001', '000003']
+
+
+def test_recency_of_a_hit_survives_opening_the_cache_again(tmp_path, clock):
+    cache = responsecache.ResponseCache(str(tmp_path))
+    _fill(cache, clock, ['000001', '000002'])
+    max_size_mb = cache.size() * 1.25 / 1024.0 / 1024.0
+
+    assert cache.get('get_nav_history', ('000001',))[0]
+    clock.now += 1
+
+    # A new process only knows the modification times of the files.
+    cache = responsecache.ResponseCache(str(tmp_path), max_size_mb = max_size_mb)
+    _fill(cache, clock, ['000003'])
+
+    assert _cached_symbols(cache, ['000001', '000002', '000003']) == ['000001', '000003']
+
+
+if __name__ == '__main__':
+    pytest.main(['-q', __file__])
@@ -6,4 +6,40 @@ def check_path(path):
     else:
         os.makedirs(path)
 
-    return path
\ No newline at end of file
+    return path
+
+def find_previous_data_path(path, today_string):
+    """
+    Find the latest dated directory in path that is older than today_string,
+    for example '.\\data\\originaldata\\20161115\\' for today_string '20161116'.
+
+    Returns None if there is no such directory.
+    """
+    if not os.path.exists(path):
+        return None
+
+    days = [name for name in os.listdir(path)
+            if name.isdigit() and name < today_string and os.path.isdir(os.path.join(path, name))]
+
+    if len(days) == 0:
+        return None
+
+    return os.path.join(path, max(days)) + os.path.sep
+
+
+def memory_usage():
+    """
+    Returns the resident memory of this process in bytes, 0 if it cannot be found.
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        # Linux, the second number is the resident pages.
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return 0